@@ -0,0 +1,55 @@
+"""
+Benchmark of the pre/post paired batch loader: samples per second for a
+number of workers, with and without the shared memory cache, over a
+directory of synthetic patches laid out like the output of patch_utils.main
+
+USAGE:
+---
+    python -m src.benchmarks.bench_paired_loader [--pairs 2000] [--size 64] [--workers 0 2 4] [--epochs 2]
+    python -m src.benchmarks.bench_paired_loader --path data/processed/patches/irma
+"""
+import argparse
+import tempfile
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from models.pair_loader_utils import PairedPatchLoader, measure_throughput
+from tests.fixtures import write_synthetic_geotiff
+
+def make_synthetic_patches(path_to_hurricane_patches, pairs = 2000, size = 64, seed = 0):
+    """
+    Writes pre/{point_idx}-1.tif and post/{point_idx}-1.tif for pairs points,
+    of slightly different sizes around size x size like real patches
+    """
+    for point_idx in range(pairs):
+        for (phase, offset) in [("pre", 0), ("post", 1)]:
+            path = os.path.join(path_to_hurricane_patches, phase, f"{point_idx}-1.tif")
+            write_synthetic_geotiff(path, (0, 0, 1, 1), size = size - 2 + (point_idx + offset) % 5, seed = seed + 2 * point_idx + offset)
+
+def main(path_to_hurricane_patches = None, pairs = 2000, size = 64, workers = (0, 2, 4), epochs = 2, batch_size = 32):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if path_to_hurricane_patches is None:
+            path_to_hurricane_patches = tmpdir
+            make_synthetic_patches(path_to_hurricane_patches, pairs, size)
+        print(f"{'workers':>7} {'cache':>5} " + " ".join(f"{'epoch ' + str(epoch + 1):>12}" for epoch in range(epochs)) + "   (samples/s)")
+        for n in workers:
+            for cache in [False, True]:
+                with PairedPatchLoader(
+                    path_to_hurricane_patches, batch_size = batch_size, shape = (3, size, size),
+                    workers = n, cache = cache,
+                ) as loader:
+                    res = measure_throughput(loader, epochs)
+                print(f"{n:>7} {str(cache):>5} " + " ".join(f"{speed:12.0f}" for speed in res["samples_per_second"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help = "a directory of patches to load instead of synthetic ones, e.g. data/processed/patches/irma")
+    parser.add_argument("--pairs", type = int, default = 2000, help = "number of synthetic pre/post pairs")
+    parser.add_argument("--size", type = int, default = 64, help = "size of the synthetic patches and of the batches, in pixels")
+    parser.add_argument("--workers", type = int, nargs = "+", default = [0, 2, 4], help = "numbers of workers to try")
+    parser.add_argument("--epochs", type = int, default = 2, help = "number of epochs timed for each setting")
+    parser.add_argument("--batch-size", type = int, default = 32)
+    args = parser.parse_args()
+    main(args.path, args.pairs, args.size, args.workers, args.epochs, args.batch_size)
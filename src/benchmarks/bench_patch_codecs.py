@@ -0,0 +1,143 @@
+"""
+Benchmark of the ways the patches can be saved (see patch_codec_utils): for
+every codec and layout, the size of the GeoTIFFs of synthetic patches, the time
+to write them one by one and with a pool of encoding threads, and the time to
+read them back (from the page cache, so it is the cost of decoding, not of the disk)
+
+USAGE:
+---
+    python -m src.benchmarks.bench_patch_codecs [--patches 500] [--size 128] [--bands 3] [--repeat 3]
+"""
+import argparse
+import tempfile
+import time
+import shutil
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_bounds
+from rasterio.windows import Window
+from rasterio.crs import CRS
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.extraction_utils import GTiffSink, PatchJob
+from data_loading.patch_codec_utils import PatchEncoding, PATCH_CODECS, get_encoding
+
+def make_synthetic_patches(count = 500, size = 128, bands = 3, dtype = "uint8", seed = 0) -> list:
+    """
+    Patches that compress roughly like aerial imagery: smooth shading,
+    a few flat rectangles (roofs, roads) and some sensor noise
+
+    RETURNS:
+    ---
+        A list of (bands, size, size) arrays
+    """
+    rng = np.random.default_rng(seed)
+    top = np.iinfo(dtype).max if np.issubdtype(np.dtype(dtype), np.integer) else 1.0
+    (y, x) = np.mgrid[0:size, 0:size] / size
+    res = []
+    for _ in range(count):
+        (fx, fy, phase) = rng.uniform(0.5, 3, 3)
+        base = 0.5 + 0.25 * np.sin(2 * np.pi * (fx * x + phase)) * np.cos(2 * np.pi * fy * y)
+        data = np.repeat(base[None], bands, axis = 0) * rng.uniform(0.8, 1.2, (bands, 1, 1))
+        for _ in range(rng.integers(2, 6)):
+            (r0, c0) = rng.integers(0, size - 8, 2)
+            (h, w) = rng.integers(8, size // 2, 2)
+            data[:, r0:r0 + h, c0:c0 + w] = rng.uniform(0.1, 0.9, (bands, 1, 1))
+        data = data + rng.normal(0, 0.01, data.shape)
+        res.append((np.clip(data, 0, 1) * top).astype(dtype))
+    return res
+
+def get_benchmark_encodings(level = None) -> list:
+    encodings = [PatchEncoding()]
+    for codec in PATCH_CODECS:
+        for layout in ["tiles", "cog"]:
+            encodings.append(get_encoding(codec, level if codec in ["deflate", "zstd"] else None, layout))
+    return encodings
+
+def write_patches(patches, path_to_dir, encoding: PatchEncoding, threads) -> float:
+    """
+    Saves the patches in path_to_dir with a GTiffSink
+
+    RETURNS:
+    ---
+        The number of seconds it took
+    """
+    size = patches[0].shape[1]
+    transform = from_bounds(0, 0, 1, 1, size, size)
+    crs = CRS.from_epsg(4326)
+    sink = GTiffSink(encoding, threads)
+    start = time.perf_counter()
+    for (i, data) in enumerate(patches):
+        job = PatchJob(i, 0, 1, Window(0, 0, size, size), os.path.join(path_to_dir, f"{i}-1.tif"))
+        sink.write(job, data, transform, crs)
+    sink.flush()
+    return time.perf_counter() - start
+
+def read_patches(path_to_dir) -> tuple:
+    """
+    RETURNS:
+    ---
+        (the number of seconds it took to read all the GeoTIFFs of path_to_dir, their total size in bytes)
+    """
+    paths = [entry.path for entry in os.scandir(path_to_dir)]
+    start = time.perf_counter()
+    for path in paths:
+        with rio.open(path) as src:
+            src.read()
+    return (time.perf_counter() - start, sum(os.path.getsize(path) for path in paths))
+
+def run_benchmarks(patches, repeat = 3, threads = PATCH_ENCODE_THREADS, level = None) -> list:
+    """
+    RETURNS:
+    ---
+        One dictionary per encoding (see get_benchmark_encodings) with its codec,
+        layout, bytes (total size of the files), ratio (of the size of the uncompressed
+        files to bytes), write_seconds, threaded_write_seconds and read_seconds (best of repeat)
+    """
+    res = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for encoding in get_benchmark_encodings(level):
+            path_to_dir = os.path.join(tmpdir, f"{encoding.codec}-{encoding.layout}")
+            times = {"write_seconds": [], "threaded_write_seconds": [], "read_seconds": []}
+            for _ in range(repeat):
+                for (name, workers) in [("write_seconds", 0), ("threaded_write_seconds", threads)]:
+                    shutil.rmtree(path_to_dir, ignore_errors = True)
+                    os.makedirs(path_to_dir)
+                    times[name].append(write_patches(patches, path_to_dir, encoding, workers))
+                (seconds, size) = read_patches(path_to_dir)
+                times["read_seconds"].append(seconds)
+            res.append({"codec": encoding.codec, "layout": encoding.layout, "bytes": size,
+                **{name: min(values) for (name, values) in times.items()}})
+    for row in res:
+        row["ratio"] = res[0]["bytes"] / row["bytes"]
+    return res
+
+def format_results(res: list, count) -> str:
+    lines = [f"{'codec':<8} {'layout':<7} {'MB':>8} {'ratio':>6} {'write ms':>9} {'threaded':>9} {'read ms':>8}   (per {count} patches)"]
+    for row in res:
+        lines.append(
+            f"{row['codec']:<8} {row['layout']:<7} {row['bytes'] / 2**20:8.2f} {row['ratio']:6.2f} "
+            f"{row['write_seconds'] * 1000:9.1f} {row['threaded_write_seconds'] * 1000:9.1f} {row['read_seconds'] * 1000:8.1f}"
+        )
+    return "\n".join(lines)
+
+def main(count = 500, size = 128, bands = 3, dtype = "uint8", repeat = 3, threads = PATCH_ENCODE_THREADS, level = None) -> list:
+    patches = make_synthetic_patches(count, size, bands, dtype)
+    res = run_benchmarks(patches, repeat, threads, level)
+    print(format_results(res, count))
+    return res
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patches", type = int, default = 500, help = "number of synthetic patches")
+    parser.add_argument("--size", type = int, default = 128, help = "width and height of the patches, in pixels")
+    parser.add_argument("--bands", type = int, default = 3, help = "number of bands of the patches")
+    parser.add_argument("--dtype", default = "uint8", help = "data type of the pixels")
+    parser.add_argument("--repeat", type = int, default = 3, help = "number of times everything is timed (the best is kept)")
+    parser.add_argument("--threads", type = int, default = PATCH_ENCODE_THREADS, help = "number of encoding threads of the threaded writes")
+    parser.add_argument("--level", type = int, help = "compression level of deflate and zstd")
+    args = parser.parse_args()
+    main(args.patches, args.size, args.bands, args.dtype, args.repeat, args.threads, args.level)
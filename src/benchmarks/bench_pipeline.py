@@ -0,0 +1,250 @@
+"""
+Benchmark of every stage of the data pipeline, on synthetic scenes and building
+points (see synthetic_data) read from local files or from a local HTTP server:
+    tidy: tidy_up_tif_links, reading the header of every scene into a fresh catalog
+    bounds: get_list_of_bounds_for_hurricane and a FootprintIndex query of all the points
+    combine: combine_all_vector_data, reading the geojson files and saving them as GeoParquet
+    trim: trim_gdf
+    countries: add_country_names
+    assess: add_damage_assessments, joining the synthetic official assessments onto the points with imagery
+    plan: plan_patch_jobs for all the points with imagery, both phases
+    extract: extract_patches_by_scene for the first --extract-points of them, both phases
+
+The best time of every stage is compared with the baseline saved for the same
+configuration in baselines.json; the script exits with 1 if a stage got slower
+than the baseline by more than --tolerance
+
+USAGE:
+---
+    python -m src.benchmarks.bench_pipeline [--preset small|medium|large] [--points 1000] [--scenes 10] [--http]
+    python -m src.benchmarks.bench_pipeline --preset medium --save-baseline
+"""
+import argparse
+import json
+import tempfile
+import time
+from contextlib import ExitStack
+from unittest import mock
+import numpy as np
+import geopandas as gpd
+
+# Others
+from typing import NamedTuple
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.tif_links_utils import tidy_up_tif_links, get_list_of_bounds_for_hurricane, get_scene_metadata_for_hurricane
+from data_loading.footprint_utils import FootprintIndex
+from data_loading.vector_data_utils import combine_all_vector_data, trim_gdf, add_country_names, add_damage_assessments, read_vector_data_files
+from data_loading.extraction_utils import plan_patch_jobs, extract_patches_by_scene
+from data_loading.range_cache_utils import RANGE_CACHE_ENV
+from benchmarks.synthetic_data import make_synthetic_hurricane
+from tests.fixtures import LocalHTTPServer
+
+STAGES = ["tidy", "bounds", "combine", "trim", "countries", "assess", "plan", "extract"]
+PATH_TO_BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+# Stages faster than this are too noisy to be called regressions
+MIN_REGRESSION_SECONDS = 0.05
+
+class BenchmarkConfig(NamedTuple):
+    """
+    points, scenes: number of synthetic building points and scenes
+    source: "local" to read the scenes from files, "http" from a local HTTP server
+    scene_size: width and height of the scenes, in pixels
+    extract_points: number of points the extract stage crops patches for
+    dist: distance in meters from the point to each edge of the patches
+    """
+    points: int = 1000
+    scenes: int = 10
+    source: str = "local"
+    scene_size: int = 256
+    extract_points: int = 1000
+    dist: int = 20
+
+    @property
+    def key(self) -> str:
+        return f"{self.points}p-{self.scenes}s-{self.scene_size}px-{self.extract_points}x-{self.dist}m-{self.source}"
+
+PRESETS = {
+    "small": BenchmarkConfig(1000, 10),
+    "medium": BenchmarkConfig(100000, 100),
+    "large": BenchmarkConfig(1000000, 1000),
+}
+
+def best_time(f, repeat, setup = None) -> tuple:
+    """
+    RETURNS:
+    ---
+        (the best time of repeat calls to f, the result of the last one);
+        setup is called before every call, outside of the timing
+    """
+    best = np.inf
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        res = f()
+        best = min(best, time.perf_counter() - start)
+    return (best, res)
+
+def run_benchmarks(config: BenchmarkConfig, repeat = 3, toprint = True, root = None) -> dict:
+    """
+    Generates the synthetic data in root (a temporary directory by default)
+    and times every stage in STAGES, each one repeat times
+
+    Everything the pipeline writes goes to root too, and the range cache
+    is disabled so that every repeat reads the scenes again
+
+    RETURNS:
+    ---
+        A dictionary from stage to its best time in seconds
+    """
+    name = "synthetic"
+    with ExitStack() as stack:
+        if root is None:
+            root = stack.enter_context(tempfile.TemporaryDirectory())
+        start = time.perf_counter()
+        data = make_synthetic_hurricane(os.path.join(root, "raw"), config.points, config.scenes, config.scene_size)
+        print_message(toprint, f"Generated {config.points} points and {config.scenes} scenes in {time.perf_counter() - start:.1f}s")
+        links = data.scene_paths
+        if config.source == "http":
+            server = stack.enter_context(LocalHTTPServer(data.root))
+            links = [server.url(path) for path in links]
+        elif config.source != "local":
+            raise ValueError(f"Unknown source {config.source}")
+        processed = os.path.join(root, "processed")
+        path_to_catalog = os.path.join(processed, "scene-catalog.sqlite")
+        for patch in [
+            mock.patch("data_loading.catalog_utils.PATH_TO_SCENE_CATALOG", path_to_catalog),
+            mock.patch("data_loading.tif_links_utils.PATH_TO_TIDIED_FILELISTS", os.path.join(processed, "tidied")),
+            mock.patch("data_loading.tif_links_utils.PATH_TO_TIDY_REPORTS", os.path.join(processed, "tidy-reports")),
+            mock.patch("data_loading.vector_data_utils.PATH_TO_VECTOR_DATA", os.path.join(processed, "vector-data")),
+            mock.patch("data_loading.vector_data_utils.PATH_TO_GEOJSONS", os.path.join(processed, "geojsons")),
+            mock.patch("data_loading.vector_data_utils.load_all_vector_data_for_hurricane", lambda *args: data.vector_files),
+            mock.patch.dict(os.environ, {RANGE_CACHE_ENV: ""}),
+        ]:
+            stack.enter_context(patch)
+        os.makedirs(processed, exist_ok = True)
+
+        def forget_scenes():
+            if os.path.isfile(path_to_catalog):
+                os.remove(path_to_catalog)
+
+        def lookup_bounds():
+            bounds_dict = get_list_of_bounds_for_hurricane(name, False)
+            return [FootprintIndex(bounds_dict[phase]).query(data.xs, data.ys) for phase in ["pre", "post"]]
+
+        def plan():
+            records = get_scene_metadata_for_hurricane(name, False)
+            return {phase: plan_patch_jobs(records[phase], xs, ys, config.dist, None) for phase in ["pre", "post"]}
+
+        def extract():
+            records = get_scene_metadata_for_hurricane(name, False)
+            written = 0
+            for phase in ["pre", "post"]:
+                path_to_dir = os.path.join(processed, "patches", phase)
+                os.makedirs(path_to_dir, exist_ok = True)
+                jobs = plan_patch_jobs(records[phase], xs[:config.extract_points], ys[:config.extract_points], config.dist, path_to_dir)
+                written += extract_patches_by_scene([record.link for record in records[phase]], jobs, False)
+            return written
+
+        res = dict()
+        (res["tidy"], kept) = best_time(lambda: tidy_up_tif_links(links, name, False, overwrite = True), repeat, forget_scenes)
+        (res["bounds"], _) = best_time(lookup_bounds, repeat)
+        (res["combine"], combined) = best_time(lambda: combine_all_vector_data(name, False, True), repeat)
+        (res["trim"], trimmed) = best_time(lambda: trim_gdf(gpd.GeoDataFrame(combined), name, False), repeat)
+        (res["countries"], _) = best_time(lambda: add_country_names(trimmed.copy(), name, False), repeat)
+        official = read_vector_data_files(data.vector_files[-1:], False)
+        (res["assess"], _) = best_time(lambda: add_damage_assessments(trimmed.copy(), official, False), repeat)
+        (xs, ys) = (trimmed.geometry.x.to_numpy(), trimmed.geometry.y.to_numpy())
+        (res["plan"], jobs) = best_time(plan, repeat)
+        (res["extract"], written) = best_time(extract, repeat)
+        print_message(toprint, f"{len(kept)} scenes kept, {len(trimmed)} points with imagery, "
+            f"{sum(len(j) for j in jobs.values())} patches planned, {written} written")
+        return res
+
+def load_baselines(path = PATH_TO_BASELINES) -> dict:
+    if not os.path.isfile(path):
+        return dict()
+    with open(path) as f:
+        return json.load(f)
+
+def save_baseline(config: BenchmarkConfig, results: dict, path = PATH_TO_BASELINES):
+    """
+    Saves results as the baseline of config (replacing the previous one)
+    """
+    baselines = load_baselines(path)
+    baselines[config.key] = {
+        "config": config._asdict(),
+        "seconds": {stage: round(seconds, 4) for (stage, seconds) in results.items()},
+    }
+    with open(path, "w") as f:
+        json.dump(baselines, f, indent = 2, sort_keys = True)
+        f.write("\n")
+
+def find_regressions(results: dict, baseline: dict, tolerance = 0.5) -> dict:
+    """
+    RETURNS:
+    ---
+        A dictionary from every stage that took more than (1 + tolerance) times
+        its baseline (and at least MIN_REGRESSION_SECONDS more) to the ratio
+        between its time and the baseline
+    """
+    res = dict()
+    for (stage, seconds) in results.items():
+        if stage not in baseline:
+            continue
+        if seconds > baseline[stage] * (1 + tolerance) and seconds - baseline[stage] > MIN_REGRESSION_SECONDS:
+            res[stage] = seconds / baseline[stage]
+    return res
+
+def format_results(results: dict, baseline: dict = None, regressions: dict = None) -> str:
+    baseline = dict() if baseline is None else baseline
+    regressions = dict() if regressions is None else regressions
+    lines = [f"{'stage':<10} {'seconds':>9} {'baseline':>9} {'ratio':>7}"]
+    for (stage, seconds) in results.items():
+        if stage in baseline:
+            flag = "  REGRESSION" if stage in regressions else ""
+            lines.append(f"{stage:<10} {seconds:9.3f} {baseline[stage]:9.3f} {seconds / baseline[stage]:7.2f}{flag}")
+        else:
+            lines.append(f"{stage:<10} {seconds:9.3f} {'-':>9} {'-':>7}")
+    return "\n".join(lines)
+
+def main(config: BenchmarkConfig, repeat = 3, tolerance = 0.5, save = False, path_to_baselines = PATH_TO_BASELINES) -> int:
+    """
+    RETURNS:
+    ---
+        The exit code: 1 if some stage regressed, 0 otherwise
+    """
+    print(f"Configuration {config.key}")
+    results = run_benchmarks(config, repeat)
+    baseline = load_baselines(path_to_baselines).get(config.key, dict()).get("seconds", dict())
+    regressions = find_regressions(results, baseline, tolerance)
+    print(format_results(results, baseline, regressions))
+    if save:
+        save_baseline(config, results, path_to_baselines)
+        print(f"Saved the baseline of {config.key} to {path_to_baselines}")
+        return 0
+    if len(baseline) == 0:
+        print("No baseline for this configuration, run with --save-baseline to save one")
+    return 1 if len(regressions) > 0 else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--preset", choices = sorted(PRESETS.keys()), default = "small",
+        help = "small: 1k points and 10 scenes, medium: 100k and 100, large: 1M and 1,000")
+    parser.add_argument("--points", type = int, help = "number of synthetic building points, instead of the preset's")
+    parser.add_argument("--scenes", type = int, help = "number of synthetic scenes, instead of the preset's")
+    parser.add_argument("--scene-size", type = int, help = "width and height of the scenes, in pixels")
+    parser.add_argument("--extract-points", type = int, help = "number of points the extract stage crops patches for")
+    parser.add_argument("--http", action = "store_true", help = "serve the scenes from a local HTTP server")
+    parser.add_argument("--repeat", type = int, default = 3, help = "number of times every stage is timed")
+    parser.add_argument("--tolerance", type = float, default = 0.5, help = "how much slower than the baseline a stage may be, 0.5 for 50%%")
+    parser.add_argument("--save-baseline", action = "store_true", help = "save the results as the baseline of this configuration")
+    args = parser.parse_args()
+    config = PRESETS[args.preset]._replace(source = "http" if args.http else "local")
+    for field in ["points", "scenes", "scene_size", "extract_points"]:
+        if getattr(args, field) is not None:
+            config = config._replace(**{field: getattr(args, field)})
+    sys.exit(main(config, args.repeat, args.tolerance, args.save_baseline))
@@ -0,0 +1,103 @@
+"""
+Benchmark of trim_gdf and add_country_names: the old row-by-row versions
+against the spatial joins, on the bundled Irma damage assessments
+
+USAGE:
+---
+    python -m src.benchmarks.bench_vector_data [--scale 20] [--scenes 200]
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry.point import Point
+import country_bounding_boxes as cbb
+from rasterio.coords import BoundingBox
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.vector_data_utils import (
+    find_all_files_with_extension_in_dir,
+    exist_link_containing_point,
+    find_countries_for_point,
+    make_footprints_gdf,
+    add_imagery_columns,
+    add_country_names,
+)
+
+def load_damage_assessment_points(scale = 1, jitter = 0.01, seed = 0) -> gpd.GeoDataFrame:
+    """
+    All the buildings of the bundled damage assessments (polygons are replaced
+    by a point inside them), repeated scale times with some random jitter (in degrees)
+    """
+    files = find_all_files_with_extension_in_dir(PATH_TO_DAMAGE_ASSESSMENTS, ".geojson", [])
+    geometries = pd.concat([gpd.read_file(path).geometry for path in sorted(files)])
+    points = geometries.representative_point()
+    xs = np.tile(points.x.to_numpy(), scale)
+    ys = np.tile(points.y.to_numpy(), scale)
+    rng = np.random.default_rng(seed)
+    xs[len(points):] += rng.uniform(-jitter, jitter, len(xs) - len(points))
+    ys[len(points):] += rng.uniform(-jitter, jitter, len(ys) - len(points))
+    return gpd.GeoDataFrame(geometry = gpd.points_from_xy(xs, ys), crs = "EPSG:4326")
+
+def make_synthetic_bounds(gdf: gpd.GeoDataFrame, n_scenes, size = 0.1, seed = 0) -> dict:
+    """
+    n_scenes random square footprints per phase around the points of gdf
+    """
+    (left, bottom, right, top) = gdf.total_bounds
+    rng = np.random.default_rng(seed)
+    bounds_dict = dict()
+    for phase in ["pre", "post"]:
+        xs = rng.uniform(left - size, right, n_scenes)
+        ys = rng.uniform(bottom - size, top, n_scenes)
+        bounds_dict[phase] = [BoundingBox(x, y, x + size, y + size) for (x, y) in zip(xs, ys)]
+    return bounds_dict
+
+def trim_row_by_row(gdf: gpd.GeoDataFrame, bounds_dict: dict):
+    for phase in ["post", "pre"]:
+        gdf[f"exist_{phase}_event_imagery"] = gdf.geometry.apply(
+            lambda point: exist_link_containing_point(point, bounds_dict[phase])
+        )
+    return gdf
+
+def add_country_names_row_by_row(gdf: gpd.GeoDataFrame):
+    gdf["country"] = gdf.geometry.apply(lambda point: find_countries_for_point(point))
+    countries = {}
+    for p in gdf.geometry.tolist():
+        for c in cbb.country_subunits_containing_point(p.x, p.y):
+            countries[c.name] = countries.get(c.name, 0) + 1
+    return countries
+
+def timeit(f, *args) -> tuple:
+    start = time.perf_counter()
+    res = f(*args)
+    return (time.perf_counter() - start, res)
+
+def main(scale = 20, n_scenes = 200):
+    gdf = load_damage_assessment_points(scale)
+    bounds_dict = make_synthetic_bounds(gdf, n_scenes)
+    print(f"{len(gdf)} points, {n_scenes} scenes per phase")
+
+    (t_old, old) = timeit(trim_row_by_row, gdf.copy(), bounds_dict)
+    (t_new, new) = timeit(
+        lambda g: add_imagery_columns(g, make_footprints_gdf(bounds_dict, g.crs)), gdf.copy()
+    )
+    for phase in ["pre", "post"]:
+        column = f"exist_{phase}_event_imagery"
+        assert old[column].tolist() == new[column].tolist(), f"{column} differs"
+    print(f"trim:          row by row {t_old:8.3f}s   sjoin {t_new:8.3f}s   speedup {t_old / t_new:6.1f}x")
+
+    (t_old, old) = timeit(lambda g: (g, add_country_names_row_by_row(g)), gdf.copy())
+    (t_new, new) = timeit(lambda g: (g, add_country_names(g, "irma", False)), gdf.copy())
+    assert old[0]["country"].tolist() == new[0]["country"].tolist(), "country names differ"
+    print(f"country names: row by row {t_old:8.3f}s   sjoin {t_new:8.3f}s   speedup {t_old / t_new:6.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type = int, default = 20, help = "how many (jittered) copies of the buildings to use")
+    parser.add_argument("--scenes", type = int, default = 200, help = "number of synthetic scenes per phase")
+    args = parser.parse_args()
+    main(args.scale, args.scenes)
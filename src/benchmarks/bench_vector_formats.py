@@ -0,0 +1,80 @@
+"""
+Benchmark of the processed vector data formats: loading GeoJSON against
+GeoParquet, in full and with column projection and filters
+
+USAGE:
+---
+    python -m src.benchmarks.bench_vector_formats [--scale 20] [--repeat 3]
+"""
+import argparse
+import tempfile
+import time
+from unittest import mock
+import numpy as np
+import geopandas as gpd
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+import data_loading.vector_data_utils as vector_data_utils
+from data_loading.vector_data_utils import add_country_names, save_vector_data, load_vector_data, get_vector_data_path
+from benchmarks.bench_vector_data import load_damage_assessment_points
+
+def make_processed_vector_data(scale = 20, seed = 0) -> gpd.GeoDataFrame:
+    """
+    Something that looks like the output of combine_all_vector_data_and_save_for_hurricane,
+    built from the bundled damage assessments
+    """
+    gdf = load_damage_assessment_points(scale, seed = seed)
+    rng = np.random.default_rng(seed)
+    gdf.insert(0, "source", "benchmark")
+    gdf.insert(1, "damage", rng.choice(["Affected", "Minor", "Major", "Destroyed"], len(gdf)))
+    gdf["exist_post_event_imagery"] = rng.random(len(gdf)) < 0.8
+    gdf["exist_pre_event_imagery"] = rng.random(len(gdf)) < 0.5
+    add_country_names(gdf, "benchmark", False)
+    return gdf
+
+def best_time(f, repeat) -> tuple:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = f()
+        times.append(time.perf_counter() - start)
+    return (min(times), res)
+
+def main(scale = 20, repeat = 3):
+    gdf = make_processed_vector_data(scale)
+    columns = ["damage"]
+    filters = [("exist_pre_event_imagery", "==", True), ("country", "==", "Anguilla")]
+    # Write to a temporary directory rather than data/processed
+    with tempfile.TemporaryDirectory() as tmpdir, mock.patch.multiple(
+        vector_data_utils,
+        PATH_TO_VECTOR_DATA = os.path.join(tmpdir, "vector-data"),
+        PATH_TO_GEOJSONS = os.path.join(tmpdir, "geojsons"),
+    ):
+        parquet_path = save_vector_data(gdf, "benchmark", False, export_geojson = True)
+        geojson_path = get_vector_data_path("benchmark", ".geojson")
+        print(f"{len(gdf)} rows")
+        print(f"size:    geojson {os.path.getsize(geojson_path) / 2**20:8.2f}MB   parquet {os.path.getsize(parquet_path) / 2**20:8.2f}MB")
+
+        (t_geojson, from_geojson) = best_time(lambda: gpd.read_file(geojson_path), repeat)
+        (t_parquet, from_parquet) = best_time(lambda: load_vector_data("benchmark"), repeat)
+        assert len(from_geojson) == len(from_parquet) == len(gdf)
+        print(f"load:    geojson {t_geojson:8.3f}s   parquet {t_parquet:8.3f}s   speedup {t_geojson / t_parquet:6.1f}x")
+
+        def filter_geojson():
+            res = gpd.read_file(geojson_path)
+            mask = res.exist_pre_event_imagery & (res.country == "Anguilla")
+            return res.loc[mask, columns + ["geometry"]]
+        (t_geojson, from_geojson) = best_time(filter_geojson, repeat)
+        (t_parquet, from_parquet) = best_time(lambda: load_vector_data("benchmark", columns, filters), repeat)
+        assert from_geojson["damage"].tolist() == from_parquet["damage"].tolist()
+        print(f"filter:  geojson {t_geojson:8.3f}s   parquet {t_parquet:8.3f}s   speedup {t_geojson / t_parquet:6.1f}x   ({len(from_parquet)} rows)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type = int, default = 20, help = "how many (jittered) copies of the buildings to use")
+    parser.add_argument("--repeat", type = int, default = 3, help = "number of times each load is timed (the best is kept)")
+    args = parser.parse_args()
+    main(args.scale, args.repeat)
@@ -0,0 +1,120 @@
+"""
+Synthetic scenes and building points laid out like the real data, so that the
+data pipeline can be benchmarked (and tested) offline at any scale:
+    root/{pre,post}-event/<date>/<name>/<name>.tif, as in the DigitalGlobe links
+    root/vector-data/*.geojson, as in the extracted vector data zips
+"""
+import numpy as np
+import geopandas as gpd
+import rasterio as rio
+from rasterio.transform import from_bounds
+
+# Others
+from typing import List, NamedTuple
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+
+# Around the Virgin Islands, Anguilla and Saint Martin, where Irma made landfall
+SYNTHETIC_AREA = (-65.0, 17.6, -62.8, 18.6)
+SYNTHETIC_PRE_DATES = ["2017-01-12", "2017-05-20", "2017-07-28", "2017-09-02"]
+SYNTHETIC_POST_DATES = ["2017-09-07", "2017-09-10", "2017-09-12", "2017-09-20"]
+SYNTHETIC_LABELS = ["Flooded / Damaged Building", "Flooded / Blocked Road", "Blocked Bridge"]
+SYNTHETIC_LEVELS = ["Affected", "Minor", "Major", "Destroyed"]
+
+class SyntheticHurricane(NamedTuple):
+    """
+    root: the directory everything is written to
+    scene_paths: the path of every scene, pre event scenes first
+    bounds: the (left, bottom, right, top) of every scene
+    counts: the number of bands of every scene (the ones with fewer than 3 are tidied away)
+    vector_files: the paths of the geojson files
+    xs, ys: the coordinates of all the points, in the order of the files
+    """
+    root: str
+    scene_paths: List
+    bounds: List
+    counts: List
+    vector_files: List
+    xs: np.ndarray
+    ys: np.ndarray
+
+def write_synthetic_scene(path, bounds, count = 3, size = 256, nodata = None, seed = 0):
+    """
+    Writes a tiled GeoTIFF (EPSG:4326) of smooth random-looking pixels covering bounds.
+    With nodata, the left quarter of the scene is nodata, like the black edges of real scenes
+    """
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(1, 255, size = (count, size // 16 + 1, size // 16 + 1))
+    data = np.repeat(np.repeat(coarse, 16, axis = 1), 16, axis = 2)[:, :size, :size]
+    data = (data + rng.integers(0, 8, size = data.shape)).clip(1, 255).astype("uint8")
+    if nodata is not None:
+        data[:, :, :size // 4] = nodata
+    with rio.open(
+        path, "w", driver = "GTiff", width = size, height = size, count = count, dtype = "uint8",
+        nodata = nodata, crs = "EPSG:4326", transform = from_bounds(*bounds, size, size),
+        tiled = True, blockxsize = min(size, 256), blockysize = min(size, 256),
+    ) as dst:
+        dst.write(data)
+    return path
+
+def make_synthetic_hurricane(root, points = 1000, scenes = 10, scene_size = 256, scene_width = 0.01, files = 4, seed = 0) -> SyntheticHurricane:
+    """
+    Writes scenes synthetic scenes (half pre event, half post event) and points
+    building points spread over SYNTHETIC_AREA
+
+    PARAMETERS:
+    ---
+        scene_size: width and height of the scenes, in pixels
+        scene_width: width and height of the scenes, in degrees
+        files: number of geojson files the points are split into; the last one holds
+            official damage assessments (a "LEVEL_" column), the others crowdsourced
+            points (a "label" column)
+
+    Every tenth scene has a single band, every fourth one has nodata edges, and
+    4 points in 5 fall inside some scene (all scenes of a phase overlap a little)
+    """
+    rng = np.random.default_rng(seed)
+    (left, bottom, right, top) = SYNTHETIC_AREA
+    # The scenes come in overlapping pre/post groups, like the real ones
+    lefts = rng.uniform(left, right - 2 * scene_width, scenes)
+    bottoms = rng.uniform(bottom, top - 2 * scene_width, scenes)
+    n_pre = (scenes + 1) // 2
+    lefts[n_pre:] = lefts[:scenes - n_pre] + rng.uniform(0, scene_width / 2, scenes - n_pre)
+    bottoms[n_pre:] = bottoms[:scenes - n_pre] + rng.uniform(0, scene_width / 2, scenes - n_pre)
+    (scene_paths, bounds, counts) = ([], [], [])
+    for i in range(scenes):
+        (phase, dates) = ("pre", SYNTHETIC_PRE_DATES) if i < n_pre else ("post", SYNTHETIC_POST_DATES)
+        name = f"{phase}{i:05d}"
+        path = os.path.join(root, f"{phase}-event", dates[i % len(dates)], name, name + ".tif")
+        b = (lefts[i], bottoms[i], lefts[i] + scene_width, bottoms[i] + scene_width)
+        count = 1 if i % 10 == 9 else 3
+        write_synthetic_scene(path, b, count, scene_size, 0 if i % 4 == 3 else None, seed + i)
+        scene_paths.append(path)
+        bounds.append(b)
+        counts.append(count)
+
+    inside = rng.random(points) < 0.8
+    owners = rng.integers(0, scenes, points)
+    xs = rng.uniform(left, right, points)
+    ys = rng.uniform(bottom, top, points)
+    xs[inside] = lefts[owners[inside]] + rng.uniform(0.02, 0.98, inside.sum()) * scene_width
+    ys[inside] = bottoms[owners[inside]] + rng.uniform(0.02, 0.98, inside.sum()) * scene_width
+
+    vector_files = []
+    parts = np.array_split(np.arange(points), files)
+    for (k, part) in enumerate(parts):
+        official = k == len(parts) - 1 and len(parts) > 1
+        if official:
+            (filename, column) = ("damage-assessment.geojson", {"LEVEL_": rng.choice(SYNTHETIC_LEVELS, len(part))})
+        else:
+            labels = rng.choice(SYNTHETIC_LABELS, len(part), p = [0.8, 0.15, 0.05])
+            (filename, column) = (f"crowdsourced-{k}.geojson", {"label": labels})
+        path = os.path.join(root, "vector-data", filename)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        gdf = gpd.GeoDataFrame(column, geometry = gpd.points_from_xy(xs[part], ys[part]), crs = VECTOR_DATA_CRS)
+        gdf.to_file(path, driver = "GeoJSON")
+        vector_files.append(path)
+    return SyntheticHurricane(root, scene_paths, bounds, counts, vector_files, xs, ys)
@@ -0,0 +1,207 @@
+"""
+The command line interface of the data pipeline, one subcommand per step:
+
+    python -m src tidy irma               keep the scenes with at least 3 bands
+    python -m src ingest-vectors irma     combine the vector data into one GeoParquet file
+    python -m src trim irma               keep the buildings with imagery, add their countries
+    python -m src extract-patches irma    crop the patches around every building
+    python -m src stats irma              what has been done so far
+    python -m src band-stats irma         per band statistics of the patches, for normalization
+    python -m src serve irma              crop the patches around any point on demand, over HTTP
+
+The modules a subcommand needs (rasterio, geopandas, ...) are only imported
+once it runs, so that the command line starts quickly.
+Run python -m src <subcommand> --help for the options of each one
+"""
+import argparse
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from data_loading.utils import *
+from data_loading.patch_codec_utils import PATCH_CODECS, PATCH_LAYOUTS
+
+def run_tidy(args):
+    from data_loading.tif_links_utils import get_raw_tif_links, tidy_up_tif_links
+    if args.file_list is None:
+        links = get_raw_tif_links(args.hurricane_name, args.toprint)
+    else:
+        with open(args.file_list) as f:
+            links = [line.strip() for line in f if ".tif" in line]
+    tidy_up_tif_links(links, args.hurricane_name, args.toprint, args.overwrite, args.max_workers)
+
+def run_ingest_vectors(args):
+    from data_loading.vector_data_utils import combine_all_vector_data
+    combine_all_vector_data(args.hurricane_name, args.toprint, args.overwrite, args.max_workers, args.batch_size, args.export_geojson)
+
+def run_trim(args):
+    from data_loading.vector_data_utils import combine_all_vector_data_and_save_for_hurricane
+    combine_all_vector_data_and_save_for_hurricane(
+        hurricane_name = args.hurricane_name, toprint = args.toprint, overwrite = args.overwrite,
+        max_workers = args.max_workers, batch_size = args.batch_size, export_geojson = args.export_geojson,
+        metrics = args.metrics, max_distance = args.max_distance,
+    )
+
+def run_extract_patches(args):
+    from data_loading.patch_utils import main
+    main(
+        hurricane_name = args.hurricane_name, toprint = args.toprint, dist = args.dist, workers = args.workers,
+        output = args.output, dry_run = args.dry_run, max_nodata = args.max_nodata, boundless = args.boundless,
+        scenes = args.scenes, k = args.k, metrics = args.metrics, io_stats = args.io_stats, band_stats = args.band_stats,
+        codec = args.codec, level = args.level, layout = args.layout, encode_threads = args.encode_threads,
+    )
+
+def get_stats(hurricane_name) -> dict:
+    """
+    What has been done so far for the hurricane, from the files in data/processed
+    (nothing is downloaded)
+
+    RETURNS:
+    ---
+        A dictionary with, for every step that has been run:
+            links: the number of tidied links per phase
+            combined: the number of rows of the combined vector data
+            buildings: the number of buildings kept, and countries: how many per country
+            patches: from the manifest, the number of patch jobs per phase and status
+            stores: the number of patches in the array store of every phase
+    """
+    from data_loading.vector_data_utils import get_vector_data_path, load_vector_data
+    from data_loading.manifest_utils import PatchManifest, MANIFEST_FILENAME
+    from data_loading.patch_store_utils import get_patch_store_paths
+    import pyarrow.parquet as pq
+    res = dict()
+    path = os.path.join(PATH_TO_TIDIED_FILELISTS, hurricane_name)
+    if os.path.isfile(path):
+        with open(path) as f:
+            phases = [get_phase_from_link(line) for line in f if ".tif" in line]
+        res["links"] = {phase: phases.count(phase) for phase in ["pre", "post"]}
+    path = get_vector_data_path(hurricane_name + "-combined")
+    if os.path.isfile(path):
+        res["combined"] = pq.ParquetFile(path).metadata.num_rows
+    if os.path.isfile(get_vector_data_path(hurricane_name)):
+        countries = load_vector_data(hurricane_name, ["country"])["country"]
+        res["buildings"] = len(countries)
+        res["countries"] = {name: int(count) for (name, count) in countries.value_counts().items()}
+    path_to_hurricane_patches = os.path.join(PATH_TO_PATCHES, hurricane_name)
+    path = os.path.join(path_to_hurricane_patches, MANIFEST_FILENAME)
+    if os.path.isfile(path):
+        res["patches"] = PatchManifest(path).summary()
+    for phase in ["pre", "post"]:
+        (npy_path, _) = get_patch_store_paths(os.path.join(path_to_hurricane_patches, phase))
+        if os.path.isfile(npy_path):
+            res.setdefault("stores", dict())[phase] = int(np.load(npy_path, mmap_mode = "r").shape[0])
+    return res
+
+def format_stats(hurricane_name, stats: dict) -> str:
+    lines = [f"Hurricane {hurricane_name}:"]
+    if "links" in stats:
+        lines.append(f"  tidied links: {stats['links']['pre']} pre event, {stats['links']['post']} post event")
+    if "combined" in stats:
+        lines.append(f"  combined vector data: {stats['combined']} rows")
+    if "buildings" in stats:
+        lines.append(f"  buildings with imagery: {stats['buildings']}")
+        for (name, count) in stats["countries"].items():
+            lines.append(f"    {name}: {count}")
+    for (phase, counts) in sorted(stats.get("patches", dict()).items()):
+        lines.append(f"  {phase} event patches: " + ", ".join(f"{count} {status}" for (status, count) in sorted(counts.items())))
+    for (phase, count) in stats.get("stores", dict()).items():
+        lines.append(f"  {phase} event array store: {count} patches")
+    if len(lines) == 1:
+        lines.append("  nothing has been processed yet")
+    return "\n".join(lines)
+
+def run_stats(args):
+    print(format_stats(args.hurricane_name, get_stats(args.hurricane_name)))
+
+def run_band_stats(args):
+    from data_loading.band_stats_utils import compute_band_stats_for_directory, save_band_stats, group_band_stats, format_band_stats
+    path_to_hurricane_patches = os.path.join(PATH_TO_PATCHES, args.hurricane_name)
+    stats = compute_band_stats_for_directory(path_to_hurricane_patches, args.output, args.workers, args.toprint)
+    path = save_band_stats(path_to_hurricane_patches, stats)
+    print_message(args.toprint, f"Saved the band statistics to {path}")
+    print(format_band_stats(group_band_stats(stats, args.by)))
+
+def run_serve(args):
+    from data_loading.patch_service_utils import serve_patches
+    serve_patches(args.hurricane_name, args.toprint, args.host, args.port, args.max_nodata, args.boundless, args.max_queries)
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog = "python -m src", description = "Prepare the data to predict the damage to buildings")
+    subparsers = parser.add_subparsers(dest = "command", required = True, metavar = "command")
+    common = argparse.ArgumentParser(add_help = False)
+    common.add_argument("hurricane_name", nargs = "?", default = DEFAULT_HURRICANE, type = lambda name: name.strip().lower(),
+        help = f"name of the hurricane, e.g. irma or test (default {DEFAULT_HURRICANE})")
+    common.add_argument("--quiet", dest = "toprint", action = "store_false", help = "do not print progress")
+    vectors = argparse.ArgumentParser(add_help = False)
+    vectors.add_argument("--overwrite", action = "store_true", help = "process the vector data again even if it has been saved")
+    vectors.add_argument("--max-workers", type = int, default = VECTOR_DATA_MAX_WORKERS, help = "number of files read at the same time")
+    vectors.add_argument("--batch-size", type = int, help = "read the files this many rows at a time")
+    vectors.add_argument("--export-geojson", action = "store_true", help = "also save the result in data/processed/geojsons")
+    remote = argparse.ArgumentParser(add_help = False)
+    remote.add_argument("--no-cache", action = "store_true", help = "do not keep the bytes read from remote images in data/cache")
+    metrics = argparse.ArgumentParser(add_help = False)
+    metrics.add_argument("--metrics", help = "file to write the timings and counters of the run to: JSON lines, or the Prometheus text format if it ends in .prom")
+
+    tidy = subparsers.add_parser("tidy", parents = [common, remote], help = "keep the scenes with at least 3 bands")
+    tidy.add_argument("--file-list", help = "a local file of links to tidy, instead of the file list on github")
+    tidy.add_argument("--overwrite", action = "store_true", help = "tidy the links again even if they have been")
+    tidy.add_argument("--max-workers", type = int, default = PROBE_MAX_WORKERS, help = "number of links probed at the same time")
+    tidy.set_defaults(func = run_tidy)
+
+    ingest = subparsers.add_parser("ingest-vectors", parents = [common, vectors], help = "combine the vector data into one GeoParquet file")
+    ingest.set_defaults(func = run_ingest_vectors)
+
+    trim = subparsers.add_parser("trim", parents = [common, vectors, remote, metrics], help = "keep the buildings with imagery and add their countries")
+    trim.add_argument("--max-distance", type = float, default = DAMAGE_ASSESSMENT_MAX_DISTANCE,
+        help = "give every building the grade of the nearest official damage assessment at most this many meters away")
+    trim.set_defaults(func = run_trim)
+
+    extract = subparsers.add_parser("extract-patches", parents = [common, remote, metrics], help = "crop pre and post event patches around every building")
+    extract.add_argument("--dist", type = float, default = 20, help = "distance in meters from the building to each edge of the patch")
+    extract.add_argument("--workers", type = int, default = 1, help = "number of worker processes")
+    extract.add_argument("--output", choices = ["gtiff", "npy"], default = "gtiff", help = "one GeoTIFF per patch, or one array store per phase")
+    extract.add_argument("--dry-run", action = "store_true", help = "only report how many patches are outstanding")
+    extract.add_argument("--max-nodata", type = float, default = PATCH_MAX_NODATA, help = "skip the patches with a larger fraction of nodata pixels")
+    extract.add_argument("--boundless", choices = ["clip", "pad", "skip"], default = "clip", help = "what to do with the patches partly outside their image")
+    extract.add_argument("--scenes", default = "all", help = "which of the images containing a building to crop it from: all, closest or coverage (see scene_selection_utils.SCENE_POLICIES)")
+    extract.add_argument("--k", type = int, default = 1, help = "number of images per building and phase kept by --scenes")
+    extract.add_argument("--io-stats", action = "store_true", help = "also count the datasets GDAL opens and the HTTP requests it sends")
+    extract.add_argument("--band-stats", action = "store_true", help = "also compute the statistics of every band of the patches, saved in band-stats.json")
+    extract.add_argument("--codec", choices = PATCH_CODECS, default = "none", help = "how to compress the GeoTIFFs (losslessly)")
+    extract.add_argument("--level", type = int, help = "compression level of deflate (1-9) or zstd (1-22)")
+    extract.add_argument("--layout", choices = PATCH_LAYOUTS, help = "how to lay out the pixels of the GeoTIFFs (default tiles if compressed, strips otherwise)")
+    extract.add_argument("--encode-threads", type = int, default = PATCH_ENCODE_THREADS, help = "number of threads compressing and writing the GeoTIFFs of every process")
+    extract.set_defaults(func = run_extract_patches)
+
+    stats = subparsers.add_parser("stats", parents = [common], help = "show what has been done so far")
+    stats.set_defaults(func = run_stats)
+
+    band_stats = subparsers.add_parser("band-stats", parents = [common], help = "compute the statistics of every band of the patches already cropped")
+    band_stats.add_argument("--output", choices = ["gtiff", "npy"], default = "gtiff", help = "the patches are GeoTIFFs, or array stores")
+    band_stats.add_argument("--workers", type = int, default = 1, help = "number of worker processes")
+    band_stats.add_argument("--by", choices = ["phase", "sensor", "scene"], default = "phase", help = "how to group the statistics printed")
+    band_stats.set_defaults(func = run_band_stats)
+
+    serve = subparsers.add_parser("serve", parents = [common, remote], help = "crop the patches around any point on demand, over HTTP")
+    serve.add_argument("--host", default = "127.0.0.1", help = "address to listen on")
+    serve.add_argument("--port", type = int, default = PATCH_SERVICE_PORT, help = "port to listen on, 0 for any free port")
+    serve.add_argument("--max-nodata", type = float, default = PATCH_MAX_NODATA, help = "skip the patches with a larger fraction of nodata pixels")
+    serve.add_argument("--boundless", choices = ["clip", "pad", "skip"], default = "clip", help = "what to do with the patches partly outside their image")
+    serve.add_argument("--max-queries", type = int, default = PATCH_SERVICE_MAX_QUERIES, help = "number of queries whose patches are kept in memory")
+    serve.set_defaults(func = run_serve)
+    return parser
+
+def main(argv = None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command == "extract-patches":
+        from data_loading.scene_selection_utils import SCENE_POLICIES, SINGLE_PHASE_POLICIES
+        choices = [name for name in SCENE_POLICIES if name not in SINGLE_PHASE_POLICIES]
+        if args.scenes not in choices:
+            parser.error(f"argument --scenes: invalid choice: {args.scenes} (choose from {', '.join(choices)})")
+    if getattr(args, "no_cache", False):
+        from data_loading.range_cache_utils import set_range_cache
+        set_range_cache(None)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
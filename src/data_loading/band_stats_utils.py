@@ -0,0 +1,444 @@
+# Handle tif files
+import rasterio as rio
+import numpy as np
+
+# Computing the statistics of many files in parallel
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import json
+
+# Others
+from typing import List, Optional
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.patch_store_utils import get_patch_store_paths, load_patch_store_index
+
+# Bump this whenever what is saved in BAND_STATS_FILENAME changes, the statistics are then computed again
+BAND_STATS_VERSION = 1
+# Files read by every task of compute_band_stats_for_files
+BAND_STATS_FILES_PER_TASK = 256
+# Patches of an array store read at a time
+BAND_STATS_STORE_CHUNK = 1024
+
+def get_histogram_range(dtype) -> tuple:
+    """
+    The (low, high) values covered by the histograms of data of type dtype:
+    every value of integer types (one bin per value for 8 bits), and 0 to 1
+    for floating point types (values outside go to the first or last bin)
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return (float(info.min), float(info.max) + 1)
+    return (0.0, 1.0)
+
+def get_valid_pixels(data: np.ndarray, nodata = None) -> np.ndarray:
+    """
+    RETURNS:
+    ---
+        A (height, width) boolean array, False where a (bands, height, width) patch
+        is nodata: every band is nodata (the same as the mask GDAL derives from a
+        nodata value), or some band is nan
+    """
+    valid = np.ones(data.shape[1:], dtype = bool)
+    if nodata is not None:
+        valid &= (data != nodata).any(axis = 0)
+    if np.issubdtype(data.dtype, np.floating):
+        valid &= ~np.isnan(data).any(axis = 0)
+    return valid
+
+class BandStats:
+    """
+    Single-pass statistics of every band of a stream of patches: the number of
+    valid pixels, their mean and variance (Welford's online algorithm, one batch
+    per patch) and a histogram over fixed bins (see get_histogram_range)
+
+    Two BandStats are merged exactly (Chan et al.), so that workers can each
+    compute the statistics of their share of the patches. Patches with more
+    bands than seen so far add bands; the pixels a band is missing from are not counted
+    """
+    def __init__(self, bins = BAND_STATS_BINS, value_range = None):
+        """
+        PARAMETERS:
+        ---
+            bins: number of histogram bins per band
+            value_range: the (low, high) values covered by the histograms,
+                by default from the dtype of the first patch
+        """
+        self.bins = bins
+        self.value_range = None if value_range is None else tuple(float(v) for v in value_range)
+        self.count = np.zeros(0, dtype = np.int64)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.min = np.zeros(0)
+        self.max = np.zeros(0)
+        self.histogram = np.zeros((0, bins), dtype = np.int64)
+
+    @property
+    def bands(self) -> int:
+        return len(self.count)
+
+    @property
+    def variance(self) -> np.ndarray:
+        return np.where(self.count > 0, self.m2 / np.maximum(self.count, 1), np.nan)
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.variance)
+
+    def _grow(self, bands):
+        extra = bands - self.bands
+        if extra <= 0:
+            return
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype = np.int64)])
+        self.mean = np.concatenate([self.mean, np.zeros(extra)])
+        self.m2 = np.concatenate([self.m2, np.zeros(extra)])
+        self.min = np.concatenate([self.min, np.full(extra, np.inf)])
+        self.max = np.concatenate([self.max, np.full(extra, -np.inf)])
+        self.histogram = np.concatenate([self.histogram, np.zeros((extra, self.bins), dtype = np.int64)])
+
+    def _combine(self, count, mean, m2, low, high, histogram):
+        # Chan et al.'s pairwise update, band by band
+        self._grow(len(count))
+        bands = len(count)
+        total = self.count[:bands] + count
+        delta = mean - self.mean[:bands]
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            self.mean[:bands] = np.where(total > 0, self.mean[:bands] + delta * count / np.maximum(total, 1), 0.0)
+            self.m2[:bands] += m2 + delta ** 2 * self.count[:bands] * count / np.maximum(total, 1)
+        self.count[:bands] = total
+        self.min[:bands] = np.minimum(self.min[:bands], low)
+        self.max[:bands] = np.maximum(self.max[:bands], high)
+        self.histogram[:bands] += histogram
+
+    def update(self, data: np.ndarray, nodata = None, valid: np.ndarray = None):
+        """
+        Adds the valid pixels of a (bands, height, width) patch
+
+        PARAMETERS:
+        ---
+            nodata: the nodata value of the scene the patch was cut out of, if any
+            valid: the (height, width) mask of the valid pixels, by default from
+                nodata (see get_valid_pixels)
+        """
+        if self.value_range is None:
+            self.value_range = get_histogram_range(data.dtype)
+        if valid is None:
+            valid = get_valid_pixels(data, nodata)
+        values = data[:, valid].astype(np.float64)
+        bands = values.shape[0]
+        n = values.shape[1]
+        if n == 0:
+            self._grow(bands)
+            return
+        mean = values.mean(axis = 1)
+        m2 = ((values - mean[:, None]) ** 2).sum(axis = 1)
+        (low, high) = self.value_range
+        idx = np.clip(((values - low) * (self.bins / (high - low))).astype(np.int64), 0, self.bins - 1)
+        idx += np.arange(bands)[:, None] * self.bins
+        histogram = np.bincount(idx.ravel(), minlength = bands * self.bins).reshape(bands, self.bins)
+        self._combine(np.full(bands, n, dtype = np.int64), mean, m2, values.min(axis = 1), values.max(axis = 1), histogram)
+
+    def merge(self, other: "BandStats") -> "BandStats":
+        """
+        Adds the statistics of other to these ones (they must have the same bins)
+
+        RETURNS:
+        ---
+            self
+        """
+        if other.bands == 0:
+            return self
+        if self.value_range is None and self.bands == 0:
+            (self.bins, self.value_range) = (other.bins, other.value_range)
+            self.histogram = np.zeros((0, self.bins), dtype = np.int64)
+        if other.bins != self.bins or (other.value_range is not None and other.value_range != self.value_range):
+            raise ValueError(f"Cannot merge histograms of {other.bins} bins over {other.value_range} "
+                f"into histograms of {self.bins} bins over {self.value_range}")
+        self._combine(other.count, other.mean, other.m2, other.min, other.max, other.histogram)
+        return self
+
+    def quantiles(self, q) -> np.ndarray:
+        """
+        The quantiles q (between 0 and 1) of every band, from the histograms:
+        exact for 8 bit data, otherwise the lower edge of the bin they fall in
+
+        RETURNS:
+        ---
+            A (bands, len(q)) array, nan for the bands without any valid pixel
+        """
+        q = np.atleast_1d(np.asarray(q, dtype = float))
+        res = np.full((self.bands, len(q)), np.nan)
+        if self.value_range is None:
+            return res
+        (low, high) = self.value_range
+        for band in range(self.bands):
+            if self.count[band] == 0:
+                continue
+            cdf = np.cumsum(self.histogram[band]) / self.count[band]
+            idx = np.minimum(np.searchsorted(cdf, q, side = "left"), self.bins - 1)
+            res[band] = low + idx * (high - low) / self.bins
+        return res
+
+    def to_dict(self) -> dict:
+        return {
+            "bins": self.bins,
+            "value_range": None if self.value_range is None else list(self.value_range),
+            "count": self.count.tolist(),
+            "mean": self.mean.tolist(),
+            "m2": self.m2.tolist(),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+            "histogram": self.histogram.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "BandStats":
+        res = cls(d["bins"], d["value_range"])
+        res.count = np.asarray(d["count"], dtype = np.int64)
+        for name in ["mean", "m2", "min", "max"]:
+            setattr(res, name, np.asarray(d[name], dtype = float))
+        res.histogram = np.asarray(d["histogram"], dtype = np.int64).reshape(len(res.count), res.bins)
+        return res
+
+def merge_band_stats(stats: dict, other: dict) -> dict:
+    """
+    Merges other into stats, both dictionaries from (phase, link) to BandStats
+
+    RETURNS:
+    ---
+        stats
+    """
+    for (key, value) in other.items():
+        stats.setdefault(key, BandStats(value.bins, value.value_range)).merge(value)
+    return stats
+
+class BandStatsSink:
+    """
+    A sink (see extraction_utils.GTiffSink) that computes the statistics of
+    every patch it is handed, per phase and scene, before passing it on to sink.
+    The statistics of the patches written by worker processes are sent back
+    with collect and merge (see extraction_utils.extract_patches_in_parallel)
+
+    stats is a dictionary from (phase, link) to BandStats
+    """
+    def __init__(self, sink, records: List, phase):
+        """
+        PARAMETERS:
+        ---
+            sink: where the patches go, e.g. a GTiffSink or an ArraySink
+            records: a list of SceneMetadata, job.scene_idx indexes into it
+                (for the link and the nodata value of the scene of every patch)
+            phase: "pre" or "post"
+        """
+        self.sink = sink
+        self.links = [record.link for record in records]
+        self.nodata = [record.nodata for record in records]
+        self.phase = phase
+        self.stats = dict()
+
+    def __getstate__(self):
+        # Workers start from empty statistics
+        return {**self.__dict__, "stats": dict()}
+
+    def write(self, job, data: np.ndarray, transform, crs):
+        key = (self.phase, self.links[job.scene_idx])
+        self.stats.setdefault(key, BandStats()).update(data, self.nodata[job.scene_idx])
+        self.sink.write(job, data, transform, crs)
+
+    def flush(self):
+        if hasattr(self.sink, "flush"):
+            self.sink.flush()
+
+    def collect(self) -> dict:
+        """
+        RETURNS:
+        ---
+            The statistics gathered since the last call, which are then forgotten
+        """
+        (res, self.stats) = (self.stats, dict())
+        return res
+
+    def merge(self, partial: dict):
+        merge_band_stats(self.stats, partial)
+
+def _band_stats_for_files(paths: List, keys: List, nodata: List) -> dict:
+    stats = dict()
+    for (path, key, value) in zip(paths, keys, nodata):
+        with rio.open(path) as src:
+            data = src.read()
+        stats.setdefault(key, BandStats()).update(data, value)
+    return stats
+
+def compute_band_stats_for_files(paths: List, keys: List, nodata: List = None, workers = 1, toprint = True) -> dict:
+    """
+    The statistics of the patches saved as GeoTIFFs at paths, grouped by keys
+
+    PARAMETERS:
+    ---
+        keys: the (phase, link) of every patch
+        nodata: the nodata value of the scene of every patch; the patch files do not
+            have it (see extraction_utils.write_patch), by default 0 as in the DigitalGlobe scenes
+        workers: number of worker processes, every one of them reads
+            BAND_STATS_FILES_PER_TASK files at a time and sends back their statistics
+
+    RETURNS:
+    ---
+        A dictionary from (phase, link) to BandStats
+    """
+    if nodata is None:
+        nodata = [0] * len(paths)
+    tasks = [
+        (paths[start:start + BAND_STATS_FILES_PER_TASK], keys[start:start + BAND_STATS_FILES_PER_TASK], nodata[start:start + BAND_STATS_FILES_PER_TASK])
+        for start in range(0, len(paths), BAND_STATS_FILES_PER_TASK)
+    ]
+    print_message(toprint, f"Computing the band statistics of {len(paths)} patches...")
+    stats = dict()
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            merge_band_stats(stats, _band_stats_for_files(*task))
+        return stats
+    # Workers are spawned rather than forked: GDAL's state does not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers = workers, mp_context = context) as executor:
+        futures = [executor.submit(_band_stats_for_files, *task) for task in tasks]
+        for (future, idx) in zip(as_completed(futures), range(len(futures))):
+            merge_band_stats(stats, future.result())
+            print_message(toprint, f"{idx+1}/{len(futures)} tasks done", end = "\r")
+    print_message(toprint, "")
+    return stats
+
+def compute_band_stats_for_store(path_to_store, phase = None) -> dict:
+    """
+    The statistics of the patches of an array store (see patch_store_utils),
+    reading BAND_STATS_STORE_CHUNK of them at a time. The store does not keep the
+    nodata values of the scenes, so pixels that are 0 in every band (which is
+    also what the padding is) are treated as nodata. The rows of the patches
+    that were skipped (not written) are left out
+
+    RETURNS:
+    ---
+        A dictionary from (phase, link) to BandStats
+    """
+    (npy_path, _) = get_patch_store_paths(path_to_store)
+    patches = np.load(npy_path, mmap_mode = "r")
+    index = load_patch_store_index(path_to_store, ["patch_idx", "phase", "link", "count", "height", "width"], written_only = True)
+    stats = dict()
+    for start in range(0, len(patches), BAND_STATS_STORE_CHUNK):
+        chunk = np.asarray(patches[start:start + BAND_STATS_STORE_CHUNK])
+        rows = index[(index["patch_idx"] >= start) & (index["patch_idx"] < start + len(chunk))]
+        for row in rows.itertuples(index = False):
+            data = chunk[row.patch_idx - start]
+            key = (phase if phase is not None else row.phase, row.link)
+            stats.setdefault(key, BandStats()).update(data[:row.count, :row.height, :row.width], 0)
+    return stats
+
+def compute_band_stats_for_directory(path_to_hurricane_patches, output = "gtiff", workers = 1, toprint = True) -> dict:
+    """
+    The statistics of the patches saved by patch_utils.main, without running it again
+
+    PARAMETERS:
+    ---
+        path_to_hurricane_patches: e.g. data/processed/patches/<hurricane_name>
+        output: "gtiff" for the {pre,post}/{point_idx}-{i}.tif files (their scene is not
+            known from the files, so their link is None), "npy" for the {pre,post} array stores
+
+    RETURNS:
+    ---
+        A dictionary from (phase, link) to BandStats
+    """
+    stats = dict()
+    for phase in ["pre", "post"]:
+        if output == "npy":
+            if os.path.isfile(get_patch_store_paths(os.path.join(path_to_hurricane_patches, phase))[0]):
+                merge_band_stats(stats, compute_band_stats_for_store(os.path.join(path_to_hurricane_patches, phase), phase))
+        elif output == "gtiff":
+            path_to_dir = os.path.join(path_to_hurricane_patches, phase)
+            if not os.path.isdir(path_to_dir):
+                continue
+            paths = [os.path.join(path_to_dir, name) for name in sorted(os.listdir(path_to_dir)) if name.endswith(".tif")]
+            merge_band_stats(stats, compute_band_stats_for_files(paths, [(phase, None)] * len(paths), None, workers, toprint))
+        else:
+            raise ValueError(f"Unknown output format {output}")
+    return stats
+
+def get_band_stats_path(path_to_hurricane_patches) -> str:
+    return os.path.join(path_to_hurricane_patches, BAND_STATS_FILENAME)
+
+def save_band_stats(path_to_hurricane_patches, stats: dict) -> str:
+    """
+    Saves the statistics (a dictionary from (phase, link) to BandStats) next to the patches
+
+    RETURNS:
+    ---
+        The path to the file
+    """
+    path = get_band_stats_path(path_to_hurricane_patches)
+    os.makedirs(path_to_hurricane_patches, exist_ok = True)
+    scenes = [
+        {"phase": phase, "link": link, "sensor": None if link is None else get_sensor_from_link(link), "stats": value.to_dict()}
+        for ((phase, link), value) in sorted(stats.items(), key = lambda item: (item[0][0], item[0][1] or ""))
+    ]
+    with open(path, "w") as f:
+        json.dump({"version": BAND_STATS_VERSION, "scenes": scenes}, f)
+    return path
+
+def load_band_stats(path_to_hurricane_patches) -> Optional[dict]:
+    """
+    RETURNS:
+    ---
+        The statistics saved by save_band_stats, as a dictionary from (phase, link)
+        to BandStats; None if there are none (or they were saved by another version)
+    """
+    path = get_band_stats_path(path_to_hurricane_patches)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        saved = json.load(f)
+    if saved.get("version") != BAND_STATS_VERSION:
+        return None
+    return {(scene["phase"], scene["link"]): BandStats.from_dict(scene["stats"]) for scene in saved["scenes"]}
+
+def group_band_stats(stats: dict, by = "phase") -> dict:
+    """
+    Merges the statistics of the scenes into groups
+
+    PARAMETERS:
+    ---
+        stats: a dictionary from (phase, link) to BandStats
+        by: "phase" (keys "pre" and "post"), "sensor" (keys (phase, sensor), see
+            get_sensor_from_link) or "scene" (keys (phase, link), a copy of stats)
+
+    RETURNS:
+    ---
+        A dictionary from group to BandStats
+    """
+    if by not in ["phase", "sensor", "scene"]:
+        raise ValueError(f"Unknown grouping {by}")
+    res = dict()
+    for ((phase, link), value) in stats.items():
+        if by == "phase":
+            key = phase
+        elif by == "sensor":
+            key = (phase, None if link is None else get_sensor_from_link(link))
+        else:
+            key = (phase, link)
+        res.setdefault(key, BandStats(value.bins, value.value_range)).merge(value)
+    return res
+
+def format_band_stats(stats: dict) -> str:
+    """
+    A table of the mean and standard deviation of every band of every group of stats
+    (a dictionary from group to BandStats, e.g. from group_band_stats)
+    """
+    lines = [f"{'group':<24} {'band':>4} {'pixels':>12} {'mean':>9} {'std':>9} {'min':>7} {'max':>7}"]
+    for (key, value) in stats.items():
+        name = key if isinstance(key, str) else "/".join(str(k) for k in key)
+        for band in range(value.bands):
+            lines.append(
+                f"{name[-24:]:<24} {band + 1:>4} {value.count[band]:>12} {value.mean[band]:9.2f} "
+                f"{value.std[band]:9.2f} {value.min[band]:7.0f} {value.max[band]:7.0f}"
+            )
+    return "\n".join(lines)
@@ -0,0 +1,320 @@
+# Handle tif files
+import rasterio as rio
+import affine
+
+# Some useful thiings from rasterio
+from rasterio.coords import BoundingBox
+
+# On-disk catalog
+import sqlite3
+import hashlib
+import json
+from contextlib import closing
+
+# Probing links concurrently
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+
+# Others
+from typing import List, NamedTuple, Optional
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.range_cache_utils import open_scene
+
+# Bump this whenever the columns below change, the catalog is then rebuilt
+CATALOG_VERSION = 1
+
+class SceneMetadata(NamedTuple):
+    """
+    Everything we need to know about a scene without opening it
+    """
+    link: str
+    phase: Optional[str]
+    acquisition_date: Optional[str]
+    count: int
+    dtype: str
+    nodata: Optional[float]
+    crs: Optional[str]
+    transform: tuple
+    width: int
+    height: int
+    left: float
+    bottom: float
+    right: float
+    top: float
+
+    @property
+    def bounds(self) -> BoundingBox:
+        return BoundingBox(self.left, self.bottom, self.right, self.top)
+
+    @property
+    def affine(self) -> affine.Affine:
+        return affine.Affine(*self.transform)
+
+def read_scene_metadata(link: str, timeout = None) -> SceneMetadata:
+    """
+    Opens the tif file at link and reads its header, waiting at most timeout
+    seconds for every request through the range cache (see range_cache_utils.open_scene)
+    """
+    with open_scene(link, timeout) as src:
+        return SceneMetadata(
+            link = link,
+            phase = get_phase_from_link(link),
+            acquisition_date = get_acquisition_date_from_link(link),
+            count = src.count,
+            dtype = src.dtypes[0],
+            nodata = src.nodata,
+            crs = src.crs.to_wkt() if src.crs is not None else None,
+            transform = tuple(src.transform)[:6],
+            width = src.width,
+            height = src.height,
+            left = src.bounds.left,
+            bottom = src.bounds.bottom,
+            right = src.bounds.right,
+            top = src.bounds.top,
+        )
+
+class ProbeReport(NamedTuple):
+    """
+    records: a dictionary from link to SceneMetadata, for the links that could be opened
+    unreachable: a dictionary from link to the last error, for the links that could not
+    """
+    records: dict
+    unreachable: dict
+
+def probe_link(link: str, timeout = PROBE_TIMEOUT, retries = PROBE_RETRIES, backoff = PROBE_BACKOFF) -> tuple:
+    """
+    Reads the header of one link, retrying with exponential backoff if it fails
+
+    RETURNS:
+    ---
+        (SceneMetadata, None) if successful, (None, error message) otherwise
+    """
+    error = None
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            # GDAL remembers failed requests, so make sure a retry really asks again
+            with rio.Env(
+                GDAL_HTTP_TIMEOUT = timeout,
+                GDAL_HTTP_CONNECTTIMEOUT = timeout,
+                CPL_VSIL_CURL_NON_CACHED = "/vsicurl/" + link,
+                **GDAL_REMOTE_OPTIONS,
+            ):
+                return read_scene_metadata(link, timeout), None
+        except rio.errors.RasterioIOError as e:
+            error = str(e)
+    return None, error
+
+def probe_scene_metadata(links: List, toprint = True, max_workers = PROBE_MAX_WORKERS, **kwargs) -> ProbeReport:
+    """
+    Reads the headers of many links at once using a pool of max_workers threads
+    (GDAL releases the GIL while waiting on the network)
+
+    PARAMETERS:
+    ---
+        links: a list of links
+        toprint: whether or not to print progress
+        max_workers: maximum number of links probed at the same time
+        kwargs: timeout, retries, backoff, passed on to probe_link
+    """
+    records, unreachable = dict(), dict()
+    if len(links) == 0:
+        return ProbeReport(records, unreachable)
+    with ThreadPoolExecutor(max_workers = min(max_workers, len(links))) as executor:
+        futures = {executor.submit(probe_link, link, **kwargs): link for link in links}
+        for (future, idx) in zip(as_completed(futures), range(len(links))):
+            print_message(toprint, f"{idx+1}/{len(links)}", end = "\r")
+            link = futures[future]
+            (record, error) = future.result()
+            if record is not None:
+                records[link] = record
+            else:
+                unreachable[link] = error
+    return ProbeReport(records, unreachable)
+
+def get_file_list_digest(links: List) -> str:
+    return hashlib.sha256("\n".join(links).encode()).hexdigest()
+
+class SceneCatalog:
+    """
+    A SQLite catalog of scene metadata keyed by link, by default saved in
+    data/processed/scene-catalog.sqlite
+
+    It also remembers which links belong to each file list, so that a scene is
+    forgotten (and re-read next time) once no file list refers to it anymore,
+    and which links could not be opened, so that they are not probed again
+    before PROBE_UNREACHABLE_TTL seconds have passed
+    """
+    def __init__(self, path = None):
+        if path is None:
+            path = PATH_TO_SCENE_CATALOG
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+            row = conn.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+            if row is None or int(row[0]) != CATALOG_VERSION:
+                conn.execute("DROP TABLE IF EXISTS scenes")
+                conn.execute("DROP TABLE IF EXISTS file_lists")
+                conn.execute("DROP TABLE IF EXISTS file_list_links")
+                conn.execute("DROP TABLE IF EXISTS unreachable")
+                conn.execute(
+                    "INSERT OR REPLACE INTO info VALUES ('version', ?)", (str(CATALOG_VERSION),)
+                )
+            columns = ", ".join(
+                f"{name} TEXT PRIMARY KEY" if name == "link" else name
+                for name in SceneMetadata._fields
+            )
+            conn.execute(f"CREATE TABLE IF NOT EXISTS scenes ({columns})")
+            conn.execute("CREATE TABLE IF NOT EXISTS file_lists (name TEXT PRIMARY KEY, digest TEXT)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_list_links (name TEXT, link TEXT, PRIMARY KEY (name, link))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS unreachable (link TEXT PRIMARY KEY, error TEXT, updated REAL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout = 60)
+
+    def get(self, links: List) -> dict:
+        """
+        RETURNS:
+        ---
+            A dictionary from link to SceneMetadata, for the links that are in the catalog
+        """
+        res = dict()
+        links = set(links)
+        with closing(self._connect()) as conn:
+            for row in conn.execute("SELECT * FROM scenes"):
+                if row[0] in links:
+                    res[row[0]] = self._from_row(row)
+        return res
+
+    def put(self, records: List):
+        with closing(self._connect()) as conn, conn:
+            placeholders = ", ".join("?" * len(SceneMetadata._fields))
+            conn.executemany(
+                f"INSERT OR REPLACE INTO scenes VALUES ({placeholders})",
+                [self._to_row(record) for record in records],
+            )
+            conn.executemany("DELETE FROM unreachable WHERE link = ?", [(record.link,) for record in records])
+
+    def get_unreachable(self, links: List, max_age = PROBE_UNREACHABLE_TTL) -> dict:
+        """
+        RETURNS:
+        ---
+            A dictionary from link to error, for the links that could
+            not be opened in the last max_age seconds
+        """
+        res = dict()
+        links = set(links)
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT link, error FROM unreachable WHERE updated >= ?", (time.time() - max_age,))
+            for (link, error) in rows:
+                if link in links:
+                    res[link] = error
+        return res
+
+    def put_unreachable(self, unreachable: dict):
+        """
+        unreachable: a dictionary from link to the error it could not be opened with
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO unreachable VALUES (?, ?, ?)",
+                [(link, error, now) for (link, error) in unreachable.items()],
+            )
+
+    def get_digest(self, name: str) -> Optional[str]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT digest FROM file_lists WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_file_list(self, name: str, links: List):
+        """
+        Records the links of the file list called name and forgets about the
+        scenes that no file list refers to anymore
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM file_list_links WHERE name = ?", (name,))
+            conn.executemany(
+                "INSERT OR IGNORE INTO file_list_links VALUES (?, ?)", [(name, link) for link in links]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO file_lists VALUES (?, ?)", (name, get_file_list_digest(links))
+            )
+            conn.execute("DELETE FROM scenes WHERE link NOT IN (SELECT link FROM file_list_links)")
+            conn.execute("DELETE FROM unreachable WHERE link NOT IN (SELECT link FROM file_list_links)")
+
+    @staticmethod
+    def _to_row(record: SceneMetadata) -> tuple:
+        return record._replace(transform = json.dumps(list(record.transform)))
+
+    @staticmethod
+    def _from_row(row) -> SceneMetadata:
+        record = SceneMetadata(*row)
+        return record._replace(transform = tuple(json.loads(record.transform)))
+
+def get_scene_metadata(links: List, toprint = True, catalog: SceneCatalog = None, unreachable: dict = None, save = True,
+                       retry_unreachable = False, **kwargs) -> List:
+    """
+    Get the metadata of the scenes at links, reading the headers of the scenes
+    that are not in the catalog yet (and adding them to it). Links that could
+    not be opened recently (see SceneCatalog) are not probed again
+
+    PARAMETERS:
+    ---
+        links: a list of links
+        toprint: whether or not to print progress
+        catalog: the SceneCatalog to use, by default the one in data/processed
+        unreachable: if given, a dictionary that will be filled with link: error
+            for the links that could not be opened
+        save: whether or not to add what was read to the catalog; only scenes in a file
+            list (see sync_catalog_with_file_list) are kept there, so links that are
+            not in one should not be saved
+        retry_unreachable: whether or not to probe again the links that could not be opened recently
+        kwargs: max_workers, timeout, retries, backoff, passed on to probe_scene_metadata
+
+    RETURNS:
+    ---
+        A list of SceneMetadata in the same order as links;
+        None for the links that could not be opened
+    """
+    if catalog is None:
+        catalog = SceneCatalog()
+    found = catalog.get(links)
+    known_unreachable = dict()
+    if not retry_unreachable:
+        known_unreachable = catalog.get_unreachable([link for link in links if link not in found])
+    if len(known_unreachable) > 0:
+        print_message(toprint, f"Skipping {len(known_unreachable)} scenes that could not be opened recently")
+    if unreachable is not None:
+        unreachable.update(known_unreachable)
+    missing = [link for link in links if link not in found and link not in known_unreachable]
+    if len(missing) > 0:
+        print_message(toprint, f"Reading the headers of {len(missing)} scenes...")
+        report = probe_scene_metadata(missing, toprint, **kwargs)
+        if save:
+            catalog.put(list(report.records.values()))
+            catalog.put_unreachable(report.unreachable)
+        found.update(report.records)
+        if unreachable is not None:
+            unreachable.update(report.unreachable)
+    return [found.get(link) for link in links]
+
+def sync_catalog_with_file_list(name: str, links: List, toprint = True, catalog: SceneCatalog = None, **kwargs) -> List:
+    """
+    Same as get_scene_metadata, but first checks whether the file list called name
+    has changed since the catalog last saw it. If it has, the scenes that were
+    dropped from the list are removed from the catalog
+    """
+    if catalog is None:
+        catalog = SceneCatalog()
+    if catalog.get_digest(name) != get_file_list_digest(links):
+        print_message(toprint, f"File list {name} has changed, updating the scene catalog...")
+        catalog.set_file_list(name, links)
+    return get_scene_metadata(links, toprint, catalog, **kwargs)
@@ -0,0 +1,195 @@
+# Downloading whole files (requests is imported when the first file is downloaded)
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import time
+
+# Extracting them
+import zipfile
+import shutil
+import json
+
+# Others
+from typing import List, NamedTuple, Optional
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+
+# Kept next to every cached file, to know where it came from
+SOURCE_FILENAME = "source.json"
+# Kept in every directory archives are extracted to: which version of every archive is in it
+EXTRACTED_FILENAME = ".extracted.json"
+
+class DownloadResult(NamedTuple):
+    """
+    url: the link downloaded
+    path: where the file is in the download cache
+    key: the version of the file, see get_download_key
+    downloaded: the number of bytes downloaded, 0 if the file was already cached
+    resumed: whether or not an earlier partial download was carried on
+    """
+    url: str
+    path: str
+    key: str
+    downloaded: int
+    resumed: bool
+
+def get_download_key(url: str, etag: Optional[str], size: Optional[int]) -> str:
+    """
+    The key of one version of a remote file: its url with its ETag, or its size
+    if the server sends no ETag. A new version of the file gets a new key
+    """
+    version = etag if etag is not None else ("" if size is None else str(size))
+    return hashlib.sha256(f"{url}\n{version}".encode()).hexdigest()
+
+def get_remote_version(session: "requests.Session", url: str, timeout = PROBE_TIMEOUT) -> tuple:
+    """
+    RETURNS:
+    ---
+        (etag, size) of the remote file, each None if the server does not say
+    """
+    response = session.head(url, allow_redirects = True, timeout = timeout)
+    if response.status_code >= 500 and response.status_code != 501:
+        raise OSError(f"HTTP {response.status_code} when asking for the version of {url}")
+    if response.status_code != 200:
+        # Some servers do not answer HEAD requests
+        return (None, None)
+    size = response.headers.get("Content-Length")
+    return (response.headers.get("ETag"), int(size) if size is not None else None)
+
+def remove_old_versions(cache_dir, url: str, key: str):
+    """
+    Removes the other versions of url from the download cache
+    """
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name, SOURCE_FILENAME)
+        if name == key or not os.path.isfile(path):
+            continue
+        with open(path) as f:
+            if json.load(f)["url"] == url:
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors = True)
+
+def _download(session: "requests.Session", url: str, cache_dir, timeout) -> DownloadResult:
+    (etag, size) = get_remote_version(session, url, timeout)
+    key = get_download_key(url, etag, size)
+    entry_dir = os.path.join(cache_dir, key)
+    path = os.path.join(entry_dir, url.split("?")[0].split("/")[-1] or "download")
+    if os.path.isfile(path):
+        return DownloadResult(url, path, key, 0, False)
+    os.makedirs(entry_dir, exist_ok = True)
+    with open(os.path.join(entry_dir, SOURCE_FILENAME), "w") as f:
+        json.dump({"url": url, "etag": etag, "size": size}, f)
+    part = path + ".part"
+    # A partial download can only be carried on if it is of the same version
+    offset = os.path.getsize(part) if os.path.isfile(part) and (etag is not None or size is not None) else 0
+    if size is not None and offset > size:
+        offset = 0
+    downloaded = 0
+    if size is None or offset < size:
+        headers = dict()
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+            if etag is not None and not etag.startswith("W/"):
+                # The whole file is sent if it changed since the HEAD request
+                headers["If-Range"] = etag
+        with session.get(url, headers = headers, stream = True, timeout = timeout) as response:
+            if response.status_code == 206 and response.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+                mode = "ab"
+            elif response.status_code == 200:
+                (mode, offset) = ("wb", 0)
+            else:
+                raise OSError(f"HTTP {response.status_code} when downloading {url}")
+            with open(part, mode) as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    downloaded += len(chunk)
+    if size is not None and os.path.getsize(part) != size:
+        raise OSError(f"Expected {size} bytes from {url} but got {os.path.getsize(part)}")
+    os.replace(part, path)
+    remove_old_versions(cache_dir, url, key)
+    return DownloadResult(url, path, key, downloaded, offset > 0)
+
+def download_file(url: str, cache_dir = None, timeout = PROBE_TIMEOUT, retries = PROBE_RETRIES, backoff = PROBE_BACKOFF,
+                  session = None) -> DownloadResult:
+    """
+    Downloads url into the download cache (by default data/cache/downloads),
+    unless the same version of it (see get_download_key) is already there
+
+    Files are written to <cache_dir>/<key>/<filename>.part first and renamed once
+    complete. If the download fails, it is retried with exponential backoff, carrying
+    on from the bytes already written (with a range request); so does the next call
+    if all the retries fail. Older versions of the file are removed from the cache
+
+    The same url must not be downloaded by two threads or processes at the same time
+    """
+    import requests
+    if cache_dir is None:
+        cache_dir = PATH_TO_DOWNLOAD_CACHE
+    if session is None:
+        session = requests.Session()
+    error = None
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            return _download(session, url, cache_dir, timeout)
+        except (requests.RequestException, OSError) as e:
+            error = e
+    raise OSError(f"Could not download {url}: {error}")
+
+def download_files(urls: List, cache_dir = None, max_workers = DOWNLOAD_MAX_WORKERS, toprint = True, **kwargs) -> dict:
+    """
+    Downloads many files at once using a pool of max_workers threads, see download_file
+
+    PARAMETERS:
+    ---
+        urls: a list of links
+        cache_dir: the download cache, by default data/cache/downloads
+        toprint: whether or not to print progress
+        max_workers: maximum number of files downloaded at the same time
+        kwargs: timeout, retries, backoff, passed on to download_file
+
+    RETURNS:
+    ---
+        A dictionary from url to DownloadResult
+    """
+    urls = list(dict.fromkeys(urls))
+    res = dict()
+    if len(urls) == 0:
+        return res
+    with ThreadPoolExecutor(max_workers = min(max_workers, len(urls))) as executor:
+        futures = {executor.submit(download_file, url, cache_dir, **kwargs): url for url in urls}
+        for (future, idx) in zip(as_completed(futures), range(len(urls))):
+            print_message(toprint, f"{idx+1}/{len(urls)}", end="\r")
+            res[futures[future]] = future.result()
+    return res
+
+def extract_archive(download: DownloadResult, destination_dir) -> bool:
+    """
+    Extracts a downloaded zip file into destination_dir, unless this version of it
+    has already been extracted there (and none of its files has been removed since)
+
+    Not thread safe: extract the archives of one directory one after the other
+
+    RETURNS:
+    ---
+        Whether or not the archive was extracted
+    """
+    os.makedirs(destination_dir, exist_ok = True)
+    path = os.path.join(destination_dir, EXTRACTED_FILENAME)
+    extracted = dict()
+    if os.path.isfile(path):
+        with open(path) as f:
+            extracted = json.load(f)
+    with zipfile.ZipFile(download.path, "r") as zip_ref:
+        names = [name for name in zip_ref.namelist() if not name.endswith("/")]
+        if extracted.get(download.url) == download.key and all(
+            os.path.isfile(os.path.join(destination_dir, name)) for name in names
+        ):
+            return False
+        zip_ref.extractall(destination_dir)
+    extracted[download.url] = download.key
+    with open(path + ".tmp", "w") as f:
+        json.dump(extracted, f, indent = 1)
+    os.replace(path + ".tmp", path)
+    return True
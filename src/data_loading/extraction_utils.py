@@ -0,0 +1,893 @@
+# Handle tif files
+import rasterio as rio
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+from rasterio.enums import MaskFlags
+from rasterio.errors import WindowError
+from rasterio.crs import CRS
+import affine
+import numpy as np
+
+# Parallel extraction
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import multiprocessing
+import threading
+import queue
+from collections import OrderedDict, deque
+import hashlib
+
+# Others
+from typing import List, NamedTuple, Optional
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.footprint_utils import FootprintIndex
+from data_loading.range_cache_utils import open_scene
+from data_loading.scene_selection_utils import SceneSelection, select_scenes
+from data_loading.patch_codec_utils import PatchEncoding, get_creation_options
+
+# Regions bigger than this (in pixels) are never merged into one read
+MAX_REGION_PIXELS = 2048 * 2048
+# When extracting in parallel, scenes with more jobs than this are split into several work units
+MAX_JOBS_PER_UNIT = 500
+# Number of datasets each worker process keeps open
+MAX_OPEN_DATASETS = 8
+# Number of patches iter_patches_by_scene reads ahead of the consumer
+PATCH_PREFETCH = 64
+# The nodata check reads the mask from the coarsest overview that still has this many pixels across a patch
+NODATA_CHECK_MIN_PIXELS = 8
+
+class PatchJob(NamedTuple):
+    """
+    One patch to cut: the window of scene scene_idx around point point_idx,
+    saved as {point_idx}-{seq}.tif in the output directory
+    """
+    point_idx: int
+    scene_idx: int
+    seq: int
+    window: Window
+    path: str
+    idx: int = -1 # row of the patch in an array store, see patch_store_utils
+
+class PatchFilter(NamedTuple):
+    """
+    Which patches to skip, and what to do with windows partly outside their scene
+
+    max_nodata: patches with a larger fraction of nodata pixels are skipped
+        (checked on the mask of the scene before reading it, see iter_patches_from_dataset);
+        1 keeps every patch. PATCH_MAX_NODATA by default
+    boundless: "clip" keeps the part of the window inside the scene,
+        "pad" keeps the whole window and fills the part outside with nodata (or 0),
+        "skip" skips the windows that are not entirely inside the scene
+    """
+    max_nodata: float = PATCH_MAX_NODATA
+    boundless: str = "clip"
+
+class Patch(NamedTuple):
+    """
+    A patch cut out of a scene, see iter_patches_by_scene
+    """
+    point_idx: int
+    seq: int
+    x: Optional[float] # coordinates of the point
+    y: Optional[float]
+    link: str # the scene it was cut out of
+    data: np.ndarray # (bands, height, width)
+    transform: affine.Affine
+    crs: CRS
+
+def get_bounds_for_points(xs, ys, dist) -> tuple:
+    """
+    Vectorized version of get_geom_for_point(point, dist).geometry[0].bounds:
+    every edge is dist meters away from the point, so the patches are twice as
+    wide in degrees of longitude at 60 degrees north as at the equator
+
+    RETURNS:
+    ---
+        (lefts, bottoms, rights, tops) arrays
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    deg = convert_meters_to_deg(dist)
+    deg_lon = convert_meters_to_deg_lon(dist, ys)
+    return (xs - deg_lon, ys - deg, xs + deg_lon, ys + deg)
+
+def get_windows_for_bounds(lefts, bottoms, rights, tops, transform) -> tuple:
+    """
+    Vectorized version of rasterio.windows.from_bounds: maps the corners of
+    every box to pixel space with the inverse of the transform of the scene
+
+    RETURNS:
+    ---
+        (col_offs, row_offs, widths, heights) arrays of fractional windows
+    """
+    inverse = ~transform
+    corners_x = np.stack([lefts, rights, rights, lefts])
+    corners_y = np.stack([tops, tops, bottoms, bottoms])
+    cols = inverse.a * corners_x + inverse.b * corners_y + inverse.c
+    rows = inverse.d * corners_x + inverse.e * corners_y + inverse.f
+    col_offs = cols.min(axis = 0)
+    row_offs = rows.min(axis = 0)
+    widths = np.maximum(cols.max(axis = 0) - col_offs, 0.0)
+    heights = np.maximum(rows.max(axis = 0) - row_offs, 0.0)
+    return (col_offs, row_offs, widths, heights)
+
+def plan_patch_jobs(records: List, xs, ys, dist, path_to_dir, index: FootprintIndex = None, selection: SceneSelection = None) -> List:
+    """
+    Works out every patch to cut, without opening any scene
+
+    PARAMETERS:
+    ---
+        records: a list of SceneMetadata (from catalog_utils), one per link
+        xs, ys: arrays of point coordinates
+        dist: distance in meters from the point to each edge of the patch
+        path_to_dir: path to the directory in which we will store all the patches
+            (None if they are not going to be saved, see iter_patches_by_scene)
+        index: FootprintIndex over the bounds of records, built if not given
+        selection: which of the scenes containing a point to crop it from
+            (see scene_selection_utils), by default all of them
+
+    RETURNS:
+    ---
+        A list of PatchJob, numbered the same way as crop_patches_for_point does:
+        the patches of a point are numbered 1, 2, ... in the order of records
+        (of the selected records, if only some are selected)
+    """
+    if index is None:
+        index = FootprintIndex([record.bounds for record in records])
+    point_idx, scene_idx = index.query(xs, ys)
+    (lefts, bottoms, rights, tops) = get_bounds_for_points(xs, ys, dist)
+    # The windows of all the points of a scene in one go
+    windows = np.empty((4, len(point_idx)))
+    order = np.argsort(scene_idx, kind = "stable")
+    starts = np.flatnonzero(np.diff(scene_idx[order], prepend = -1))
+    for (start, end) in zip(starts, np.append(starts[1:], len(order))):
+        members = order[start:end]
+        points = point_idx[members]
+        windows[:, members] = get_windows_for_bounds(
+            lefts[points], bottoms[points], rights[points], tops[points], records[scene_idx[members[0]]].affine
+        )
+    if selection is not None:
+        keep = select_scenes(records, point_idx, scene_idx, selection, windows)
+        (point_idx, scene_idx, windows) = (point_idx[keep], scene_idx[keep], windows[:, keep])
+    # point_idx is sorted, so seq counts the scenes seen so far for each point
+    seq = np.arange(len(point_idx)) - np.searchsorted(point_idx, point_idx) + 1
+    jobs = []
+    for (p, s, i, window) in zip(point_idx.tolist(), scene_idx.tolist(), seq.tolist(), windows.T.tolist()):
+        path = None if path_to_dir is None else os.path.join(path_to_dir, f"{p}-{i}.tif")
+        jobs.append(PatchJob(p, s, i, Window(*window), path))
+    return jobs
+
+def get_patch_window(window: Window, width, height, boundless = "clip") -> Optional[Window]:
+    """
+    The part of window that the patch covers (see PatchFilter.boundless)
+
+    RETURNS:
+    ---
+        A Window, or None if the patch is skipped: the window has no pixel in the
+        scene, or it is partly outside and boundless is "skip"
+    """
+    try:
+        clipped = window.intersection(Window(0, 0, width, height))
+    except WindowError:
+        return None
+    if int(round(clipped.height)) == 0 or int(round(clipped.width)) == 0:
+        return None
+    if boundless == "pad":
+        return window
+    if boundless == "skip" and (
+        window.col_off < 0 or window.row_off < 0 or
+        window.col_off + window.width > width or window.row_off + window.height > height
+    ):
+        return None
+    if boundless not in ["clip", "skip"]:
+        raise ValueError(f"Unknown boundless {boundless}")
+    return clipped
+
+def get_patch_transform(window: Window, transform: affine.Affine, width, height, boundless = "clip") -> Optional[affine.Affine]:
+    """
+    The transform of the patch cut out of window, in a scene of the given
+    transform and size: with "clip", the patch starts where the window enters
+    the scene, not where the window starts
+
+    RETURNS:
+    ---
+        The transform, or None if the patch is skipped (see get_patch_window)
+    """
+    patch_window = get_patch_window(window, width, height, boundless)
+    return None if patch_window is None else window_transform(patch_window, transform)
+
+def get_pixel_indices(window: Window, width, height, boundless = "clip") -> tuple:
+    """
+    The rows and columns of the scene that src.read(window=window) returns
+    for a (possibly fractional, possibly partly outside) window: rasterio first
+    clips the window to the scene, then samples it with nearest neighbour
+
+    With boundless "pad" the window is not clipped, and the rows and columns
+    outside the scene (below 0, or from height / width on) are kept
+
+    RETURNS:
+    ---
+        (rows, cols) arrays of pixel indices in the scene, both empty if the patch is skipped
+    """
+    patch_window = get_patch_window(window, width, height, boundless)
+    if patch_window is None:
+        return (np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64))
+    out_height = int(round(patch_window.height))
+    out_width = int(round(patch_window.width))
+    # GDAL adds a tiny epsilon before rounding down, so do we
+    rows = np.floor(patch_window.row_off + (np.arange(out_height) + 0.5) * patch_window.height / max(out_height, 1) + 1e-10)
+    cols = np.floor(patch_window.col_off + (np.arange(out_width) + 0.5) * patch_window.width / max(out_width, 1) + 1e-10)
+    rows = rows.astype(np.int64)
+    cols = cols.astype(np.int64)
+    if boundless != "pad":
+        rows = np.clip(rows, 0, height - 1)
+        cols = np.clip(cols, 0, width - 1)
+    return (rows, cols)
+
+def get_pixels_inside(pixel_indices: List, width, height) -> List:
+    """
+    RETURNS:
+    ---
+        pixel_indices without the rows and columns outside the scene
+    """
+    return [
+        (rows[(rows >= 0) & (rows < height)], cols[(cols >= 0) & (cols < width)])
+        for (rows, cols) in pixel_indices
+    ]
+
+def get_block_boxes(pixel_indices: List, block_shape, width, height) -> List:
+    """
+    RETURNS:
+    ---
+        For each (rows, cols) of pixel_indices, the smallest block-aligned box
+        (row start, col start, row stop, col stop) holding them, None if empty
+    """
+    (block_height, block_width) = block_shape
+    boxes = []
+    for (rows, cols) in pixel_indices:
+        if len(rows) == 0 or len(cols) == 0:
+            boxes.append(None)
+            continue
+        boxes.append((
+            int(rows.min() // block_height) * block_height,
+            int(cols.min() // block_width) * block_width,
+            min(int(rows.max() // block_height + 1) * block_height, height),
+            min(int(cols.max() // block_width + 1) * block_width, width),
+        ))
+    return boxes
+
+def cluster_block_boxes(boxes: List, block_shape) -> List:
+    """
+    Groups the boxes that share blocks, directly or through other boxes:
+    every box is bucketed by the blocks it covers, and the boxes in the same
+    bucket are joined (union-find)
+
+    RETURNS:
+    ---
+        A list of clusters, each a sorted list of positions in boxes (None boxes are left out)
+    """
+    (block_height, block_width) = block_shape
+    parent = list(range(len(boxes)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    owners = dict()
+    for (i, box) in enumerate(boxes):
+        if box is None:
+            continue
+        (r0, c0, r1, c1) = box
+        for block_row in range(r0 // block_height, (r1 - 1) // block_height + 1):
+            for block_col in range(c0 // block_width, (c1 - 1) // block_width + 1):
+                j = owners.setdefault((block_row, block_col), i)
+                (root_i, root_j) = (find(i), find(j))
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+    clusters = dict()
+    for (i, box) in enumerate(boxes):
+        if box is not None:
+            clusters.setdefault(find(i), []).append(i)
+    return list(clusters.values())
+
+def split_cluster(boxes: List, members: List, max_region_pixels) -> List:
+    """
+    Splits a cluster until the bounding box of every part has at most
+    max_region_pixels pixels (or a single box), cutting it in two halves
+    along its longer side at the median box centre, like a KD-tree
+
+    RETURNS:
+    ---
+        A list of (region, members), region being (row start, col start, row stop, col stop)
+    """
+    region = (
+        min(boxes[i][0] for i in members),
+        min(boxes[i][1] for i in members),
+        max(boxes[i][2] for i in members),
+        max(boxes[i][3] for i in members),
+    )
+    (r0, c0, r1, c1) = region
+    if len(members) == 1 or (r1 - r0) * (c1 - c0) <= max_region_pixels:
+        return [(region, members)]
+    axis = 0 if r1 - r0 >= c1 - c0 else 1
+    ordered = sorted(members, key = lambda i: (boxes[i][axis] + boxes[i][axis + 2], i))
+    half = len(ordered) // 2
+    return (
+        split_cluster(boxes, sorted(ordered[:half]), max_region_pixels) +
+        split_cluster(boxes, sorted(ordered[half:]), max_region_pixels)
+    )
+
+def plan_region_reads(pixel_indices: List, block_shape, width, height, max_region_pixels = MAX_REGION_PIXELS) -> List:
+    """
+    Groups windows whose blocks overlap into block-aligned regions,
+    so that every block is only fetched and decoded once
+    (unless the region would grow beyond max_region_pixels)
+
+    PARAMETERS:
+    ---
+        pixel_indices: a list of (rows, cols) from get_pixel_indices
+        block_shape: (block height, block width) of the scene
+        width, height: size of the scene
+        max_region_pixels: a region is never grown beyond this many pixels
+
+    RETURNS:
+    ---
+        A list of (region, members): region is an integer Window,
+        members the positions in pixel_indices that are read from it
+    """
+    boxes = get_block_boxes(pixel_indices, block_shape, width, height)
+    regions = []
+    for members in cluster_block_boxes(boxes, block_shape):
+        regions += split_cluster(boxes, members, max_region_pixels)
+    regions.sort(key = lambda region: (region[0][:2], region[1]))
+    return [
+        (Window(c0, r0, c1 - c0, r1 - r0), members) for ((r0, c0, r1, c1), members) in regions
+    ]
+
+def count_read_bytes(pixel_indices: List, regions: List, block_shape, width, height, bytes_per_pixel) -> dict:
+    """
+    How much reading the regions saves
+
+    RETURNS:
+    ---
+        A dictionary with:
+            patches, regions: number of patches and of reads
+            requested_bytes: size of the patches themselves
+            window_bytes: bytes decoded with one read per patch (every block it touches)
+            read_bytes: bytes decoded reading the regions
+    """
+    boxes = get_block_boxes(pixel_indices, block_shape, width, height)
+    return {
+        "patches": sum(box is not None for box in boxes),
+        "regions": len(regions),
+        "requested_bytes": bytes_per_pixel * sum(len(rows) * len(cols) for (rows, cols) in pixel_indices),
+        "window_bytes": bytes_per_pixel * sum((r1 - r0) * (c1 - c0) for (r0, c0, r1, c1) in filter(None, boxes)),
+        "read_bytes": bytes_per_pixel * sum(int(region.width) * int(region.height) for (region, _) in regions),
+    }
+
+def add_read_stats(stats: dict, other: dict):
+    for (name, value) in other.items():
+        stats[name] = stats.get(name, 0) + value
+
+def get_read_counters(stats: dict) -> dict:
+    """
+    The read stats (see iter_patches_from_dataset) worth reporting as counters
+    of a run (see instrumentation_utils)
+    """
+    return {
+        "scenes_opened": stats.get("scenes_opened", 0),
+        "windows_read": stats.get("regions", 0),
+        "bytes_read": stats.get("read_bytes", 0),
+        "mask_bytes_read": stats.get("mask_bytes", 0),
+        "patches_skipped": sum(stats.get(name, 0) for name in ["skipped_nodata", "skipped_outside", "skipped_empty"]),
+    }
+
+def format_read_stats(stats: dict) -> str:
+    if stats.get("read_bytes", 0) == 0 and stats.get("mask_bytes", 0) == 0:
+        res = "Nothing was read"
+    else:
+        res = (
+            f"Read {stats['read_bytes'] / 2**20:.1f}MB in {stats['regions']} reads for {stats['patches']} patches "
+            f"({stats['requested_bytes'] / 2**20:.1f}MB of patches, {stats['window_bytes'] / 2**20:.1f}MB "
+            f"with one read per patch: {stats['window_bytes'] / max(stats['read_bytes'], 1):.2f}x saved)"
+        )
+    skipped = sum(stats.get(name, 0) for name in ["skipped_nodata", "skipped_outside", "skipped_empty"])
+    if skipped > 0 or stats.get("mask_bytes", 0) > 0:
+        res += (
+            f"\nSkipped {skipped} patches ({stats.get('skipped_nodata', 0)} with too much nodata, "
+            f"{stats.get('skipped_outside', 0)} partly outside their scene, {stats.get('skipped_empty', 0)} empty): "
+            f"{stats.get('skipped_bytes', 0) / 2**20:.1f}MB of patches, {stats.get('saved_bytes', 0) / 2**20:.1f}MB not read "
+            f"at the cost of {stats.get('mask_bytes', 0) / 2**20:.1f}MB of masks"
+        )
+    return res
+
+def has_nodata(src) -> bool:
+    """
+    Whether or not some pixels of the open dataset src can be nodata
+    (it has a nodata value, a mask band or an alpha band)
+    """
+    return any(MaskFlags.all_valid not in flags for flags in src.mask_flag_enums)
+
+def get_overview_factor(src, size) -> int:
+    """
+    RETURNS:
+    ---
+        The decimation factor of the coarsest overview of src that still has
+        NODATA_CHECK_MIN_PIXELS pixels across size pixels, 1 if there is none
+    """
+    return max([f for f in src.overviews(1) if size // f >= NODATA_CHECK_MIN_PIXELS], default = 1)
+
+def read_valid_mask(src, region: Window, size) -> tuple:
+    """
+    The mask of the region of src (non-zero where the pixels are valid),
+    read as cheaply as possible for patches of about size pixels across:
+    from an overview if there is one, from the mask band if there is one,
+    and otherwise from the data itself (which is then returned so that it
+    is not read twice)
+
+    RETURNS:
+    ---
+        (mask, data): data is None unless the data had to be read
+    """
+    factor = get_overview_factor(src, size)
+    if factor == 1 and src.nodata is not None and MaskFlags.per_dataset not in src.mask_flag_enums[0]:
+        data = src.read(window = region)
+        return ((data != src.nodata).any(axis = 0), data)
+    out_shape = (max(int(region.height) // factor, 1), max(int(region.width) // factor, 1))
+    return (src.dataset_mask(window = region, out_shape = out_shape), None)
+
+def get_nodata_fractions(mask: np.ndarray, region: Window, pixel_indices: List) -> List:
+    """
+    RETURNS:
+    ---
+        For each (rows, cols) of pixel_indices, the fraction of its pixels that are
+        nodata according to mask, the (possibly decimated) mask of region.
+        Pixels outside the scene count as nodata
+    """
+    (mask_height, mask_width) = mask.shape
+    (row_off, col_off) = (int(region.row_off), int(region.col_off))
+    (height, width) = (int(region.height), int(region.width))
+    res = []
+    for (rows, cols) in pixel_indices:
+        total = len(rows) * len(cols)
+        rows = rows[(rows >= row_off) & (rows < row_off + height)]
+        cols = cols[(cols >= col_off) & (cols < col_off + width)]
+        if total == 0:
+            res.append(1.0)
+            continue
+        mask_rows = (rows - row_off) * mask_height // height
+        mask_cols = (cols - col_off) * mask_width // width
+        valid = np.count_nonzero(mask[mask_rows[:, None], mask_cols[None, :]])
+        res.append(1 - valid / total)
+    return res
+
+def get_region_for_boxes(boxes: List) -> Window:
+    """
+    RETURNS:
+    ---
+        The smallest Window holding all the (row start, col start, row stop, col stop) boxes
+    """
+    r0 = min(box[0] for box in boxes)
+    c0 = min(box[1] for box in boxes)
+    r1 = max(box[2] for box in boxes)
+    c1 = max(box[3] for box in boxes)
+    return Window(c0, r0, c1 - c0, r1 - r0)
+
+def write_patch(filename, data: np.ndarray, transform, crs, encoding: PatchEncoding = None):
+    """
+    Saves a (bands, height, width) array as a GeoTIFF, compressed and laid out
+    as encoding says (see patch_codec_utils.PatchEncoding), uncompressed by default
+    """
+    options = get_creation_options(encoding, data)
+    with rio.open(
+        filename, 'w',
+        driver=options.pop("driver", 'GTiff'),
+        width=data.shape[2],
+        height=data.shape[1],
+        count=data.shape[0],
+        transform=transform,
+        crs=crs,
+        dtype=data.dtype,
+        **options,
+        ) as dst:
+        dst.write(data)
+
+class GTiffSink:
+    """
+    Where the cropped patches go: one GeoTIFF per patch, saved at job.path
+    with encoding (see write_patch)
+
+    With threads > 0, the patches are compressed and written by a pool of threads
+    while the next ones are read (GDAL does not hold the GIL while it compresses),
+    at most two per thread waiting at a time; flush waits for them
+
+    Any object with the same write method can be used instead (see
+    patch_store_utils.ArraySink); it must be picklable to be sent to workers.
+    A sink that writes in the background must have a flush method, called once
+    all the patches of a scene have been handed to it.
+    A sink that gathers something from the patches (see band_stats_utils.BandStatsSink)
+    can also have collect() and merge(partial) methods: every worker then collects
+    what its copy of the sink gathered, and the sink of the main process merges it
+    """
+    def __init__(self, encoding: PatchEncoding = None, threads = 0):
+        self.encoding = encoding
+        self.threads = threads
+        self._executor = None
+        self._pending = deque()
+
+    def __getstate__(self):
+        # Each process starts its own threads
+        return {**self.__dict__, "_executor": None, "_pending": deque()}
+
+    def write(self, job: PatchJob, data: np.ndarray, transform, crs):
+        if self.threads <= 0:
+            write_patch(job.path, data, transform, crs, self.encoding)
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers = self.threads)
+        while len(self._pending) >= 2 * self.threads:
+            self._pending.popleft().result()
+        self._pending.append(self._executor.submit(write_patch, job.path, data, transform, crs, self.encoding))
+
+    def flush(self):
+        """
+        Waits for all the patches handed to write to be saved, and raises
+        the first error if any of them could not be
+        """
+        error = None
+        while len(self._pending) > 0:
+            e = self._pending.popleft().exception()
+            error = e if error is None else error
+        if error is not None:
+            raise error
+
+def get_patch_hash(data: np.ndarray) -> str:
+    """
+    A hash of the content of a patch (its pixels, shape and dtype)
+    """
+    h = hashlib.sha256(f"{data.dtype.str}{data.shape}".encode())
+    h.update(np.ascontiguousarray(data).tobytes())
+    return h.hexdigest()
+
+def iter_patches_from_dataset(src, jobs: List, max_region_pixels = MAX_REGION_PIXELS, stats: dict = None, patch_filter: PatchFilter = None):
+    """
+    Cuts all the patches of jobs out of the open dataset src. Nearby patches
+    are cut out of one read of the region around them (see plan_region_reads);
+    if stats is given, the counts of count_read_bytes are added to it, together
+    with the number of patches skipped (skipped_nodata, skipped_outside, skipped_empty),
+    their size (skipped_bytes), the bytes that did not have to be read because
+    of them (saved_bytes) and the bytes of masks read to find them (mask_bytes)
+
+    PARAMETERS:
+    ---
+        patch_filter: which patches to skip, see PatchFilter. If some pixels of the
+            scene can be nodata, the mask of every region is checked before the region
+            is read, from an overview if the scene has some; a region is then only
+            read for the patches that pass, or not at all
+
+    YIELDS:
+    ---
+        (i, data, transform) for every job i (position in jobs) that is not skipped, region by region
+    """
+    if patch_filter is None:
+        patch_filter = PatchFilter()
+    block_shape = src.block_shapes[0]
+    bytes_per_pixel = src.count * np.dtype(src.dtypes[0]).itemsize
+    pixel_indices = [get_pixel_indices(job.window, src.width, src.height, patch_filter.boundless) for job in jobs]
+    inside = get_pixels_inside(pixel_indices, src.width, src.height)
+    regions = plan_region_reads(inside, block_shape, src.width, src.height, max_region_pixels)
+    if stats is None:
+        stats = dict()
+    add_read_stats(stats, count_read_bytes(inside, regions, block_shape, src.width, src.height, bytes_per_pixel))
+    for (job, (rows, cols)) in zip(jobs, pixel_indices):
+        if len(rows) == 0 or len(cols) == 0:
+            outside = get_patch_window(job.window, src.width, src.height) is not None
+            add_read_stats(stats, {"skipped_outside" if outside else "skipped_empty": 1})
+    check_nodata = patch_filter.max_nodata < 1 and has_nodata(src)
+    fill = src.nodata if src.nodata is not None else 0
+    for (region, members) in regions:
+        data = None
+        if check_nodata:
+            size = min(min(len(pixel_indices[i][0]), len(pixel_indices[i][1])) for i in members)
+            (mask, data) = read_valid_mask(src, region, size)
+            fractions = get_nodata_fractions(mask, region, [pixel_indices[i] for i in members])
+            kept = [i for (i, fraction) in zip(members, fractions) if fraction <= patch_filter.max_nodata]
+            skipped = sorted(set(members) - set(kept))
+            add_read_stats(stats, {
+                "mask_bytes": mask.size if data is None else 0,
+                "skipped_nodata": len(skipped),
+                "skipped_bytes": bytes_per_pixel * sum(len(pixel_indices[i][0]) * len(pixel_indices[i][1]) for i in skipped),
+            })
+            if len(kept) == 0 or (data is None and len(kept) < len(members)):
+                # Only read the blocks the remaining patches need
+                smaller = None
+                if len(kept) > 0:
+                    smaller = get_region_for_boxes(get_block_boxes([inside[i] for i in kept], block_shape, src.width, src.height))
+                saved = int(region.width) * int(region.height)
+                if smaller is not None:
+                    saved -= int(smaller.width) * int(smaller.height)
+                    region = smaller
+                if data is None:
+                    add_read_stats(stats, {"saved_bytes": bytes_per_pixel * saved, "read_bytes": -bytes_per_pixel * saved})
+            members = kept
+            if len(members) == 0:
+                continue
+        if data is None:
+            data = src.read(window=region)
+        for i in members:
+            (rows, cols) = pixel_indices[i]
+            transform = get_patch_transform(jobs[i].window, src.transform, src.width, src.height, patch_filter.boundless)
+            rows = rows - int(region.row_off)
+            cols = cols - int(region.col_off)
+            in_rows = (rows >= 0) & (rows < data.shape[1])
+            in_cols = (cols >= 0) & (cols < data.shape[2])
+            if in_rows.all() and in_cols.all():
+                yield (i, data[:, rows][:, :, cols], transform)
+                continue
+            # A padded patch, partly outside the scene
+            patch = np.full((data.shape[0], len(rows), len(cols)), fill, dtype = data.dtype)
+            patch[:, np.flatnonzero(in_rows)[:, None], np.flatnonzero(in_cols)[None, :]] = (
+                data[:, rows[in_rows][:, None], cols[in_cols][None, :]]
+            )
+            yield (i, patch, transform)
+
+def extract_patches_from_dataset(src, jobs: List, max_region_pixels = MAX_REGION_PIXELS, sink = None, stats: dict = None, patch_filter: PatchFilter = None) -> List:
+    """
+    Hands all the patches of jobs from iter_patches_from_dataset to sink (by default a GTiffSink)
+
+    RETURNS:
+    ---
+        A list with one entry per job: the hash of the patch written (see
+        get_patch_hash), or None if the patch was skipped and nothing was written
+    """
+    if sink is None:
+        sink = GTiffSink()
+    hashes = [None] * len(jobs)
+    try:
+        for (i, data, transform) in iter_patches_from_dataset(src, jobs, max_region_pixels, stats, patch_filter):
+            sink.write(jobs[i], data, transform, src.crs)
+            hashes[i] = get_patch_hash(data)
+    finally:
+        # The patches are only done once they are saved
+        if hasattr(sink, "flush"):
+            sink.flush()
+    return hashes
+
+def extract_patches_from_scene(link, jobs: List, toprint = True, max_region_pixels = MAX_REGION_PIXELS, sink = None, stats: dict = None, patch_filter: PatchFilter = None) -> List:
+    """
+    Opens the scene at link once and cuts all of its patches
+
+    PARAMETERS:
+    ---
+        link: link to the scene
+        jobs: a list of PatchJob, all for this scene
+
+    RETURNS:
+    ---
+        Same as extract_patches_from_dataset
+    """
+    with rio.Env(**GDAL_REMOTE_OPTIONS), open_scene(link) as src:
+        if stats is not None:
+            add_read_stats(stats, {"scenes_opened": 1})
+        return extract_patches_from_dataset(src, jobs, max_region_pixels, sink, stats, patch_filter)
+
+def group_jobs_by_scene(jobs: List) -> dict:
+    jobs_by_scene = dict()
+    for job in jobs:
+        jobs_by_scene.setdefault(job.scene_idx, []).append(job)
+    return jobs_by_scene
+
+def schedule_work_units(links: List, jobs: List, max_jobs_per_unit = MAX_JOBS_PER_UNIT) -> List:
+    """
+    Splits the jobs into work units for a pool of workers
+
+    Every unit holds jobs of a single scene, at most max_jobs_per_unit of them.
+    The cost of a unit is the number of pixels it reads. Units are returned
+    biggest first, so that the big scenes start early and the small ones
+    fill in the gaps at the end (longest processing time first)
+
+    RETURNS:
+    ---
+        A list of (cost, link, jobs)
+    """
+    units = []
+    for (scene_idx, scene_jobs) in group_jobs_by_scene(jobs).items():
+        for start in range(0, len(scene_jobs), max_jobs_per_unit):
+            unit_jobs = scene_jobs[start:start + max_jobs_per_unit]
+            cost = sum(int(round(job.window.width)) * int(round(job.window.height)) for job in unit_jobs)
+            units.append((cost, links[scene_idx], unit_jobs))
+    return sorted(units, key = lambda unit: unit[0], reverse = True)
+
+# Datasets opened by this (worker) process, most recently used last
+_open_datasets = OrderedDict()
+
+def _get_open_dataset(link):
+    if link in _open_datasets:
+        _open_datasets.move_to_end(link)
+        return _open_datasets[link]
+    if len(_open_datasets) >= MAX_OPEN_DATASETS:
+        _open_datasets.popitem(last = False)[1].close()
+    with rio.Env(**GDAL_REMOTE_OPTIONS):
+        _open_datasets[link] = open_scene(link)
+    return _open_datasets[link]
+
+def _extract_work_unit(link, jobs: List, max_region_pixels, sink, patch_filter) -> tuple:
+    stats = {"scenes_opened": int(link not in _open_datasets)}
+    with rio.Env(**GDAL_REMOTE_OPTIONS):
+        hashes = extract_patches_from_dataset(_get_open_dataset(link), jobs, max_region_pixels, sink, stats, patch_filter)
+    partial = sink.collect() if hasattr(sink, "collect") else None
+    return (hashes, stats, partial)
+
+def _report_unit(jobs: List, hashes, error, on_done) -> int:
+    """
+    Passes the outcome of a work unit on to on_done (if any)
+
+    RETURNS:
+    ---
+        The number of patches written
+    """
+    if error is not None and on_done is None:
+        raise error
+    if on_done is not None:
+        on_done(jobs, hashes, None if error is None else str(error))
+    if hashes is None:
+        return 0
+    return sum(h is not None for h in hashes)
+
+def extract_patches_in_parallel(links: List, jobs: List, workers, toprint = True, max_region_pixels = MAX_REGION_PIXELS, sink = None, on_done = None, stats: dict = None, patch_filter: PatchFilter = None) -> int:
+    """
+    Same as extract_patches_by_scene, but the work units are shared out
+    between a pool of worker processes. Every worker keeps its own dataset
+    handles open between units; the output paths are fixed by the jobs,
+    so the patches are the same as those of a serial run
+
+    RETURNS:
+    ---
+        The number of patches written
+    """
+    units = schedule_work_units(links, jobs)
+    written = 0
+    print_message(toprint, f"Cropping {len(jobs)} patches in {len(units)} work units with {workers} workers...")
+    # Workers are spawned rather than forked: GDAL's state does not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers = workers, mp_context = context) as executor:
+        futures = {
+            executor.submit(_extract_work_unit, link, unit_jobs, max_region_pixels, sink, patch_filter): unit_jobs
+            for (_, link, unit_jobs) in units
+        }
+        for (future, idx) in zip(as_completed(futures), range(len(futures))):
+            error = future.exception()
+            hashes = None
+            if error is None:
+                (hashes, unit_stats, partial) = future.result()
+                if stats is not None:
+                    add_read_stats(stats, unit_stats)
+                if partial is not None:
+                    sink.merge(partial)
+            written += _report_unit(futures[future], hashes, error, on_done)
+            print_message(toprint, f"{idx+1}/{len(units)} work units done, {written}/{len(jobs)} patches written")
+    print_message(toprint, f"Wrote {written} patches")
+    return written
+
+def extract_patches_by_scene(links: List, jobs: List, toprint = True, max_region_pixels = MAX_REGION_PIXELS, workers = 1, sink = None, on_done = None, stats: dict = None, patch_filter: PatchFilter = None) -> int:
+    """
+    Scene-major patch extraction: the jobs are grouped by scene,
+    and every scene is opened only once
+
+    PARAMETERS:
+    ---
+        links: a list of links, jobs[k].scene_idx indexes into it
+        jobs: a list of PatchJob, e.g. from plan_patch_jobs
+        workers: number of worker processes, 1 to run everything in this process
+        sink: where the patches go, by default a GTiffSink
+        on_done: if given, called as on_done(jobs, hashes, error) after each scene
+            (or work unit), with the hashes from extract_patches_from_dataset, or
+            hashes None and the error message if it failed. Failures are then
+            reported this way instead of being raised
+        stats: if given, a dictionary the read counts are added to (see iter_patches_from_dataset),
+            together with the number of scenes opened (scenes_opened)
+        patch_filter: which patches to skip, see PatchFilter
+
+    RETURNS:
+    ---
+        The number of patches written
+    """
+    if stats is None:
+        stats = dict()
+    if workers > 1:
+        written = extract_patches_in_parallel(links, jobs, workers, toprint, max_region_pixels, sink, on_done, stats, patch_filter)
+        print_message(toprint, format_read_stats(stats))
+        return written
+    jobs_by_scene = group_jobs_by_scene(jobs)
+    written = 0
+    for (scene_idx, idx) in zip(sorted(jobs_by_scene.keys()), range(len(jobs_by_scene))):
+        scene_jobs = jobs_by_scene[scene_idx]
+        print_message(toprint, f"Scene {idx+1}/{len(jobs_by_scene)}: cropping {len(scene_jobs)} patches...")
+        try:
+            hashes = extract_patches_from_scene(links[scene_idx], scene_jobs, toprint, max_region_pixels, sink, stats, patch_filter)
+            error = None
+        except Exception as e:
+            (hashes, error) = (None, e)
+        written += _report_unit(scene_jobs, hashes, error, on_done)
+    print_message(toprint, f"Wrote {written} patches")
+    print_message(toprint, format_read_stats(stats))
+    return written
+
+def _read_patches_by_scene(links: List, jobs: List, xs, ys, max_region_pixels, stats, patch_filter):
+    for (scene_idx, scene_jobs) in sorted(group_jobs_by_scene(jobs).items()):
+        link = links[scene_idx]
+        with rio.Env(**GDAL_REMOTE_OPTIONS), open_scene(link) as src:
+            if stats is not None:
+                add_read_stats(stats, {"scenes_opened": 1})
+            for (i, data, transform) in iter_patches_from_dataset(src, scene_jobs, max_region_pixels, stats, patch_filter):
+                job = scene_jobs[i]
+                x = None if xs is None else float(xs[job.point_idx])
+                y = None if ys is None else float(ys[job.point_idx])
+                yield Patch(job.point_idx, job.seq, x, y, link, data, transform, src.crs)
+
+def iter_patches_by_scene(links: List, jobs: List, xs = None, ys = None, max_region_pixels = MAX_REGION_PIXELS, prefetch = PATCH_PREFETCH, stats: dict = None, patch_filter: PatchFilter = None):
+    """
+    The patches of jobs as a stream, without writing anything to disk.
+    Scenes are read one after the other (each opened once) in a background
+    thread, which stays at most prefetch patches ahead of the consumer
+
+    PARAMETERS:
+    ---
+        links: a list of links, jobs[k].scene_idx indexes into it
+        jobs: a list of PatchJob, e.g. from plan_patch_jobs
+        xs, ys: the points the jobs were planned with, to fill in Patch.x and Patch.y
+        prefetch: number of patches read ahead, 0 to read them only when asked for
+        stats: if given, a dictionary the read counts are added to (see iter_patches_from_dataset)
+        patch_filter: which patches to skip, see PatchFilter
+
+    YIELDS:
+    ---
+        A Patch for every job that is not skipped, scene by scene.
+        If a scene cannot be read, the error is raised to the consumer
+    """
+    patches = _read_patches_by_scene(links, jobs, xs, ys, max_region_pixels, stats, patch_filter)
+    if prefetch <= 0:
+        yield from patches
+        return
+    buffer = queue.Queue(maxsize = prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up as soon as the consumer has gone away
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for patch in patches:
+                if not put(patch):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+        finally:
+            patches.close()
+
+    thread = threading.Thread(target = produce, daemon = True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
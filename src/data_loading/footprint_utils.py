@@ -0,0 +1,135 @@
+# Spatial index over scene footprints
+import numpy as np
+
+# Others
+from typing import List
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+
+class FootprintIndex:
+    """
+    A uniform grid index over a list of scene footprints (BoundingBox objects)
+
+    Each scene is registered in every grid cell its bounds touch, so a point only
+    has to be tested against the scenes in its own cell. All queries take arrays
+    of coordinates and are answered in one vectorized pass.
+
+    Containment is strict, i.e. the same test as check_point_in_bounding_box:
+        left < x < right and bottom < y < top
+    """
+    def __init__(self, bounds_list: List, cells_per_axis = None):
+        """
+        PARAMETERS:
+        ---
+            bounds_list: a list of BoundingBox from rasterio.coords
+            cells_per_axis: number of grid cells along each axis
+                by default this is ceil(sqrt(number of scenes))
+        """
+        self.bounds = np.array(
+            [(b.left, b.bottom, b.right, b.top) for b in bounds_list], dtype = float
+        ).reshape(-1, 4)
+        count = len(self.bounds)
+        if cells_per_axis is None:
+            cells_per_axis = max(1, int(np.ceil(np.sqrt(count))))
+        self.nx = self.ny = int(cells_per_axis)
+        if count == 0:
+            self.extent = (0.0, 0.0, 0.0, 0.0)
+            self.cell_width = self.cell_height = 1.0
+            self.cell_starts = np.zeros(self.nx * self.ny + 1, dtype = np.int64)
+            self.cell_scenes = np.zeros(0, dtype = np.int64)
+            return
+        left, bottom = self.bounds[:, 0].min(), self.bounds[:, 1].min()
+        right, top = self.bounds[:, 2].max(), self.bounds[:, 3].max()
+        self.extent = (left, bottom, right, top)
+        self.cell_width = (right - left) / self.nx or 1.0
+        self.cell_height = (top - bottom) / self.ny or 1.0
+
+        # Register each scene in every cell that its bounds touch
+        col0, row0 = self._cells(self.bounds[:, 0], self.bounds[:, 1])
+        col1, row1 = self._cells(self.bounds[:, 2], self.bounds[:, 3])
+        cell_ids, scene_ids = [], []
+        for scene in range(count):
+            cols, rows = np.meshgrid(
+                np.arange(col0[scene], col1[scene] + 1),
+                np.arange(row0[scene], row1[scene] + 1),
+            )
+            ids = (rows * self.nx + cols).ravel()
+            cell_ids.append(ids)
+            scene_ids.append(np.full(len(ids), scene, dtype = np.int64))
+        cell_ids = np.concatenate(cell_ids)
+        scene_ids = np.concatenate(scene_ids)
+        # Sort by cell, then by scene so that results come out in list order
+        order = np.lexsort((scene_ids, cell_ids))
+        self.cell_scenes = scene_ids[order]
+        counts = np.bincount(cell_ids, minlength = self.nx * self.ny)
+        self.cell_starts = np.concatenate([[0], np.cumsum(counts)])
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def _cells(self, xs, ys):
+        col = np.floor((xs - self.extent[0]) / self.cell_width).astype(np.int64)
+        row = np.floor((ys - self.extent[1]) / self.cell_height).astype(np.int64)
+        return np.clip(col, 0, self.nx - 1), np.clip(row, 0, self.ny - 1)
+
+    def query(self, xs, ys) -> tuple:
+        """
+        Find every (point, scene) pair where the scene contains the point
+
+        PARAMETERS:
+        ---
+            xs, ys: arrays of point coordinates (same crs as the bounds)
+
+        RETURNS:
+        ---
+            (point_indices, scene_indices): two integer arrays of equal length,
+            sorted by point index and then by scene index
+        """
+        xs = np.asarray(xs, dtype = float).ravel()
+        ys = np.asarray(ys, dtype = float).ravel()
+        empty = np.zeros(0, dtype = np.int64)
+        if len(self) == 0 or len(xs) == 0:
+            return empty, empty
+        left, bottom, right, top = self.extent
+        inside = (left < xs) & (xs < right) & (bottom < ys) & (ys < top)
+        points = np.flatnonzero(inside)
+        col, row = self._cells(xs[points], ys[points])
+        cells = row * self.nx + col
+        starts = self.cell_starts[cells]
+        counts = self.cell_starts[cells + 1] - starts
+
+        # Expand every point into one candidate pair per scene in its cell
+        total = counts.sum()
+        point_idx = np.repeat(points, counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        scene_idx = self.cell_scenes[np.arange(total) - first + np.repeat(starts, counts)]
+
+        x, y = xs[point_idx], ys[point_idx]
+        b = self.bounds[scene_idx]
+        hit = (b[:, 0] < x) & (x < b[:, 2]) & (b[:, 1] < y) & (y < b[:, 3])
+        return point_idx[hit], scene_idx[hit]
+
+    def contains_any(self, xs, ys) -> np.ndarray:
+        """
+        RETURNS:
+        ---
+            A boolean array, True where at least one scene contains the point
+        """
+        res = np.zeros(len(np.asarray(xs).ravel()), dtype = bool)
+        point_idx, _ = self.query(xs, ys)
+        res[point_idx] = True
+        return res
+
+    def indices_for_points(self, xs, ys) -> List:
+        """
+        RETURNS:
+        ---
+            A list with one entry per point; entry k is the list of indices of
+            the scenes containing point k, the same as get_indices_for_point
+        """
+        n = len(np.asarray(xs).ravel())
+        point_idx, scene_idx = self.query(xs, ys)
+        splits = np.searchsorted(point_idx, np.arange(1, n))
+        return [part.tolist() for part in np.split(scene_idx, splits)]
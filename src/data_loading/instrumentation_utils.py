@@ -0,0 +1,278 @@
+# Timing the stages of a run
+import time
+from contextlib import contextmanager
+
+# GDAL reports its I/O through rasterio's logger
+from rasterio.env import get_gdal_config, set_gdal_config
+import logging
+import re
+
+# Writing the metrics
+import json
+import threading
+
+# Others
+from typing import Optional
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+
+# Every metric written in the Prometheus text format starts with this
+METRICS_PREFIX = "cat5_"
+
+def get_metrics_format(path) -> str:
+    """
+    "prometheus" for .prom and .txt files, "jsonl" otherwise
+    """
+    return "prometheus" if os.path.splitext(path)[1] in [".prom", ".txt"] else "jsonl"
+
+def format_labels(labels: tuple) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for (name, value) in labels) + "}"
+
+class GdalIOStats(logging.Handler):
+    """
+    Counts what GDAL reports through rasterio's logger while it is installed:
+        gdal_opens: datasets opened
+        gdal_http_requests: HTTP requests sent by /vsicurl/ (header and range requests)
+        gdal_http_bytes: bytes asked for by the range requests
+
+    GDAL only reports it with CPL_DEBUG on, which costs a little, so this is optional.
+    Only this process is counted, not the worker processes; reads through the range
+    cache (see range_cache_utils) do not go through /vsicurl/ and are counted by it instead
+    """
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.counts = {"gdal_opens": 0, "gdal_http_requests": 0, "gdal_http_bytes": 0}
+        self._logger = logging.getLogger("rasterio._env")
+
+    def emit(self, record):
+        message = record.getMessage()
+        if "GDALOpen(" in message and "succeeds" in message:
+            self.counts["gdal_opens"] += 1
+        elif "VSICURL: GetFileSize(" in message:
+            self.counts["gdal_http_requests"] += 1
+        elif "VSICURL: Downloading" in message:
+            self.counts["gdal_http_requests"] += 1
+            for (start, end) in re.findall(r"(\d+)-(\d+)", message.split("(")[0]):
+                self.counts["gdal_http_bytes"] += int(end) - int(start) + 1
+
+    def install(self):
+        self._previous = (self._logger.level, get_gdal_config("CPL_DEBUG"))
+        self._logger.setLevel(logging.DEBUG)
+        self._logger.addHandler(self)
+        # Only in rasterio's GDAL: not in the one pyogrio may bring, nor in the workers
+        set_gdal_config("CPL_DEBUG", "ON")
+
+    def uninstall(self):
+        (level, cpl_debug) = self._previous
+        self._logger.removeHandler(self)
+        self._logger.setLevel(level)
+        set_gdal_config("CPL_DEBUG", cpl_debug if cpl_debug is not None else False)
+
+class Instrumentation:
+    """
+    The stage timers and counters of one run (e.g. of patch_utils.main)
+
+    Stages and counters have a name and optionally labels, e.g.
+        with instrumentation.stage("extract", phase = "pre"):
+            ...
+        instrumentation.count("patches_written", 120, phase = "pre")
+
+    If path is given, the metrics are written to it: as JSON lines (one line per
+    stage as soon as it ends, then one per counter when the run ends, appended
+    to the file) or in the Prometheus text format (the whole run, written when
+    it ends, e.g. for node_exporter's textfile collector)
+    """
+    def __init__(self, name, path = None, metrics_format = None, io_stats = False):
+        """
+        PARAMETERS:
+        ---
+            name: the name of the run
+            path: where to write the metrics, None not to write them
+            metrics_format: "jsonl" or "prometheus", by default from the extension of path
+                (see get_metrics_format)
+            io_stats: whether or not to count GDAL's I/O (see GdalIOStats)
+        """
+        self.name = name
+        self.path = path
+        self.metrics_format = metrics_format if metrics_format is not None or path is None else get_metrics_format(path)
+        if self.metrics_format not in [None, "jsonl", "prometheus"]:
+            raise ValueError(f"Unknown metrics format {self.metrics_format}")
+        # (name, labels) -> [seconds, calls]
+        self.timers = dict()
+        # (name, labels) -> value
+        self.counters = dict()
+        self.io_stats = GdalIOStats() if io_stats else None
+        self._lock = threading.Lock()
+        # The stages being timed in every thread
+        self._local = threading.local()
+        self._start = time.perf_counter()
+        self.seconds = None
+        if self.io_stats is not None:
+            self.io_stats.install()
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """
+        Times what runs inside it. A stage within another one is named after
+        both, e.g. "vector-data/trim"
+        """
+        parents = getattr(self._local, "stages", [])
+        name = "/".join(parents + [name])
+        self._local.stages = name.split("/")
+        key = (name, tuple(sorted(labels.items())))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._local.stages = parents
+            with self._lock:
+                timer = self.timers.setdefault(key, [0.0, 0])
+                timer[0] += seconds
+                timer[1] += 1
+            self._write_lines([{"type": "stage", "stage": name, "labels": labels, "seconds": seconds}])
+
+    def count(self, name, value = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_counts(self, counts: dict, **labels):
+        """
+        Adds every name: value of counts (e.g. the read stats of extraction_utils)
+        """
+        for (name, value) in counts.items():
+            self.count(name, value, **labels)
+
+    def get(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def close(self):
+        """
+        Ends the run and writes the counters
+        """
+        self.seconds = time.perf_counter() - self._start
+        if self.io_stats is not None:
+            self.io_stats.uninstall()
+            self.add_counts(self.io_stats.counts)
+        if self.metrics_format == "jsonl":
+            self._write_lines(
+                [{"type": "counter", "counter": name, "labels": dict(labels), "value": value}
+                    for ((name, labels), value) in sorted(self.counters.items())]
+                + [{"type": "run", "seconds": self.seconds}]
+            )
+        elif self.metrics_format == "prometheus":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+            with open(self.path, "w") as f:
+                f.write(self.to_prometheus())
+
+    def _write_lines(self, entries):
+        if self.metrics_format != "jsonl":
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+            with open(self.path, "a") as f:
+                for entry in entries:
+                    f.write(json.dumps({"run": self.name, "time": time.time(), **entry}) + "\n")
+
+    def to_prometheus(self) -> str:
+        lines = []
+        run = (("run", self.name),)
+        for (metric, help, values) in [
+            ("stage_seconds", "Wall time spent in the stage", {key: timer[0] for (key, timer) in self.timers.items()}),
+            ("stage_calls", "Number of times the stage ran", {key: timer[1] for (key, timer) in self.timers.items()}),
+        ]:
+            lines += [f"# HELP {METRICS_PREFIX}{metric} {help}", f"# TYPE {METRICS_PREFIX}{metric} gauge"]
+            for ((name, labels), value) in sorted(values.items()):
+                lines.append(f"{METRICS_PREFIX}{metric}{format_labels(run + (('stage', name),) + labels)} {value}")
+        names = sorted(set(name for (name, _) in self.counters.keys()))
+        for name in names:
+            metric = METRICS_PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+            lines.append(f"# TYPE {metric} gauge")
+            for ((other, labels), value) in sorted(self.counters.items()):
+                if other == name:
+                    lines.append(f"{metric}{format_labels(run + labels)} {value}")
+        if self.seconds is not None:
+            lines += [f"# TYPE {METRICS_PREFIX}run_seconds gauge", f"{METRICS_PREFIX}run_seconds{format_labels(run)} {self.seconds}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """
+        RETURNS:
+        ---
+            A table of the time spent in every stage and of the counters
+        """
+        total = self.seconds if self.seconds is not None else time.perf_counter() - self._start
+        width = max([len(name + format_labels(labels)) for (name, labels) in list(self.timers) + list(self.counters)] + [20])
+        lines = [f"{'Stage':<{width}} {'calls':>7} {'seconds':>10} {'share':>7}"]
+        for ((name, labels), (seconds, calls)) in self.timers.items():
+            lines.append(f"{name + format_labels(labels):<{width}} {calls:>7} {seconds:10.2f} {seconds / max(total, 1e-9):7.1%}")
+        lines.append(f"{'total':<{width}} {'':>7} {total:10.2f}")
+        if len(self.counters) > 0:
+            lines.append(f"{'Counter':<{width}} {'value':>7}")
+            for ((name, labels), value) in self.counters.items():
+                lines.append(f"{name + format_labels(labels):<{width}} {value:>7}")
+        return "\n".join(lines)
+
+# The run being instrumented in this process, if any
+_instrumentation: Optional[Instrumentation] = None
+
+def get_instrumentation() -> Optional[Instrumentation]:
+    return _instrumentation
+
+@contextmanager
+def instrumented_run(name, toprint = True, metrics = None, io_stats = False):
+    """
+    Instruments everything run inside it: stage() and count() go to its
+    Instrumentation, and a summary table is printed at the end
+
+    Inside another instrumented run, it is only a stage of that run:
+    e.g. combine_all_vector_data_and_save_for_hurricane within patch_utils.main
+
+    PARAMETERS:
+    ---
+        metrics: where to write the metrics, see Instrumentation
+        io_stats: whether or not to count GDAL's I/O, see GdalIOStats
+
+    YIELDS:
+    ---
+        The Instrumentation of the run
+    """
+    global _instrumentation
+    if _instrumentation is not None:
+        with _instrumentation.stage(name):
+            yield _instrumentation
+        return
+    _instrumentation = Instrumentation(name, metrics, io_stats = io_stats)
+    try:
+        yield _instrumentation
+    finally:
+        (instrumentation, _instrumentation) = (_instrumentation, None)
+        instrumentation.close()
+        print_message(toprint, instrumentation.summary())
+
+@contextmanager
+def stage(name, **labels):
+    """
+    Times what runs inside it as a stage of the current run (nothing if there is none)
+    """
+    if _instrumentation is None:
+        yield
+        return
+    with _instrumentation.stage(name, **labels):
+        yield
+
+def count(name, value = 1, **labels):
+    """
+    Adds value to a counter of the current run (nothing if there is none)
+    """
+    if _instrumentation is not None:
+        _instrumentation.count(name, value, **labels)
+
+def add_counts(counts: dict, **labels):
+    if _instrumentation is not None:
+        _instrumentation.add_counts(counts, **labels)
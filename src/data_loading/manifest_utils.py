@@ -0,0 +1,238 @@
+# On-disk manifest
+import sqlite3
+import hashlib
+import json
+import time
+from contextlib import closing
+
+# Others
+from typing import List
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.extraction_utils import extract_patches_by_scene, PatchFilter, GTiffSink
+from data_loading.patch_codec_utils import PatchEncoding
+
+MANIFEST_FILENAME = "manifest.sqlite"
+# The filter every patch was cut with before the filter was part of the fingerprints:
+# the fingerprints of the jobs cut with it stay as they were
+UNFILTERED = PatchFilter(max_nodata = 1.0, boundless = "clip")
+
+def get_job_key(x, y, link, dist) -> str:
+    """
+    What a job is: the patch of a given size around a given point in a given scene
+    """
+    return f"{x:.9f},{y:.9f}|{link}|{dist}"
+
+def get_job_fingerprint(job, record, patch_filter: PatchFilter = None, encoding: PatchEncoding = None) -> str:
+    """
+    How a job is done: if the output path, the window, the header of the
+    scene, the patch filter or the encoding of the file changes, the
+    fingerprint changes and the patch has to be cut again
+    """
+    window = (job.window.col_off, job.window.row_off, job.window.width, job.window.height)
+    content = [job.path, [float(v) for v in window], list(record.transform), record.crs]
+    if patch_filter is None:
+        patch_filter = PatchFilter()
+    if patch_filter != UNFILTERED:
+        content.append(list(patch_filter))
+    # So does the default encoding
+    if encoding is not None and encoding != PatchEncoding():
+        content.append(list(encoding))
+    content = json.dumps(content)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+class PatchManifest:
+    """
+    A SQLite record of every patch job: its status ("done", "empty" if the
+    patch was skipped so nothing was written, or "failed"), output path,
+    fingerprint and the hash of the patch written
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, phase TEXT, path TEXT, "
+                "fingerprint TEXT, status TEXT, hash TEXT, error TEXT, updated REAL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout = 60)
+
+    def get(self, keys: List) -> dict:
+        """
+        RETURNS:
+        ---
+            A dictionary from key to (path, fingerprint, status, hash), for the keys in the manifest
+        """
+        keys = set(keys)
+        res = dict()
+        with closing(self._connect()) as conn:
+            for row in conn.execute("SELECT key, path, fingerprint, status, hash FROM jobs"):
+                if row[0] in keys:
+                    res[row[0]] = row[1:]
+        return res
+
+    def summary(self) -> dict:
+        """
+        RETURNS:
+        ---
+            A dictionary from phase to a dictionary from status to the number of jobs
+        """
+        res = dict()
+        with closing(self._connect()) as conn:
+            for (phase, status, count) in conn.execute("SELECT phase, status, COUNT(*) FROM jobs GROUP BY phase, status"):
+                res.setdefault(phase, dict())[status] = count
+        return res
+
+    def get_paths(self, phase = None) -> dict:
+        """
+        RETURNS:
+        ---
+            A dictionary from key to output path, for the jobs of phase in the manifest
+        """
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT key, path FROM jobs WHERE phase IS ?", (phase,)))
+
+    def remove(self, keys: List):
+        """
+        Forgets the jobs with the given keys
+        """
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("DELETE FROM jobs WHERE key = ?", [(key,) for key in keys])
+
+    def record(self, entries: List):
+        """
+        entries: a list of (key, phase, path, fingerprint, status, hash, error)
+        """
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [tuple(entry) + (now,) for entry in entries],
+            )
+
+def find_outstanding_jobs(manifest: PatchManifest, jobs: List, records: List, xs, ys, dist, patch_filter: PatchFilter = None, encoding: PatchEncoding = None) -> tuple:
+    """
+    Compares the planned jobs with the manifest
+
+    RETURNS:
+    ---
+        (outstanding, keys, fingerprints, summary):
+        outstanding: the jobs that still have to be done
+        keys, fingerprints: dictionaries from each job to its key and fingerprint
+        summary: number of jobs that are done, new, changed (fingerprint differs),
+            failed (last attempt failed) or missing (done, but the output file is gone)
+    """
+    keys = dict()
+    fingerprints = dict()
+    for job in jobs:
+        record = records[job.scene_idx]
+        keys[job] = get_job_key(xs[job.point_idx], ys[job.point_idx], record.link, dist)
+        fingerprints[job] = get_job_fingerprint(job, record, patch_filter, encoding)
+    known = manifest.get(list(keys.values()))
+    summary = {"done": 0, "new": 0, "changed": 0, "failed": 0, "missing": 0}
+    outstanding = []
+    for job in jobs:
+        entry = known.get(keys[job])
+        if entry is None:
+            state = "new"
+        elif entry[1] != fingerprints[job]:
+            state = "changed"
+        elif entry[2] == "failed":
+            state = "failed"
+        elif entry[2] == "done" and not os.path.isfile(entry[0]):
+            state = "missing"
+        else:
+            state = "done"
+        summary[state] += 1
+        if state != "done":
+            outstanding.append(job)
+    return (outstanding, keys, fingerprints, summary)
+
+def remove_stale_outputs(manifest: PatchManifest, jobs: List, keys: dict, phase = None) -> int:
+    """
+    Removes what earlier runs left of jobs of phase that are no longer planned
+    (e.g. points dropped from the vector data): their rows in the manifest and
+    their files. Also removes the files of planned jobs saved under another
+    path than they are now (e.g. renumbered points). A file a planned job is
+    saved at is never removed
+
+    RETURNS:
+    ---
+        The number of files removed
+    """
+    current = {keys[job]: job.path for job in jobs}
+    paths = set(current.values())
+    known = manifest.get_paths(phase)
+    manifest.remove([key for key in known if key not in current])
+    removed = 0
+    for (key, path) in known.items():
+        if current.get(key) != path and path not in paths and os.path.isfile(path):
+            os.remove(path)
+            removed += 1
+    return removed
+
+def extract_patches_with_manifest(records: List, jobs: List, xs, ys, dist, manifest: PatchManifest, phase = None, toprint = True, workers = 1, dry_run = False, patch_filter: PatchFilter = None, stats: dict = None, sink = None, encoding: PatchEncoding = None) -> dict:
+    """
+    Resumable version of extract_patches_by_scene: jobs that the manifest
+    records as done (with the same fingerprint, and whose file still exists)
+    are skipped, everything else is (re)done and recorded as it finishes.
+    The outputs of jobs that are no longer planned are removed (see
+    remove_stale_outputs), and so are the earlier outputs of jobs that are
+    now skipped or fail
+
+    PARAMETERS:
+    ---
+        records: a list of SceneMetadata, jobs[k].scene_idx indexes into it
+        jobs: a list of PatchJob, e.g. from plan_patch_jobs
+        xs, ys, dist: the points and the distance the jobs were planned with
+        manifest: the PatchManifest to read and update
+        dry_run: if True, only report how much work is outstanding
+        patch_filter: which patches to skip, see extraction_utils.PatchFilter
+        stats: if given, a dictionary the read counts are added to (see extraction_utils.iter_patches_from_dataset)
+        sink: where the patches go, by default a GTiffSink with encoding (it must save them at job.path)
+        encoding: how the patches are saved, see patch_codec_utils.PatchEncoding;
+            the patches saved differently by an earlier run are cut again
+
+    RETURNS:
+    ---
+        The summary from find_outstanding_jobs, plus "written" and "errors"
+        (the number of patches written and of jobs that failed in this run)
+        and "removed" (the number of stale files removed)
+    """
+    (outstanding, keys, fingerprints, summary) = find_outstanding_jobs(manifest, jobs, records, xs, ys, dist, patch_filter, encoding)
+    print_message(toprint, f"{len(outstanding)}/{len(jobs)} {phase or ''} patches outstanding: " +
+        ", ".join(f"{count} {state}" for (state, count) in summary.items()))
+    summary["written"] = 0
+    summary["errors"] = 0
+    summary["removed"] = 0
+    if dry_run:
+        return summary
+    summary["removed"] = remove_stale_outputs(manifest, jobs, keys, phase)
+    if len(outstanding) == 0:
+        return summary
+
+    def on_done(unit_jobs, hashes, error):
+        entries = []
+        for (i, job) in enumerate(unit_jobs):
+            if error is not None:
+                entries.append((keys[job], phase, job.path, fingerprints[job], "failed", None, error))
+                summary["errors"] += 1
+            else:
+                status = "done" if hashes[i] is not None else "empty"
+                entries.append((keys[job], phase, job.path, fingerprints[job], status, hashes[i], None))
+            if entries[-1][4] != "done" and os.path.isfile(job.path):
+                # Left by an earlier run, it is not what this job would write now
+                os.remove(job.path)
+        manifest.record(entries)
+
+    if sink is None:
+        sink = GTiffSink(encoding)
+    links = [record.link for record in records]
+    summary["written"] = extract_patches_by_scene(
+        links, outstanding, toprint, workers = workers, sink = sink, on_done = on_done, patch_filter = patch_filter, stats = stats
+    )
+    return summary
@@ -0,0 +1,101 @@
+# How the patches are encoded in their GeoTIFFs
+import numpy as np
+
+# Others
+from typing import NamedTuple, Optional
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+
+# Lossless codecs the patches can be compressed with; levels are those of
+# GDAL's ZLEVEL (deflate) and ZSTD_LEVEL (zstd), lzw and webp have none
+PATCH_CODECS = ["none", "deflate", "zstd", "lzw", "webp"]
+# How the pixels are laid out in the file: in rows of strips (as GDAL writes them
+# by default), in square tiles, or as a Cloud Optimized GeoTIFF (tiles, with
+# the headers first so that a remote reader gets them with one request)
+PATCH_LAYOUTS = ["strips", "tiles", "cog"]
+
+class PatchEncoding(NamedTuple):
+    """
+    How the patches are saved, see get_creation_options
+
+    codec: one of PATCH_CODECS. Integer patches are compressed with a horizontal
+        predictor, floating point ones with a floating point predictor.
+        webp only encodes 3 or 4 bands of 8 bit pixels, other patches
+        are compressed with deflate instead
+    level: the compression level of deflate (1 to 9) or zstd (1 to 22), None for GDAL's default
+    layout: one of PATCH_LAYOUTS
+    tile_size: width and height of the tiles (a multiple of 16); patches smaller than
+        a tile get a single tile just big enough for them (at least 128 pixels across for cog)
+    """
+    codec: str = "none"
+    level: Optional[int] = None
+    layout: str = "strips"
+    tile_size: int = PATCH_TILE_SIZE
+
+def get_encoding(codec = "none", level = None, layout = None, tile_size = PATCH_TILE_SIZE) -> PatchEncoding:
+    """
+    A checked PatchEncoding; the layout is tiles for compressed patches
+    and strips for uncompressed ones unless given
+    """
+    if codec not in PATCH_CODECS:
+        raise ValueError(f"Unknown codec {codec}, choose from {', '.join(PATCH_CODECS)}")
+    if layout is None:
+        layout = "strips" if codec == "none" else "tiles"
+    if layout not in PATCH_LAYOUTS:
+        raise ValueError(f"Unknown layout {layout}, choose from {', '.join(PATCH_LAYOUTS)}")
+    if tile_size <= 0 or tile_size % 16 != 0:
+        raise ValueError(f"The tile size must be a positive multiple of 16, not {tile_size}")
+    return PatchEncoding(codec, level, layout, tile_size)
+
+def get_tile_size(shape: tuple, tile_size = PATCH_TILE_SIZE) -> int:
+    """
+    The size of the tiles of a (bands, height, width) patch: tile_size,
+    or less if a single smaller tile (a multiple of 16) covers the patch
+    """
+    return min(tile_size, -(-max(shape[1], shape[2]) // 16) * 16)
+
+def get_codec(encoding: PatchEncoding, data: np.ndarray) -> str:
+    """
+    The codec a patch is compressed with: encoding.codec if it can encode the patch
+    """
+    if encoding.codec == "webp" and (data.dtype != np.uint8 or data.shape[0] not in [3, 4]):
+        return "deflate"
+    return encoding.codec
+
+def get_creation_options(encoding: PatchEncoding, data: np.ndarray) -> dict:
+    """
+    The driver and creation options of rio.open to save the (bands, height, width)
+    patch data with encoding; an empty dictionary for the default GeoTIFF
+    """
+    if encoding is None or encoding == PatchEncoding():
+        return dict()
+    codec = get_codec(encoding, data)
+    tile_size = get_tile_size(data.shape, encoding.tile_size)
+    predictor = 3 if np.issubdtype(data.dtype, np.floating) else 2
+    if encoding.layout == "cog":
+        # The COG driver has its own names for the options, and tiles of at least 128 pixels
+        options = {"driver": "COG", "blocksize": max(tile_size, 128), "overviews": "none", "compress": codec}
+        if codec == "webp":
+            options["quality"] = 100
+        elif codec != "none":
+            options["predictor"] = predictor
+        if encoding.level is not None and codec in ["deflate", "zstd"]:
+            options["level"] = encoding.level
+        return options
+    options = {"driver": "GTiff"}
+    if encoding.layout == "tiles":
+        options.update(tiled = True, blockxsize = tile_size, blockysize = tile_size)
+    if codec == "none":
+        return options
+    options["compress"] = codec
+    if codec == "webp":
+        options["webp_lossless"] = True
+    else:
+        options["predictor"] = predictor
+    if encoding.level is not None and codec == "deflate":
+        options["zlevel"] = encoding.level
+    elif encoding.level is not None and codec == "zstd":
+        options["zstd_level"] = encoding.level
+    return options
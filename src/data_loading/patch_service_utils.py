@@ -0,0 +1,355 @@
+# Handle tif files
+import rasterio as rio
+from rasterio.io import MemoryFile
+import numpy as np
+
+# Serving patches over HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import json
+import io
+
+# Caching and timing
+from collections import OrderedDict, deque
+import threading
+import time
+
+# Others
+from typing import List
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.footprint_utils import FootprintIndex
+from data_loading.range_cache_utils import open_scene
+from data_loading.extraction_utils import Patch, PatchFilter, plan_patch_jobs, iter_patches_from_dataset, MAX_OPEN_DATASETS
+
+PHASES = ["pre", "post"]
+
+def get_latency_percentiles(seconds, percentiles = (50, 90, 99)) -> dict:
+    """
+    RETURNS:
+    ---
+        A dictionary with p50_ms, p90_ms, ... and max_ms: the percentiles of the
+        latencies seconds, in milliseconds (all None if there is none)
+    """
+    seconds = np.asarray(seconds, dtype = float)
+    if len(seconds) == 0:
+        return {**{f"p{p}_ms": None for p in percentiles}, "max_ms": None}
+    res = {f"p{p}_ms": float(value) * 1000 for (p, value) in zip(percentiles, np.percentile(seconds, percentiles))}
+    res["max_ms"] = float(seconds.max()) * 1000
+    return res
+
+def patch_to_geotiff(patch: Patch) -> bytes:
+    """
+    The patch as the bytes of a GeoTIFF, the same file write_patch would save
+    """
+    (count, height, width) = patch.data.shape
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver = "GTiff", width = width, height = height, count = count,
+            transform = patch.transform, crs = patch.crs, dtype = patch.data.dtype,
+        ) as dst:
+            dst.write(patch.data)
+        return memfile.read()
+
+def patch_to_npy(patch: Patch) -> bytes:
+    """
+    The pixels of the patch as the bytes of a .npy file
+    """
+    buffer = io.BytesIO()
+    np.save(buffer, patch.data)
+    return buffer.getvalue()
+
+def describe_patch(patch: Patch) -> dict:
+    """
+    Everything about the patch but its pixels, as a JSON-friendly dictionary
+    """
+    return {
+        "seq": patch.seq,
+        "link": patch.link,
+        "shape": list(patch.data.shape),
+        "dtype": str(patch.data.dtype),
+        "transform": list(patch.transform)[:6],
+        "crs": None if patch.crs is None else patch.crs.to_string(),
+    }
+
+class ServiceDataset:
+    """
+    A dataset of a PatchService, opened when it is first read. Its lock is held
+    while it is opened, read or closed, as a dataset cannot be used by two threads at once
+    """
+    def __init__(self, link):
+        self.link = link
+        self.src = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            if self.src is not None:
+                self.src.close()
+            self.closed = True
+
+class PatchService:
+    """
+    Crops the patches around a single point on demand, e.g. to look at the
+    imagery of one building without running patch_utils.main over the whole hurricane
+
+    The scenes containing the point are found with a FootprintIndex, without
+    opening anything; the datasets opened stay open for the next queries (the
+    max_open_datasets most recently used ones), and the patches of the
+    max_queries most recent queries are kept in memory. The latency of every
+    query is recorded, see latency_stats
+
+    Queries can come from several threads (see make_patch_server). A dataset is
+    read by one thread at a time, but the service only waits for the datasets
+    a query reads: queries answered from the cache never wait for a slow read
+    """
+    def __init__(self, records: dict, patch_filter: PatchFilter = None, max_queries = PATCH_SERVICE_MAX_QUERIES,
+            max_open_datasets = MAX_OPEN_DATASETS, max_latencies = PATCH_SERVICE_MAX_LATENCIES):
+        """
+        PARAMETERS:
+        ---
+            records: a dictionary with keys pre and post, the lists of SceneMetadata
+                of the scenes of each phase (e.g. from get_scene_metadata_for_hurricane)
+            patch_filter: which patches to skip, see extraction_utils.PatchFilter
+            max_queries: number of queries whose patches are kept in memory
+            max_open_datasets: number of datasets kept open
+            max_latencies: number of latencies (the most recent ones) the percentiles are computed on
+        """
+        self.records = {phase: list(records.get(phase, [])) for phase in PHASES}
+        self.indexes = {phase: FootprintIndex([record.bounds for record in self.records[phase]]) for phase in PHASES}
+        self.patch_filter = PatchFilter() if patch_filter is None else patch_filter
+        self.max_queries = max_queries
+        self.max_open_datasets = max_open_datasets
+        # (phase, lat, lon, dist) -> list of Patch, most recently used last
+        self._patches = OrderedDict()
+        # link -> open dataset, most recently used last
+        self._datasets = OrderedDict()
+        self._latencies = deque(maxlen = max_latencies)
+        self.counts = {"queries": 0, "cache_hits": 0, "scenes_opened": 0, "patches_read": 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_hurricane(cls, hurricane_name = DEFAULT_HURRICANE, toprint = True, **kwargs) -> "PatchService":
+        """
+        A PatchService over the tidied scenes of the hurricane (see tif_links_utils);
+        kwargs are passed on to PatchService
+        """
+        from data_loading.tif_links_utils import get_scene_metadata_for_hurricane
+        return cls(get_scene_metadata_for_hurricane(hurricane_name, toprint), **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            datasets = list(self._datasets.values())
+            self._datasets.clear()
+            self._patches.clear()
+        for dataset in datasets:
+            dataset.close()
+
+    def _get_dataset(self, link) -> ServiceDataset:
+        evicted = []
+        with self._lock:
+            if link in self._datasets:
+                self._datasets.move_to_end(link)
+            else:
+                while len(self._datasets) >= self.max_open_datasets:
+                    evicted.append(self._datasets.popitem(last = False)[1])
+                self._datasets[link] = ServiceDataset(link)
+            dataset = self._datasets[link]
+        # Closing waits for the reads of the evicted datasets to finish
+        for other in evicted:
+            other.close()
+        return dataset
+
+    def _read(self, job, link, lon, lat) -> List:
+        while True:
+            dataset = self._get_dataset(link)
+            with dataset.lock:
+                if dataset.closed:
+                    # Evicted by another query before it could be read, open it again
+                    continue
+                if dataset.src is None:
+                    dataset.src = open_scene(link)
+                    with self._lock:
+                        self.counts["scenes_opened"] += 1
+                src = dataset.src
+                patches = []
+                for (_, data, transform) in iter_patches_from_dataset(src, [job], patch_filter = self.patch_filter):
+                    # The patches are shared by every query hitting the cache
+                    data.setflags(write = False)
+                    patches.append(Patch(job.point_idx, job.seq, lon, lat, link, data, transform, src.crs))
+                return patches
+
+    def _crop(self, lat, lon, dist, phase) -> List:
+        records = self.records[phase]
+        jobs = plan_patch_jobs(records, [lon], [lat], dist, None, self.indexes[phase])
+        patches = []
+        with rio.Env(**GDAL_REMOTE_OPTIONS):
+            for job in jobs:
+                patches.extend(self._read(job, records[job.scene_idx].link, lon, lat))
+        with self._lock:
+            self.counts["patches_read"] += len(patches)
+        return patches
+
+    def get_patches(self, lat, lon, dist = 20, phase = "post") -> List:
+        """
+        PARAMETERS:
+        ---
+            lat, lon: the point, in degrees
+            dist: distance in meters from the point to each edge of the patches
+            phase: "pre" or "post"
+
+        RETURNS:
+        ---
+            A list of Patch (read-only arrays), one per scene of the phase
+            containing the point, numbered like the patches of patch_utils.main
+            (seq 1, 2, ... in the order of the scenes); patches skipped by
+            patch_filter are left out
+        """
+        if phase not in PHASES:
+            raise ValueError(f"Unknown phase {phase}")
+        start = time.perf_counter()
+        # About 1cm, so that the same building always hits the cache
+        key = (phase, round(float(lat), 7), round(float(lon), 7), float(dist))
+        with self._lock:
+            self.counts["queries"] += 1
+            patches = self._patches.get(key)
+            if patches is not None:
+                self._patches.move_to_end(key)
+                self.counts["cache_hits"] += 1
+        if patches is None:
+            # Concurrent queries for the same point may both crop it, the patches are the same
+            patches = self._crop(float(lat), float(lon), float(dist), phase)
+        with self._lock:
+            self._patches[key] = patches
+            self._patches.move_to_end(key)
+            if len(self._patches) > self.max_queries:
+                self._patches.popitem(last = False)
+            self._latencies.append(time.perf_counter() - start)
+        return patches
+
+    def get_geotiffs(self, lat, lon, dist = 20, phase = "post") -> List:
+        """
+        Same as get_patches, but every patch is returned as the bytes of a GeoTIFF
+        """
+        return [patch_to_geotiff(patch) for patch in self.get_patches(lat, lon, dist, phase)]
+
+    def latency_stats(self) -> dict:
+        """
+        RETURNS:
+        ---
+            The counts of the service (queries, cache_hits, scenes_opened, patches_read),
+            the number of queries cached and of datasets open, and the percentiles of the
+            latencies of the most recent queries (see get_latency_percentiles)
+        """
+        with self._lock:
+            res = dict(self.counts)
+            res["cached_queries"] = len(self._patches)
+            res["open_datasets"] = len(self._datasets)
+            latencies = list(self._latencies)
+        res.update(get_latency_percentiles(latencies))
+        return res
+
+def format_latency_stats(stats: dict) -> str:
+    if stats["queries"] == 0:
+        return "No queries yet"
+    return (
+        f"{stats['queries']} queries ({stats['cache_hits']} from the cache), {stats['scenes_opened']} scenes opened, "
+        f"latency p50 {stats['p50_ms']:.1f}ms, p90 {stats['p90_ms']:.1f}ms, p99 {stats['p99_ms']:.1f}ms, max {stats['max_ms']:.1f}ms"
+    )
+
+class PatchRequestHandler(BaseHTTPRequestHandler):
+    """
+    The routes of make_patch_server:
+        GET /patches?lat=..&lon=..[&dist=20][&phase=post]: the patches around the point,
+            as a JSON list of describe_patch (dist is at most PATCH_SERVICE_MAX_DIST meters)
+        GET /patch?lat=..&lon=..&seq=1[&dist=20][&phase=post][&format=tif]: one of them,
+            as a GeoTIFF (format=tif) or a .npy file (format=npy)
+        GET /stats: the latency stats of the service, as JSON
+    """
+    def log_message(self, format, *args):
+        if self.server.toprint:
+            super().log_message(format, *args)
+
+    def _send(self, status, body: bytes, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, value):
+        self._send(status, json.dumps(value).encode(), "application/json")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for (name, values) in parse_qs(url.query).items()}
+        service = self.server.service
+        if url.path == "/stats":
+            self._send_json(200, service.latency_stats())
+            return
+        if url.path not in ["/patches", "/patch"]:
+            self._send_json(404, {"error": f"Unknown path {url.path}"})
+            return
+        try:
+            (lat, lon) = (float(params["lat"]), float(params["lon"]))
+            dist = float(params.get("dist", 20))
+            phase = params.get("phase", "post")
+            seq = int(params.get("seq", 1))
+            output = params.get("format", "tif")
+            if phase not in PHASES or output not in ["tif", "npy"]:
+                raise ValueError(f"Unknown phase {phase} or format {output}")
+            if not (np.isfinite(lat) and np.isfinite(lon) and 0 < dist <= PATCH_SERVICE_MAX_DIST):
+                raise ValueError(f"dist must be between 0 and {PATCH_SERVICE_MAX_DIST} meters, around a finite point")
+        except (KeyError, ValueError) as e:
+            self._send_json(400, {"error": f"Bad query: {e}"})
+            return
+        try:
+            patches = service.get_patches(lat, lon, dist, phase)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        if url.path == "/patches":
+            self._send_json(200, [describe_patch(patch) for patch in patches])
+            return
+        matching = [patch for patch in patches if patch.seq == seq]
+        if len(matching) == 0:
+            self._send_json(404, {"error": f"No patch {seq} around ({lat}, {lon})"})
+        elif output == "tif":
+            self._send(200, patch_to_geotiff(matching[0]), "image/tiff")
+        else:
+            self._send(200, patch_to_npy(matching[0]), "application/octet-stream")
+
+def make_patch_server(service: PatchService, host = "127.0.0.1", port = PATCH_SERVICE_PORT, toprint = False) -> ThreadingHTTPServer:
+    """
+    An HTTP server answering queries with service (see PatchRequestHandler for
+    the routes); port 0 picks a free port, see server.server_address.
+    Call serve_forever() to start it and shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), PatchRequestHandler)
+    server.service = service
+    server.toprint = toprint
+    return server
+
+def serve_patches(hurricane_name = DEFAULT_HURRICANE, toprint = True, host = "127.0.0.1", port = PATCH_SERVICE_PORT,
+        max_nodata = PATCH_MAX_NODATA, boundless = "clip", max_queries = PATCH_SERVICE_MAX_QUERIES):
+    """
+    Serves the patches of the hurricane over HTTP until interrupted, then prints the latency stats
+    """
+    service = PatchService.for_hurricane(hurricane_name, toprint, patch_filter = PatchFilter(max_nodata, boundless), max_queries = max_queries)
+    with service, make_patch_server(service, host, port, toprint) as server:
+        (host, port) = server.server_address[:2]
+        print_message(toprint, f"Serving the patches of {hurricane_name} on http://{host}:{port}/patches?lat=..&lon=..")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        print_message(toprint, format_latency_stats(service.latency_stats()))
@@ -0,0 +1,174 @@
+# Handle tif files
+import rasterio as rio
+from rasterio.crs import CRS
+import affine
+import numpy as np
+import pandas as pd
+
+# Others
+from typing import List
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.extraction_utils import get_pixel_indices, get_patch_transform, PatchFilter
+
+def get_patch_store_paths(path_to_store) -> tuple:
+    """
+    An array store is two files next to each other:
+        <path_to_store>.npy: all the patches, as one (N, bands, H, W) array
+        <path_to_store>.parquet: one row of metadata per patch
+
+    RETURNS:
+    ---
+        (path to the .npy file, path to the .parquet file)
+    """
+    return (path_to_store + ".npy", path_to_store + ".parquet")
+
+class ArraySink:
+    """
+    Writes patches into row job.idx of the .npy file of an array store,
+    top-left aligned and padded with zeros. The file is memory-mapped, so
+    several worker processes can fill in their own rows at the same time
+    """
+    def __init__(self, npy_path):
+        self.npy_path = npy_path
+        self._array = None
+
+    def __getstate__(self):
+        # Each process maps the file itself
+        return {"npy_path": self.npy_path, "_array": None}
+
+    def write(self, job, data: np.ndarray, transform, crs):
+        if self._array is None:
+            self._array = np.load(self.npy_path, mmap_mode = "r+")
+        (count, height, width) = data.shape
+        self._array[job.idx, :count, :height, :width] = data
+
+def create_patch_store(path_to_store, records: List, jobs: List, phase = None, patch_filter: PatchFilter = None) -> tuple:
+    """
+    Allocates an array store for the patches of jobs and saves its index.
+    Everything in the index (size, transform, crs, ...) is known from the
+    plan, so no scene has to be opened here
+
+    PARAMETERS:
+    ---
+        path_to_store: where to save the store, without extension
+        records: a list of SceneMetadata, jobs[k].scene_idx indexes into it
+        jobs: a list of PatchJob, e.g. from plan_patch_jobs
+        phase: "pre" or "post", saved in the index
+        patch_filter: the PatchFilter the patches will be extracted with
+
+    RETURNS:
+    ---
+        (sink, jobs): an ArraySink to extract into, and the jobs to extract,
+        numbered by their row in the store (empty patches are dropped; the rows
+        of the patches skipped because of nodata are left as zeros). The "written"
+        column of the index is False until save_written_patches is called
+    """
+    if patch_filter is None:
+        patch_filter = PatchFilter()
+    (npy_path, index_path) = get_patch_store_paths(path_to_store)
+    os.makedirs(os.path.dirname(os.path.abspath(npy_path)), exist_ok = True)
+    kept, rows = [], []
+    for job in jobs:
+        record = records[job.scene_idx]
+        (pixel_rows, pixel_cols) = get_pixel_indices(job.window, record.width, record.height, patch_filter.boundless)
+        if len(pixel_rows) == 0 or len(pixel_cols) == 0:
+            continue
+        job = job._replace(idx = len(kept))
+        kept.append(job)
+        transform = get_patch_transform(job.window, record.affine, record.width, record.height, patch_filter.boundless)
+        row = {
+            "patch_idx": job.idx,
+            "point_idx": job.point_idx,
+            "seq": job.seq,
+            "phase": phase,
+            "link": record.link,
+            "count": record.count,
+            "height": len(pixel_rows),
+            "width": len(pixel_cols),
+            "crs": record.crs,
+            "written": False,
+        }
+        for (name, value) in zip("abcdef", tuple(transform)[:6]):
+            row["transform_" + name] = value
+        rows.append(row)
+    index = pd.DataFrame(rows, columns = [
+        "patch_idx", "point_idx", "seq", "phase", "link", "count", "height", "width", "crs",
+        "transform_a", "transform_b", "transform_c", "transform_d", "transform_e", "transform_f", "written",
+    ])
+    used = [records[job.scene_idx] for job in kept]
+    dtype = np.result_type(*[record.dtype for record in used]) if len(used) > 0 else np.uint8
+    shape = (
+        len(kept),
+        int(index["count"].max()) if len(kept) > 0 else 0,
+        int(index["height"].max()) if len(kept) > 0 else 0,
+        int(index["width"].max()) if len(kept) > 0 else 0,
+    )
+    np.lib.format.open_memmap(npy_path, mode = "w+", dtype = dtype, shape = shape).flush()
+    index.to_parquet(index_path, index = False)
+    return (ArraySink(npy_path), kept)
+
+class WrittenPatches:
+    """
+    An on_done for extraction_utils.extract_patches_by_scene that collects the
+    rows of the store that were written, to be saved with save_written_patches.
+    A work unit that fails is raised, as it would be without on_done
+    """
+    def __init__(self):
+        self.idx = []
+
+    def __call__(self, jobs: List, hashes, error):
+        if error is not None:
+            raise Exception(f"Could not crop {len(jobs)} patches: {error}")
+        self.idx.extend(job.idx for (job, h) in zip(jobs, hashes) if h is not None)
+
+def save_written_patches(path_to_store, written: List):
+    """
+    Records which rows of the store hold a patch: the "written" column of the
+    index is True for the patch_idx in written, and False for the others
+    (the patches skipped because of nodata, whose rows are all zeros)
+    """
+    (_, index_path) = get_patch_store_paths(path_to_store)
+    index = pd.read_parquet(index_path)
+    index["written"] = index["patch_idx"].isin(set(written))
+    index.to_parquet(index_path, index = False)
+
+def load_patch_store_index(path_to_store, columns: List = None, written_only = False) -> pd.DataFrame:
+    """
+    The index of an array store, or some of its columns
+
+    PARAMETERS:
+    ---
+        written_only: if True, only the rows of the patches that were written
+            (stores saved before the "written" column existed are taken as fully written)
+    """
+    (_, index_path) = get_patch_store_paths(path_to_store)
+    index = pd.read_parquet(index_path)
+    if written_only and "written" in index:
+        index = index[index["written"].astype(bool)]
+    return index if columns is None else index[columns]
+
+def load_patch_store(path_to_store) -> tuple:
+    """
+    RETURNS:
+    ---
+        (patches, index): patches is a read-only memory-mapped (N, bands, H, W) array,
+        so slicing a batch out of it does not open any file;
+        index is a DataFrame with one row per patch
+    """
+    (npy_path, index_path) = get_patch_store_paths(path_to_store)
+    return (np.load(npy_path, mmap_mode = "r"), pd.read_parquet(index_path))
+
+def get_patch_from_store(patches: np.ndarray, index: pd.DataFrame, i) -> tuple:
+    """
+    RETURNS:
+    ---
+        (data, transform, crs) of patch i, without the padding
+    """
+    row = index.iloc[i]
+    data = np.asarray(patches[i, :row["count"], :row["height"], :row["width"]])
+    transform = affine.Affine(*[row["transform_" + name] for name in "abcdef"])
+    crs = CRS.from_wkt(row["crs"]) if row["crs"] is not None else None
+    return (data, transform, crs)
@@ -1,18 +1,28 @@
-from email import contentmanager
+import argparse
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from data_loading.utils import *
 from data_loading.tif_links_utils import *
 from data_loading.vector_data_utils import *
+from data_loading.extraction_utils import plan_patch_jobs, extract_patches_by_scene, iter_patches_by_scene, PATCH_PREFETCH
+from data_loading.extraction_utils import PatchFilter, get_patch_window, has_nodata, get_read_counters
+from data_loading.scene_selection_utils import SceneSelection, SCENE_POLICIES, SINGLE_PHASE_POLICIES, check_policy_for_phase
+from data_loading.patch_store_utils import create_patch_store, save_written_patches, WrittenPatches
+from data_loading.manifest_utils import PatchManifest, extract_patches_with_manifest, MANIFEST_FILENAME
+from data_loading.range_cache_utils import open_scene, set_range_cache, get_range_cache
+from data_loading.instrumentation_utils import instrumented_run, stage, count, add_counts
+from data_loading.band_stats_utils import BandStatsSink, compute_band_stats_for_files, save_band_stats
+from data_loading.extraction_utils import GTiffSink, write_patch
+from data_loading.patch_codec_utils import PatchEncoding, PATCH_CODECS, PATCH_LAYOUTS, get_encoding
 import rasterio as rio
-from rasterio.windows import from_bounds
+from rasterio.windows import from_bounds, Window
 from rasterio.io import MemoryFile
 from rasterio.crs import CRS
 import shapely
 from shapely.geometry.point import Point
 from shapely.geometry import box
-from typing import Counter, List
+from typing import List
 
 def get_indices_for_point(bounds_list: List, point: Point):
     """
@@ -38,7 +48,8 @@ def get_geom_for_point(point: Point, dist):
     Each edge is at a distance of dist meters from the point
     """
     deg = convert_meters_to_deg(dist)
-    left, right, top, bottom = (point.x - deg, point.x+deg, point.y+deg, point.y-deg)
+    deg_lon = convert_meters_to_deg_lon(dist, point.y)
+    left, right, top, bottom = (point.x - deg_lon, point.x+deg_lon, point.y+deg, point.y-deg)
     geodf = gpd.GeoDataFrame(
         geometry=[
             box(left, bottom, right, top)
@@ -56,7 +67,7 @@ def create_dataset(data:np.ndarray, crs:CRS, count:int, transform:affine.Affine)
   dataset.write(data)
   return dataset
 
-def crop_patches_for_point(links: List, bounds_list: List, point: Point, point_idx, dist, path_to_dir, toprint = True):
+def crop_patches_for_point(links: List, bounds_list: List, point: Point, point_idx, dist, path_to_dir, toprint = True, indices = None, patch_filter: PatchFilter = None, encoding: PatchEncoding = None):
     """
     PARAMETERS:
     ---
@@ -64,49 +75,106 @@ def crop_patches_for_point(links: List, bounds_list: List, point: Point, point_i
         bounds_list: a list of BoundingBox from rasterio.coords 
         point: the point that we want to crop patches for
         path_to_dir: path to the directory in which we will store all the patches
+        indices: indices of the bounds that contain the point, if already known
+            (e.g. from a FootprintIndex); otherwise they are found from bounds_list
+        patch_filter: which patches to skip, see extraction_utils.PatchFilter
+        encoding: how the patches are compressed and laid out, see patch_codec_utils.PatchEncoding
     """
+    if patch_filter is None:
+        patch_filter = PatchFilter()
     print_message(toprint, "Setting up...")
     geodf = get_geom_for_point(point, dist)
     (left, bottom, right, top) = geodf.geometry[0].bounds
-    print_message(toprint, "Getting list of indices for point...")
-    indices = get_indices_for_point(bounds_list, point)
+    if indices is None:
+        print_message(toprint, "Getting list of indices for point...")
+        indices = get_indices_for_point(bounds_list, point)
     print_message(toprint, f"Cropping from a total of {len(indices)} images...")
     for (idx, i) in zip(indices, range(len(indices))):
         print_message(toprint, f"{idx+1}/{len(indices)}",end="\r")
         link = links[idx]
-        with rio.open(link) as src:
+        with open_scene(link) as src:
             window = from_bounds(
                 left, bottom, right, top, src.transform,
                 )
-            window_transform = src.window_transform(window)
-            clipped = src.read(window=window)
+            patch_window = get_patch_window(window, src.width, src.height, patch_filter.boundless)
+            if patch_window is None:
+                print_message(toprint, "The window is not (entirely) in the image, skipping")
+                continue
+            if patch_filter.max_nodata < 1 and has_nodata(src):
+                # Pixels outside the image count as nodata
+                valid = np.count_nonzero(src.dataset_mask(window=window.intersection(Window(0, 0, src.width, src.height))))
+                size = int(round(patch_window.height)) * int(round(patch_window.width))
+                if 1 - valid / size > patch_filter.max_nodata:
+                    print_message(toprint, "Too much nodata, skipping")
+                    continue
+            # The patch starts where the window enters the image, not where the window starts
+            window_transform = src.window_transform(patch_window)
+            if patch_filter.boundless == "pad":
+                fill = src.nodata if src.nodata is not None else 0
+                clipped = src.read(window=window, boundless=True, fill_value=fill)
+            else:
+                clipped = src.read(window=window)
             crs = src.crs
-            count = src.count
         print_message(toprint, f"Clipped data has shape: {clipped.shape}")
         print_message(toprint,"Saving...")
         filename = os.path.join(path_to_dir, f"{point_idx}-{i+1}.tif")
-        with rio.open(
-            filename, 'w',
-            driver='GTiff', 
-            width=clipped.shape[2], 
-            height=clipped.shape[1], 
-            count=count,
-            transform=window_transform, 
-            crs=crs, 
-            dtype=clipped.dtype,
-            ) as dst:
-            dst.write(clipped)
-
-def main(hurricane_name = DEFAULT_HURRICANE, toprint = True):
-    links = get_tidied_tif_links(hurricane_name, toprint)
-    pre_event_links = [link for link in links if "pre-event" in link]
-    post_event_links = [link for link in links if "post-event" in link]
-    pre_event_bounds = [rio.open(link).bounds for link in pre_event_links]
-    post_event_bounds = [rio.open(link).bounds for link in post_event_links]
+        write_patch(filename, clipped, window_transform, crs, encoding)
+
+def main(hurricane_name = DEFAULT_HURRICANE, toprint = True, dist = 20, workers = 1, output = "gtiff", dry_run = False, max_nodata = PATCH_MAX_NODATA, boundless = "clip", scenes = "all", k = 1, metrics = None, io_stats = False, band_stats = False, codec = "none", level = None, layout = None, encode_threads = PATCH_ENCODE_THREADS):
+    """
+    Crops pre and post event patches around every building of the hurricane
+    and saves them in data/processed/patches/<hurricane_name>
+
+    PARAMETERS:
+    ---
+        dist: distance in meters from the building to each edge of the patch
+        workers: number of worker processes used to crop the patches
+        output: "gtiff" to save each patch as {pre,post}/{point_idx}-{i}.tif,
+            "npy" to save all the patches as array stores {pre,post}.npy and
+            {pre,post}.parquet (see patch_store_utils)
+        dry_run: only report how many patches are outstanding, without cropping
+        max_nodata, boundless: which patches to skip, see extraction_utils.PatchFilter
+        scenes, k: which scenes to crop every building from: the k best of them
+            according to the policy scenes, see scene_selection_utils.SCENE_POLICIES
+            (the policies of SINGLE_PHASE_POLICIES are rejected, they would leave a phase empty)
+        metrics: where to write the timings and counters of the run, as JSON lines
+            or in the Prometheus text format (see instrumentation_utils.Instrumentation)
+        io_stats: whether or not to also count GDAL's I/O (see instrumentation_utils.GdalIOStats)
+        band_stats: whether or not to also compute the statistics of every band of the
+            patches, per phase and scene, and save them in band-stats.json next to the
+            patches (see band_stats_utils); they are computed as the patches are cropped
+        codec, level, layout: how the GeoTIFFs are compressed and laid out, see
+            patch_codec_utils.PatchEncoding (by default uncompressed, tiled if compressed)
+        encode_threads: number of threads of every process compressing and writing
+            the GeoTIFFs while the next patches are read, 0 to write them one by one
+
+    With "gtiff", progress is recorded in a manifest (see manifest_utils), so that
+    a rerun only crops the patches that are new, changed, failed or missing,
+    and removes those of buildings that are gone.
+    A table of where the time went is printed at the end
+    """
+    if output not in ["gtiff", "npy"]:
+        raise ValueError(f"Unknown output format {output}")
+    check_policy_for_phase(scenes)
+    encoding = get_encoding(codec, level, layout)
+    with instrumented_run("patches", toprint, metrics, io_stats):
+        crop_all_patches(hurricane_name, toprint, dist, workers, output, dry_run, max_nodata, boundless, scenes, k, band_stats, encoding, encode_threads)
+
+def crop_all_patches(hurricane_name, toprint, dist, workers, output, dry_run, max_nodata, boundless, scenes, k, band_stats = False, encoding: PatchEncoding = None, encode_threads = 0):
+    """
+    The body of main, every step timed as a stage of the current instrumented run
+    """
+    patch_filter = PatchFilter(max_nodata, boundless)
+    selection = SceneSelection(scenes, k, LANDFALL_DATES.get(hurricane_name))
+    cache = get_range_cache()
+    cache_before = cache.stats() if cache is not None else None
+    with stage("scenes"):
+        records = get_scene_metadata_for_hurricane(hurricane_name, toprint)
 
     gdf = combine_all_vector_data_and_save_for_hurricane(hurricane_name, toprint)
     if len(gdf) == 0:
         raise Exception(f"No processed vector data for hurricane {hurricane_name}")
+    count("buildings", len(gdf))
     
     path_to_hurricane_patches = os.path.join(PATH_TO_PATCHES, hurricane_name)
     path_to_hurricane_patches_pre = os.path.join(path_to_hurricane_patches, "pre")
@@ -115,12 +183,130 @@ def main(hurricane_name = DEFAULT_HURRICANE, toprint = True):
     os.makedirs(path_to_hurricane_patches_pre, exist_ok = True)
     os.makedirs(path_to_hurricane_patches_post, exist_ok = True)
     
-    for (point,idx) in zip(gdf.geometry,range(len(gdf))):
-        crop_patches_for_point(pre_event_links, pre_event_bounds, point, idx, 20, path_to_hurricane_patches_pre, toprint)
-        crop_patches_for_point(post_event_links, post_event_bounds, point, idx, 20, path_to_hurricane_patches_post, toprint)
+    # Work out all the patches first, then cut them scene by scene
+    # so that every scene is only opened once
+    xs = gdf.geometry.x.to_numpy()
+    ys = gdf.geometry.y.to_numpy()
+    all_band_stats = dict()
+    for (phase, path_to_dir) in [("pre", path_to_hurricane_patches_pre), ("post", path_to_hurricane_patches_post)]:
+        print_message(toprint, f"Cropping {phase} event patches...")
+        with stage("plan", phase = phase):
+            jobs = plan_patch_jobs(records[phase], xs, ys, dist, path_to_dir, selection = selection)
+        count("scenes", len(records[phase]), phase = phase)
+        count("patches_planned", len(jobs), phase = phase)
+        links = [record.link for record in records[phase]]
+        stats = dict()
+        sink = None
+        with stage("extract", phase = phase):
+            if output == "gtiff":
+                sink = GTiffSink(encoding, encode_threads)
+                if band_stats:
+                    sink = BandStatsSink(sink, records[phase], phase)
+                manifest = PatchManifest(os.path.join(path_to_hurricane_patches, MANIFEST_FILENAME))
+                summary = extract_patches_with_manifest(
+                    records[phase], jobs, xs, ys, dist, manifest, phase, toprint, workers, dry_run, patch_filter, stats, sink, encoding
+                )
+                written = summary["written"]
+                count("patches_removed", summary["removed"], phase = phase)
+            elif dry_run:
+                print_message(toprint, f"{len(jobs)} {phase} patches to crop into the array store")
+                written = 0
+            else:
+                # The array store is written from scratch every time
+                path_to_store = os.path.join(path_to_hurricane_patches, phase)
+                (sink, jobs) = create_patch_store(path_to_store, records[phase], jobs, phase, patch_filter)
+                if band_stats:
+                    sink = BandStatsSink(sink, records[phase], phase)
+                written_patches = WrittenPatches()
+                written = extract_patches_by_scene(
+                    links, jobs, toprint, workers = workers, sink = sink, on_done = written_patches, stats = stats, patch_filter = patch_filter
+                )
+                save_written_patches(path_to_store, written_patches.idx)
+        count("patches_written", written, phase = phase)
+        add_counts(get_read_counters(stats), phase = phase)
+        if band_stats and not dry_run:
+            if output == "gtiff" and summary["done"] > 0:
+                # Some patches were cropped by an earlier run and not read this time
+                with stage("band-stats", phase = phase):
+                    done = [job for job in jobs if os.path.isfile(job.path)]
+                    all_band_stats.update(compute_band_stats_for_files(
+                        [job.path for job in done],
+                        [(phase, records[phase][job.scene_idx].link) for job in done],
+                        [records[phase][job.scene_idx].nodata for job in done],
+                        workers, toprint,
+                    ))
+            else:
+                all_band_stats.update(sink.stats)
+    if band_stats and not dry_run:
+        path = save_band_stats(path_to_hurricane_patches, all_band_stats)
+        print_message(toprint, f"Saved the band statistics of {len(all_band_stats)} scenes to {path}")
+    if cache is not None and not dry_run:
+        stats = cache.stats()
+        print_message(toprint, f"Range cache: {stats['hits']} hits, {stats['misses']} misses, "
+            f"{stats['bytes_fetched'] / 2**20:.1f}MB fetched, {stats['cached_bytes'] / 2**20:.1f}MB cached")
+        # The counters of the cache are kept across runs, only count this one
+        for (name, counter) in [("cache_hits", "hits"), ("cache_misses", "misses"), ("cache_requests", "requests"), ("bytes_fetched", "bytes_fetched")]:
+            count(name, stats.get(counter, 0) - cache_before.get(counter, 0))
+
+def iter_patches(hurricane_name = DEFAULT_HURRICANE, dist = 20, phase = "post", toprint = False, prefetch = PATCH_PREFETCH, max_nodata = PATCH_MAX_NODATA, boundless = "clip", scenes = "all", k = 1):
+    """
+    The same patches that main saves to disk, as a stream of arrays:
+    nothing is written, so preprocessing or training can use them directly
+
+    PARAMETERS:
+    ---
+        dist: distance in meters from the building to each edge of the patch
+        phase: "pre" or "post"
+        prefetch: number of patches read ahead (see iter_patches_by_scene)
+        max_nodata, boundless: which patches to skip, see extraction_utils.PatchFilter
+        scenes, k: which scenes to crop every building from, see main
+
+    YIELDS:
+    ---
+        A Patch (see extraction_utils) per building and image: point_idx is the
+        row of the building in the processed vector data, x and y its coordinates
+
+    EXAMPLE:
+    ---
+        for patch in iter_patches("irma", phase = "pre"):
+            print(patch.point_idx, patch.data.shape, patch.transform)
+    """
+    if phase not in ["pre", "post"]:
+        raise ValueError(f"Unknown phase {phase}")
+    check_policy_for_phase(scenes, phase)
+    records = get_scene_metadata_for_hurricane(hurricane_name, toprint)[phase]
+    gdf = combine_all_vector_data_and_save_for_hurricane(hurricane_name, toprint)
+    xs = gdf.geometry.x.to_numpy()
+    ys = gdf.geometry.y.to_numpy()
+    selection = SceneSelection(scenes, k, LANDFALL_DATES.get(hurricane_name))
+    jobs = plan_patch_jobs(records, xs, ys, dist, None, selection = selection)
+    links = [record.link for record in records]
+    return iter_patches_by_scene(links, jobs, xs, ys, prefetch = prefetch, patch_filter = PatchFilter(max_nodata, boundless))
 
 if __name__ == "__main__":
-    hurricane_name = input("Please input hurricane name (Press enter to use default test data):")
+    parser = argparse.ArgumentParser(description = "Crop pre and post event patches around every building")
+    parser.add_argument("hurricane_name", nargs = "?", help = "name of the hurricane, e.g. irma or test")
+    parser.add_argument("--workers", type = int, default = 1, help = "number of worker processes")
+    parser.add_argument("--output", choices = ["gtiff", "npy"], default = "gtiff", help = "one GeoTIFF per patch, or one array store per phase")
+    parser.add_argument("--dry-run", action = "store_true", help = "only report how many patches are outstanding")
+    parser.add_argument("--max-nodata", type = float, default = PATCH_MAX_NODATA, help = "skip the patches with a larger fraction of nodata pixels")
+    parser.add_argument("--boundless", choices = ["clip", "pad", "skip"], default = "clip", help = "what to do with the patches partly outside their image")
+    parser.add_argument("--scenes", choices = [name for name in SCENE_POLICIES if name not in SINGLE_PHASE_POLICIES], default = "all", help = "which of the images containing a building to crop it from")
+    parser.add_argument("--k", type = int, default = 1, help = "number of images per building and phase kept by --scenes")
+    parser.add_argument("--no-cache", action = "store_true", help = "do not keep the bytes read from remote images in data/cache")
+    parser.add_argument("--metrics", help = "file to write the timings and counters of the run to: JSON lines, or the Prometheus text format if it ends in .prom")
+    parser.add_argument("--io-stats", action = "store_true", help = "also count the datasets GDAL opens and the HTTP requests it sends")
+    parser.add_argument("--band-stats", action = "store_true", help = "also compute the statistics of every band of the patches, saved in band-stats.json")
+    parser.add_argument("--codec", choices = PATCH_CODECS, default = "none", help = "how to compress the GeoTIFFs (losslessly)")
+    parser.add_argument("--level", type = int, help = "compression level of deflate (1-9) or zstd (1-22)")
+    parser.add_argument("--layout", choices = PATCH_LAYOUTS, help = "how to lay out the pixels of the GeoTIFFs (default tiles if compressed, strips otherwise)")
+    parser.add_argument("--encode-threads", type = int, default = PATCH_ENCODE_THREADS, help = "number of threads compressing and writing the GeoTIFFs of every process")
+    args = parser.parse_args()
+    if args.no_cache:
+        set_range_cache(None)
+    hurricane_name = args.hurricane_name
+    if hurricane_name is None:
+        hurricane_name = input("Please input hurricane name (Press enter to use default test data):")
     hurricane_name = hurricane_name.strip()
     hurricane_name = hurricane_name.lower()
-    main(hurricane_name)
\ No newline at end of file
+    main(hurricane_name, workers = args.workers, output = args.output, dry_run = args.dry_run, max_nodata = args.max_nodata, boundless = args.boundless, scenes = args.scenes, k = args.k, metrics = args.metrics, io_stats = args.io_stats, band_stats = args.band_stats, codec = args.codec, level = args.level, layout = args.layout, encode_threads = args.encode_threads)
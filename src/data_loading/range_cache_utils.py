@@ -0,0 +1,406 @@
+# Handle tif files
+import rasterio as rio
+
+# Fetching byte ranges (requests is imported when the first range is fetched)
+import io
+import re
+import inspect
+
+# On-disk cache
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+# Others
+from typing import List, Optional
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+
+# The environment variable holding the path to the cache used by open_scene,
+# so that worker processes use the same cache as their parent; empty to disable it
+RANGE_CACHE_ENV = "RANGE_CACHE_PATH"
+
+# rio.open only takes an opener from rasterio 1.4 on, older versions read remote files directly
+OPENER_SUPPORTED = "opener" in inspect.signature(rio.open).parameters
+
+COUNTERS = ["hits", "misses", "requests", "bytes_fetched", "evictions", "cached_bytes"]
+
+def is_remote(link: str) -> bool:
+    return link.startswith("http://") or link.startswith("https://")
+
+class RangeCache:
+    """
+    A persistent cache of the bytes read from remote files, kept in SQLite
+    (by default in data/cache/byte-ranges.sqlite)
+
+    Files are read in blocks of block_size bytes, keyed by (url, block number).
+    Consecutive missing blocks are fetched with a single range request.
+    Once the cache holds more than max_bytes, the least recently used blocks
+    are evicted. Several processes can use the same cache at the same time
+
+    Remote files are assumed not to change; call clear() if they do
+    """
+    def __init__(self, path = None, max_bytes = RANGE_CACHE_MAX_BYTES, block_size = RANGE_CACHE_BLOCK_SIZE,
+                 memory_blocks = RANGE_CACHE_MEMORY_BLOCKS, timeout = PROBE_TIMEOUT):
+        if path is None:
+            path = PATH_TO_RANGE_CACHE
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_blocks = memory_blocks
+        self.timeout = timeout
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        with closing(sqlite3.connect(path, timeout = 60)) as conn, conn:
+            # Readers do not block the writer (and the other way round)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("INSERT OR IGNORE INTO info VALUES ('block_size', ?)", (str(block_size),))
+            # The blocks already cached fix the block size
+            self.block_size = int(conn.execute("SELECT value FROM info WHERE key = 'block_size'").fetchone()[0])
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            conn.executemany("INSERT OR IGNORE INTO counters VALUES (?, 0)", [(name,) for name in COUNTERS])
+            conn.execute("CREATE TABLE IF NOT EXISTS files (url TEXT PRIMARY KEY, size INTEGER)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blocks (url TEXT, block INTEGER, data BLOB, size INTEGER, "
+                "last_used REAL, PRIMARY KEY (url, block))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS blocks_last_used ON blocks (last_used)")
+        self._init_local()
+
+    def _init_local(self):
+        # One connection and one HTTP session per thread, one memory cache per process
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._sizes = dict()
+        # Hits from memory, added to the counters with the next write
+        self._memory_hits = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ["_local", "_lock", "_memory", "_sizes", "_memory_hits"]:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_local()
+
+    def _connection(self) -> sqlite3.Connection:
+        if getattr(self._local, "conn", None) is None:
+            self._local.conn = sqlite3.connect(self.path, timeout = 60)
+            self._local.conn.execute("PRAGMA synchronous=NORMAL")
+        return self._local.conn
+
+    def _session(self) -> "requests.Session":
+        if getattr(self._local, "session", None) is None:
+            import requests
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _remember(self, key, data):
+        with self._lock:
+            self._memory[key] = data
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_blocks:
+                self._memory.popitem(last = False)
+
+    def get_size(self, url: str, timeout = None) -> int:
+        """
+        The size of the remote file in bytes (asked for once, then cached);
+        timeout is the number of seconds to wait for the server, by default self.timeout
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if url in self._sizes:
+            return self._sizes[url]
+        if not is_remote(url):
+            raise FileNotFoundError(url)
+        conn = self._connection()
+        row = conn.execute("SELECT size FROM files WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            response = self._session().head(url, allow_redirects = True, timeout = timeout)
+            if response.status_code == 200 and "Content-Length" in response.headers:
+                size = int(response.headers["Content-Length"])
+            else:
+                # Some servers do not answer HEAD requests, the size is also in Content-Range
+                response = self._session().get(url, headers = {"Range": "bytes=0-0"}, timeout = timeout)
+                match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+                if response.status_code != 206 or match is None:
+                    raise OSError(f"HTTP {response.status_code} when asking for the size of {url}")
+                size = int(match.group(1))
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?)", (url, size))
+        else:
+            size = row[0]
+        self._sizes[url] = size
+        return size
+
+    def _fetch(self, url: str, start: int, end: int, timeout = None) -> bytes:
+        """
+        Bytes start (included) to end (excluded) of the remote file
+        """
+        response = self._session().get(
+            url, headers = {"Range": f"bytes={start}-{end - 1}"}, timeout = self.timeout if timeout is None else timeout
+        )
+        if response.status_code == 206:
+            data = response.content
+        elif response.status_code == 200:
+            # The server ignored the range and sent everything
+            data = response.content[start:end]
+        else:
+            raise OSError(f"HTTP {response.status_code} when reading bytes {start}-{end - 1} of {url}")
+        if len(data) != end - start:
+            raise OSError(f"Expected {end - start} bytes from {url} but got {len(data)}")
+        return data
+
+    def get_blocks(self, url: str, blocks: List, timeout = None) -> dict:
+        """
+        RETURNS:
+        ---
+            A dictionary from block number to the bytes of that block,
+            fetching the blocks that are not cached yet
+        """
+        res = dict()
+        with self._lock:
+            for block in blocks:
+                if (url, block) in self._memory:
+                    res[block] = self._memory[(url, block)]
+                    self._memory_hits += 1
+        wanted = [block for block in blocks if block not in res]
+        if len(wanted) == 0:
+            return res
+        conn = self._connection()
+        now = time.time()
+        placeholders = ", ".join("?" * len(wanted))
+        rows = conn.execute(
+            f"SELECT block, data FROM blocks WHERE url = ? AND block IN ({placeholders})", [url] + wanted
+        ).fetchall()
+        hits = {block: data for (block, data) in rows}
+        missing = [block for block in wanted if block not in hits]
+
+        # Fetch runs of consecutive missing blocks in one request each
+        fetched = dict()
+        size = self.get_size(url, timeout)
+        runs = []
+        for block in missing:
+            if len(runs) > 0 and runs[-1][1] == block - 1:
+                runs[-1][1] = block
+            else:
+                runs.append([block, block])
+        for (first, last) in runs:
+            start = first * self.block_size
+            data = self._fetch(url, start, min((last + 1) * self.block_size, size), timeout)
+            for block in range(first, last + 1):
+                offset = (block - first) * self.block_size
+                fetched[block] = data[offset:offset + self.block_size]
+
+        with conn:
+            if len(hits) > 0:
+                conn.executemany(
+                    "UPDATE blocks SET last_used = ? WHERE url = ? AND block = ?",
+                    [(now, url, block) for block in hits.keys()],
+                )
+            added = 0
+            for (block, data) in fetched.items():
+                # Another process may have cached the same block in the meantime
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO blocks VALUES (?, ?, ?, ?, ?)", (url, block, data, len(data), now)
+                )
+                added += len(data) if cursor.rowcount == 1 else 0
+            self._count(conn, {
+                "hits": len(hits) + self._take_memory_hits(),
+                "misses": len(fetched),
+                "requests": len(runs),
+                "bytes_fetched": sum(len(data) for data in fetched.values()),
+                "cached_bytes": added,
+            })
+            if added > 0:
+                self._evict(conn)
+        for (block, data) in list(hits.items()) + list(fetched.items()):
+            self._remember((url, block), data)
+            res[block] = data
+        return res
+
+    def read(self, url: str, start: int, length: int, timeout = None) -> bytes:
+        """
+        Reads length bytes of the remote file from start (fewer at the end of the file)
+        """
+        end = min(start + length, self.get_size(url, timeout))
+        if end <= start:
+            return b""
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        blocks = self.get_blocks(url, list(range(first, last + 1)), timeout)
+        data = b"".join(blocks[block] for block in range(first, last + 1))
+        offset = start - first * self.block_size
+        return data[offset:offset + end - start]
+
+    def _take_memory_hits(self) -> int:
+        with self._lock:
+            (hits, self._memory_hits) = (self._memory_hits, 0)
+        return hits
+
+    @staticmethod
+    def _count(conn, counts: dict):
+        conn.executemany(
+            "UPDATE counters SET value = value + ? WHERE name = ?",
+            [(value, name) for (name, value) in counts.items() if value != 0],
+        )
+
+    def _evict(self, conn):
+        """
+        Removes the least recently used blocks until the cache fits in max_bytes
+        """
+        cached = conn.execute("SELECT value FROM counters WHERE name = 'cached_bytes'").fetchone()[0]
+        if cached <= self.max_bytes:
+            return
+        evicted, freed = [], 0
+        for (url, block, size) in conn.execute("SELECT url, block, size FROM blocks ORDER BY last_used"):
+            if cached - freed <= self.max_bytes:
+                break
+            evicted.append((url, block))
+            freed += size
+        conn.executemany("DELETE FROM blocks WHERE url = ? AND block = ?", evicted)
+        self._count(conn, {"evictions": len(evicted), "cached_bytes": -freed})
+
+    def stats(self) -> dict:
+        """
+        RETURNS:
+        ---
+            The counters of the cache, summed over every process that used it:
+            hits/misses (blocks found in/missing from the cache), requests (range
+            requests sent), bytes_fetched, evictions (blocks evicted) and cached_bytes
+        """
+        conn = self._connection()
+        with conn:
+            self._count(conn, {"hits": self._take_memory_hits()})
+        return dict(conn.execute("SELECT name, value FROM counters").fetchall())
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM blocks")
+            conn.execute("DELETE FROM files")
+            conn.execute("UPDATE counters SET value = 0")
+        with self._lock:
+            self._memory.clear()
+            self._memory_hits = 0
+        self._sizes.clear()
+
+class CachedRangeFile(io.RawIOBase):
+    """
+    A read-only file object over a remote file, reading through a RangeCache
+    """
+    def __init__(self, cache: RangeCache, url: str, timeout = None):
+        self.cache = cache
+        self.url = url
+        self.timeout = timeout
+        self.size = cache.get_size(url, timeout)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.size + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        data = self.cache.read(self.url, self.pos, size, self.timeout)
+        self.pos += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+class RangeCacheOpener:
+    """
+    Lets rasterio (rio.open(link, opener=...)) read remote files through a RangeCache,
+    waiting at most timeout seconds for every request (by default the timeout of the cache)
+    """
+    def __init__(self, cache: RangeCache, timeout = None):
+        self.cache = cache
+        self.timeout = timeout
+
+    def open(self, path, mode = "r", **kwargs):
+        if "w" in mode or "+" in mode or "a" in mode:
+            raise OSError(f"{path} can only be read")
+        return CachedRangeFile(self.cache, path, self.timeout)
+
+    def size(self, path):
+        return self.cache.get_size(path, self.timeout)
+
+    def isfile(self, path):
+        try:
+            self.cache.get_size(path, self.timeout)
+            return True
+        except OSError:
+            return False
+
+    def isdir(self, path):
+        return False
+
+    def ls(self, path):
+        return []
+
+    def mtime(self, path):
+        return 0
+
+    def rm(self, path):
+        raise OSError(f"{path} can only be read")
+
+_range_cache = None
+_range_cache_lock = threading.Lock()
+
+def set_range_cache(path):
+    """
+    Sets the cache used by open_scene in this process and in the worker
+    processes it starts from now on; None to disable it
+    """
+    os.environ[RANGE_CACHE_ENV] = path if path is not None else ""
+
+def get_range_cache() -> Optional[RangeCache]:
+    """
+    The cache used by open_scene: by default the one in data/cache,
+    None if it has been disabled with set_range_cache(None)
+    """
+    global _range_cache
+    path = os.environ.get(RANGE_CACHE_ENV, PATH_TO_RANGE_CACHE)
+    if path == "":
+        return None
+    with _range_cache_lock:
+        if _range_cache is None or _range_cache.path != path:
+            _range_cache = RangeCache(path)
+        return _range_cache
+
+def open_scene(link: str, timeout = None):
+    """
+    Same as rio.open(link), but remote links are read through the range cache
+    (if it is enabled and rasterio supports openers)
+
+    timeout is the number of seconds to wait for the server on every request:
+    through the cache, it is passed on to its requests (by default the timeout of
+    the cache); otherwise set GDAL_HTTP_TIMEOUT, which is the one /vsicurl/ uses
+    """
+    cache = get_range_cache() if is_remote(link) and OPENER_SUPPORTED else None
+    if cache is None:
+        return rio.open(link)
+    return rio.open(link, opener = RangeCacheOpener(cache, timeout))
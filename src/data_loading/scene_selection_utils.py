@@ -0,0 +1,219 @@
+# Handle tif files
+import rasterio as rio
+import numpy as np
+
+# Reading the masks of the scenes concurrently
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+# Others
+from typing import List, NamedTuple, Optional
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.range_cache_utils import open_scene
+
+class SceneSelection(NamedTuple):
+    """
+    Which of the scenes containing a point to crop it from
+
+    policy: the name of a policy in SCENE_POLICIES, or a function with the same
+        signature as them
+    k: number of scenes kept per point (ignored by "all")
+    landfall: the "YYYY-MM-DD" date the hurricane made landfall; by default the
+        phase of the scenes (pre-event or post-event) tells whether they were
+        acquired before or after
+    """
+    policy: object = "all"
+    k: int = 1
+    landfall: Optional[str] = None
+
+def get_date_ordinals(records: List) -> np.ndarray:
+    """
+    RETURNS:
+    ---
+        The acquisition date of every record as a number of days (the later the
+        bigger), nan for the records whose link has no date
+    """
+    return np.array([
+        np.nan if record.acquisition_date is None else date.fromisoformat(record.acquisition_date).toordinal()
+        for record in records
+    ], dtype = float)
+
+def is_before_landfall(records: List, landfall = None) -> np.ndarray:
+    """
+    RETURNS:
+    ---
+        Whether every record was acquired before landfall: from its date if both are
+        known, otherwise from its phase
+    """
+    before = np.array([record.phase == "pre" for record in records], dtype = bool)
+    if landfall is not None:
+        dates = get_date_ordinals(records)
+        known = ~np.isnan(dates)
+        before[known] = dates[known] < date.fromisoformat(landfall).toordinal()
+    return before
+
+# Policies: each gets the records, the (point_idx, scene_idx) pairs of every point
+# and every scene containing it, the landfall date and, for "coverage", the fraction
+# of every window holding valid pixels; and returns (eligible, scores): which pairs
+# can be kept, and how good they are (the k best eligible pairs of each point are kept).
+# Scenes without a date get the lowest score
+
+def select_all(records, point_idx, scene_idx, landfall, coverage) -> tuple:
+    return (np.ones(len(point_idx), dtype = bool), np.zeros(len(point_idx)))
+
+def select_latest_before(records, point_idx, scene_idx, landfall, coverage) -> tuple:
+    dates = np.nan_to_num(get_date_ordinals(records), nan = -np.inf)
+    return (is_before_landfall(records, landfall)[scene_idx], dates[scene_idx])
+
+def select_earliest_after(records, point_idx, scene_idx, landfall, coverage) -> tuple:
+    dates = np.nan_to_num(get_date_ordinals(records), nan = np.inf)
+    return (~is_before_landfall(records, landfall)[scene_idx], -dates[scene_idx])
+
+def select_closest(records, point_idx, scene_idx, landfall, coverage) -> tuple:
+    """
+    The scenes acquired closest to landfall, before or after it. Run on the pre and
+    post event scenes separately (as patch_utils.main does), this gives the latest
+    pre event and the earliest post event scenes. Without a landfall date, the date
+    of the earliest post event scene is used
+    """
+    dates = get_date_ordinals(records)
+    if landfall is not None:
+        reference = date.fromisoformat(landfall).toordinal()
+    else:
+        post = [d for (d, record) in zip(dates, records) if record.phase == "post" and not np.isnan(d)]
+        reference = min(post) if len(post) > 0 else np.nanmax(np.append(dates, -np.inf))
+    scores = -np.abs(dates[scene_idx] - reference)
+    return (np.ones(len(point_idx), dtype = bool), np.nan_to_num(scores, nan = -np.inf))
+
+def select_coverage(records, point_idx, scene_idx, landfall, coverage) -> tuple:
+    return (coverage > 0, coverage)
+
+SCENE_POLICIES = {
+    "all": select_all,
+    "latest-before": select_latest_before,
+    "earliest-after": select_earliest_after,
+    "closest": select_closest,
+    "coverage": select_coverage,
+}
+
+# The policies that only keep the scenes of one phase, and that phase: run on both
+# phases, the other one would get no patch at all ("closest" keeps the latest pre
+# event and the earliest post event scenes)
+SINGLE_PHASE_POLICIES = {"latest-before": "pre", "earliest-after": "post"}
+
+def check_policy_for_phase(policy, phase = None):
+    """
+    Raises a ValueError if policy keeps no scene of phase ("pre" or "post", None for both)
+    """
+    if callable(policy) or policy not in SINGLE_PHASE_POLICIES or SINGLE_PHASE_POLICIES[policy] == phase:
+        return
+    raise ValueError(f"The {policy} policy only keeps {SINGLE_PHASE_POLICIES[policy]} event scenes, "
+        "use closest for the scenes closest to landfall of both phases")
+
+def read_coverage_mask(link, max_size = COVERAGE_MASK_SIZE) -> np.ndarray:
+    """
+    The mask of the whole scene at link (non-zero where the pixels are valid),
+    at most max_size pixels across: GDAL reads it from an overview when there is one
+    """
+    with rio.Env(**GDAL_REMOTE_OPTIONS), open_scene(link) as src:
+        scale = min(1.0, max_size / max(src.width, src.height))
+        out_shape = (max(int(src.height * scale), 1), max(int(src.width * scale), 1))
+        return src.dataset_mask(out_shape = out_shape)
+
+def get_window_coverage(mask: np.ndarray, windows, width, height) -> np.ndarray:
+    """
+    The fraction of every window holding valid pixels, in a scene of the given
+    size whose (possibly decimated) mask is mask. The part of a window outside
+    the scene counts as nodata
+
+    PARAMETERS:
+    ---
+        windows: (col_offs, row_offs, widths, heights) arrays, from get_windows_for_bounds
+
+    RETURNS:
+    ---
+        An array of fractions between 0 and 1
+    """
+    (col_offs, row_offs, widths, heights) = [np.asarray(v, dtype = float) for v in windows]
+    (mask_height, mask_width) = mask.shape
+    (sx, sy) = (mask_width / width, mask_height / height)
+    # Number of valid cells above and to the left of every corner
+    counts = np.zeros((mask_height + 1, mask_width + 1), dtype = np.int64)
+    counts[1:, 1:] = np.cumsum(np.cumsum(mask > 0, axis = 0), axis = 1)
+    c0 = np.clip(np.floor(col_offs * sx), 0, mask_width).astype(int)
+    r0 = np.clip(np.floor(row_offs * sy), 0, mask_height).astype(int)
+    c1 = np.clip(np.ceil((col_offs + widths) * sx), 0, mask_width).astype(int)
+    r1 = np.clip(np.ceil((row_offs + heights) * sy), 0, mask_height).astype(int)
+    valid = counts[r1, c1] - counts[r0, c1] - counts[r1, c0] + counts[r0, c0]
+    area = np.maximum(np.ceil((col_offs + widths) * sx) - np.floor(col_offs * sx), 1) * \
+        np.maximum(np.ceil((row_offs + heights) * sy) - np.floor(row_offs * sy), 1)
+    return np.clip(valid / area, 0, 1)
+
+def get_pair_coverage(records: List, scene_idx, windows, max_workers = PROBE_MAX_WORKERS) -> np.ndarray:
+    """
+    The coverage (see get_window_coverage) of every (point, scene) pair, reading
+    one small mask per scene, max_workers scenes at the same time
+
+    PARAMETERS:
+    ---
+        scene_idx: the scene of every pair
+        windows: (col_offs, row_offs, widths, heights) arrays, the window of every pair
+    """
+    scene_idx = np.asarray(scene_idx)
+    coverage = np.zeros(len(scene_idx))
+    scenes = np.unique(scene_idx).tolist()
+    if len(scenes) == 0:
+        return coverage
+    with ThreadPoolExecutor(max_workers = min(max_workers, len(scenes))) as executor:
+        masks = dict(zip(scenes, executor.map(lambda s: read_coverage_mask(records[s].link), scenes)))
+    for s in scenes:
+        members = np.flatnonzero(scene_idx == s)
+        coverage[members] = get_window_coverage(
+            masks[s], [np.asarray(v)[members] for v in windows], records[s].width, records[s].height
+        )
+    return coverage
+
+def select_scenes(records: List, point_idx, scene_idx, selection: SceneSelection = None, windows = None) -> np.ndarray:
+    """
+    Chooses which scenes to crop every point from
+
+    PARAMETERS:
+    ---
+        records: a list of SceneMetadata
+        point_idx, scene_idx: every point and every scene containing it (from FootprintIndex.query)
+        selection: see SceneSelection, by default every scene is kept
+        windows: (col_offs, row_offs, widths, heights) arrays, the window of every pair;
+            only needed by the "coverage" policy, which then reads a small mask of every scene
+
+    RETURNS:
+    ---
+        A boolean array, True for the pairs to keep
+    """
+    if selection is None:
+        selection = SceneSelection()
+    point_idx = np.asarray(point_idx)
+    scene_idx = np.asarray(scene_idx)
+    policy = selection.policy
+    if not callable(policy):
+        if policy not in SCENE_POLICIES:
+            raise ValueError(f"Unknown scene selection policy {policy}")
+        if policy == "all":
+            return np.ones(len(point_idx), dtype = bool)
+        policy = SCENE_POLICIES[policy]
+    coverage = None
+    if selection.policy == "coverage":
+        if windows is None:
+            raise ValueError("The coverage policy needs the windows of the pairs")
+        coverage = get_pair_coverage(records, scene_idx, windows)
+    (eligible, scores) = policy(records, point_idx, scene_idx, selection.landfall, coverage)
+    # Best first within every point; ties keep the order of the records
+    order = np.lexsort((scene_idx, -scores, point_idx))
+    order = order[eligible[order]]
+    starts = np.searchsorted(point_idx[order], point_idx[order])
+    rank = np.arange(len(order)) - starts
+    keep = np.zeros(len(point_idx), dtype = bool)
+    keep[order[rank < selection.k]] = True
+    return keep
@@ -1,30 +1,27 @@
 # Handle tif files
-from asyncio.format_helpers import _format_callback_source
-from genericpath import isfile
 import rasterio as rio
 import affine
 
 # Some useful thiings from rasterio
 from rasterio.coords import BoundingBox
 
-# Handle geojson files
-import geopandas as gpd
-
-# Web scraping
-import requests
-
 # Others
-from typing import List
+from typing import List, NamedTuple
+import warnings
+import json
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from data_loading.utils import *
+from data_loading.catalog_utils import get_scene_metadata, sync_catalog_with_file_list
 
 def get_raw_tif_links(hurricane_name = DEFAULT_HURRICANE, toprint = True) -> List:
     """
     Get a list of tif links for the hurricane with hurricane_name
     The list must exist on github
     """
+    # Web scraping, only imported when needed
+    import requests
     filename = hurricane_name + FILE_LIST_SUFFIX
     file_list_path = FILE_LIST_PREFIX + filename
     response = requests.get(file_list_path)
@@ -37,7 +34,40 @@ def get_raw_tif_links(hurricane_name = DEFAULT_HURRICANE, toprint = True) -> Lis
     print_message(toprint, f"There are in total {len(links)} links.")
     return links
 
-def tidy_up_tif_links(links: List, hurricane_name, toprint = True, overwrite = False) -> List:
+class TidyReport(NamedTuple):
+    """
+    kept: links with at least 3 bands
+    too_few_bands: a dictionary from link to its band count, for links with fewer than 3 bands
+    unreachable: a dictionary from link to the error, for links that could not be opened
+    """
+    kept: List
+    too_few_bands: dict
+    unreachable: dict
+
+def probe_tif_links(links: List, name, toprint = True, max_workers = PROBE_MAX_WORKERS, **kwargs) -> TidyReport:
+    """
+    Reads the headers of all the links concurrently (through the scene catalog)
+    and sorts them into kept / too few bands / unreachable. Links that could
+    not be opened by an earlier run are probed again
+
+    PARAMETERS:
+    ---
+        links: a list of links
+        name: name of the file list that the links come from
+        max_workers: maximum number of links probed at the same time
+        kwargs: timeout, retries, backoff, passed on to catalog_utils.probe_link
+    """
+    unreachable = dict()
+    records = sync_catalog_with_file_list(
+        name, links, toprint, unreachable = unreachable, retry_unreachable = True, max_workers = max_workers, **kwargs
+    )
+    kept = [record.link for record in records if record is not None and record.count >= 3]
+    too_few_bands = {
+        record.link: record.count for record in records if record is not None and record.count < 3
+    }
+    return TidyReport(kept, too_few_bands, unreachable)
+
+def tidy_up_tif_links(links: List, hurricane_name, toprint = True, overwrite = False, max_workers = PROBE_MAX_WORKERS) -> List:
     """
     Given a list of tif links, will discard links that are useless
     Will then save the tidied list of links in data/processed/digital-globe-file-list-tidied
@@ -47,6 +77,9 @@ def tidy_up_tif_links(links: List, hurricane_name, toprint = True, overwrite = F
         links: a list of links
         toprint: whether or not to print progress
         overwrite: if exists hurricane_file_list_tidied, whether or not to overwrite
+        max_workers: maximum number of links probed at the same time
+
+    A report of the discarded links is saved in data/processed/tidy-reports
     """
     if len(links) == 0:
         raise ValueError("Empty list of links!")
@@ -58,20 +91,18 @@ def tidy_up_tif_links(links: List, hurricane_name, toprint = True, overwrite = F
                 return get_tidied_tif_links(hurricane_name)
     if not os.path.isdir(PATH_TO_TIDIED_FILELISTS):
         os.mkdir(PATH_TO_TIDIED_FILELISTS)
-    res = [] 
     before_count = len(links)
     print_message(toprint, f"Tidying up a total of {before_count} links...")
     # Only want tif files with band >= 3
-    for (link,idx) in zip(links, list(range(before_count))):
-        print_message(toprint, f"{idx+1}/{before_count}", end="\r")
-        try:
-            src = rio.open(link)
-            if src.count >= 3:
-                res.append(link)
-        except:
-            pass 
+    report = probe_tif_links(links, hurricane_name + FILE_LIST_SUFFIX, toprint, max_workers)
+    res = report.kept
     after_count = len(res)
     print_message(toprint, f"Before: {before_count} links \nAfter: {after_count} links")
+    print_message(toprint, f"{len(report.too_few_bands)} links have fewer than 3 bands")
+    print_message(toprint, f"{len(report.unreachable)} links could not be opened")
+    os.makedirs(PATH_TO_TIDY_REPORTS, exist_ok = True)
+    with open(os.path.join(PATH_TO_TIDY_REPORTS, hurricane_name + ".json"), "w") as f:
+        json.dump(report._asdict(), f, indent = 2)
     path = os.path.join(PATH_TO_TIDIED_FILELISTS, hurricane_name)
     f = open(path, "w")
     for link in res:
@@ -100,14 +131,13 @@ def get_tidied_tif_links(hurricane_name = DEFAULT_HURRICANE, toprint = True) ->
 def find_useful_links_for_box(links: List, box: BoundingBox, toprint = True) -> List:
     """
     Find useful tiff links that overlap with the bounding box
+    The links need not be in a file list, so the scenes read are not added to the catalog
     """
     before_count = len(links)
     res = []
-    for (link, idx) in zip(links, list(range(before_count))):
-        print_message(toprint, f"{idx+1}/{before_count}")
-        src = rio.open(link)
-        if not rio.coords.disjoint_bounds(box, src.bounds):
-            res.append(link)
+    for record in get_scene_metadata(links, toprint, save = False):
+        if record is not None and not rio.coords.disjoint_bounds(box, record.bounds):
+            res.append(record.link)
     after_count = len(res)
     print_message(toprint, f"Before: {before_count} links \nAfter: {after_count} links")
     return res
@@ -134,6 +164,32 @@ def make_bounding_box_and_find_useful_links(left, bottom, right, top, links, top
     print_message(toprint, f"Found {len(post_event_links)} post event links")
     return (box, useful_pre_event_links, useful_post_event_links)
 
+def get_scene_metadata_for_hurricane(hurricane_name = DEFAULT_HURRICANE, toprint = True, max_unreachable = SCENE_MAX_UNREACHABLE) -> dict:
+    """
+    Scenes of the tidied file list that cannot be opened are left out with a
+    warning, unless they are more than max_unreachable (a fraction) of the list:
+    then an OSError is raised rather than returning part of the footprints
+
+    RETURNS:
+    ---
+        A dictionary, res, with keys: pre, post
+        res["pre"]: list of SceneMetadata of the pre_event_links
+        res["post"]: list of SceneMetadata of the post_event_links
+    """
+    good_links = get_tidied_tif_links(hurricane_name, toprint)
+    unreachable = dict()
+    records = sync_catalog_with_file_list(hurricane_name, good_links, toprint, unreachable = unreachable)
+    if len(unreachable) > 0:
+        (link, error) = next(iter(unreachable.items()))
+        message = f"{len(unreachable)}/{len(good_links)} scenes of {hurricane_name} could not be opened, e.g. {link}: {error}"
+        if len(unreachable) > max_unreachable * len(good_links):
+            raise OSError(message)
+        warnings.warn(message)
+    res = dict()
+    res["pre"] = [record for record in records if record is not None and record.phase == "pre"]
+    res["post"] = [record for record in records if record is not None and record.phase == "post"]
+    return res
+
 def get_list_of_bounds_for_hurricane(hurricane_name = DEFAULT_HURRICANE, toprint = True) -> dict:
     """
     RETURNS:
@@ -142,12 +198,8 @@ def get_list_of_bounds_for_hurricane(hurricane_name = DEFAULT_HURRICANE, toprint
         res["pre"]: list of bounds of the sources obtained from pre_event_links
         res["post"]: list of bounds of the sources obtained from post_event_links
     """
+    records = get_scene_metadata_for_hurricane(hurricane_name, toprint)
     res = dict()
-    good_links = get_tidied_tif_links(hurricane_name, toprint)
-    pre_event_links = [link for link in good_links if "pre-event" in link]
-    post_event_links = [link for link in good_links if "post-event" in link]
-    pre_event_bounds = [rio.open(link).bounds for link in pre_event_links]
-    post_event_bounds = [rio.open(link).bounds for link in post_event_links]
-    res["pre"] = pre_event_bounds
-    res["post"] = post_event_bounds
+    res["pre"] = [record.bounds for record in records["pre"]]
+    res["post"] = [record.bounds for record in records["post"]]
     return res
@@ -1,6 +1,8 @@
 import sys
 import os
 import math
+import re
+import numpy as np
 
 PATH_TO_SRC = os.path.join(os.path.dirname(__file__), '..')
 PATH_TO_DIR = os.path.join(PATH_TO_SRC, '..')
@@ -9,7 +11,13 @@ PATH_TO_DATA_RAW = os.path.join(PATH_TO_DATA, "raw")
 PATH_TO_DATA_PROCESSED = os.path.join(PATH_TO_DATA, "processed")
 PATH_TO_PATCHES = os.path.join(PATH_TO_DATA_PROCESSED, "patches")
 PATH_TO_GEOJSONS = os.path.join(PATH_TO_DATA_PROCESSED, "geojsons")
+PATH_TO_VECTOR_DATA = os.path.join(PATH_TO_DATA_PROCESSED, "vector-data")
 PATH_TO_TIDIED_FILELISTS = os.path.join(PATH_TO_DATA_PROCESSED, "digital-globe-file-lists-tidied")
+PATH_TO_SCENE_CATALOG = os.path.join(PATH_TO_DATA_PROCESSED, "scene-catalog.sqlite")
+PATH_TO_TIDY_REPORTS = os.path.join(PATH_TO_DATA_PROCESSED, "tidy-reports")
+PATH_TO_RANGE_CACHE = os.path.join(PATH_TO_DATA, "cache", "byte-ranges.sqlite")
+PATH_TO_DOWNLOAD_CACHE = os.path.join(PATH_TO_DATA, "cache", "downloads")
+PATH_TO_DAMAGE_ASSESSMENTS = os.path.join(PATH_TO_DATA_RAW, "irma-damage-assessment-geojson-data")
 
 FILE_LIST_PREFIX = "https://raw.githubusercontent.com/Chestnut-lol/predicting-cat-5-damage-to-buildings/main/data/raw/digital-globe-file-lists/" 
 FILE_LIST_SUFFIX = "_file_list.txt" 
@@ -17,9 +25,67 @@ DEFAULT_HURRICANE = "irma"
 
 earth_radius = 6371*10**(3)
 
+# Reading headers of remote tif files
+PROBE_MAX_WORKERS = 16 # number of links probed at the same time
+PROBE_TIMEOUT = 30 # seconds, per request
+PROBE_RETRIES = 3
+PROBE_BACKOFF = 1.0 # seconds, doubled after every retry
+PROBE_UNREACHABLE_TTL = 24 * 3600 # seconds before a link that could not be opened is probed again
+SCENE_MAX_UNREACHABLE = 0.1 # largest fraction of the scenes of a hurricane that can be left out for being unreachable
+# Stops GDAL from listing the remote directory to look for sidecar files on every open
+GDAL_REMOTE_OPTIONS = {"GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR"}
+
+# Local cache of the bytes read from remote tif files
+RANGE_CACHE_MAX_BYTES = 20 * 2**30 # least recently used blocks are evicted above this
+RANGE_CACHE_BLOCK_SIZE = 2**17 # bytes are fetched and cached in blocks of this size
+RANGE_CACHE_MEMORY_BLOCKS = 64 # blocks also kept in memory by each process
+
+# Downloading the vector data archives (see download_utils)
+DOWNLOAD_MAX_WORKERS = 4 # number of archives downloaded at the same time
+DOWNLOAD_CHUNK_SIZE = 2**18 # bytes written to disk at a time, an interrupted download loses at most this many
+
+# Reading geojson files
+VECTOR_DATA_MAX_WORKERS = 4 # number of files read at the same time
+VECTOR_DATA_CRS = "EPSG:4326"
+# Columns of the combined vector data, whatever the source
+VECTOR_DATA_COLUMNS = ["source", "damage", "geometry"]
+# Columns holding the damage label in the different sources, in order of preference:
+# "label" in the crowdsourced data, "LEVEL_" in the official damage assessments
+DAMAGE_COLUMN_ALIASES = ["damage", "label", "LEVEL_"]
+# Official damage assessments of every hurricane (geojson files with a "LEVEL_" column)
+DAMAGE_ASSESSMENT_DIRS = {"irma": PATH_TO_DAMAGE_ASSESSMENTS}
+# Buildings get the grade of the nearest official assessment at most this many meters away
+DAMAGE_ASSESSMENT_MAX_DISTANCE = 30
+# Rows per row group of the processed (GeoParquet) files; filters skip whole row groups
+VECTOR_DATA_ROW_GROUP_SIZE = 10000
+
+# Cropping patches
+PATCH_MAX_NODATA = 0.5 # patches with a larger fraction of nodata pixels are skipped
+# Saving the patches (see patch_codec_utils)
+PATCH_TILE_SIZE = 256 # pixels across the tiles of tiled patches
+PATCH_ENCODE_THREADS = 2 # threads compressing and writing patches while the next ones are read
+
+# Serving patches on demand (see patch_service_utils)
+PATCH_SERVICE_MAX_QUERIES = 1024 # patches of the most recent queries kept in memory
+PATCH_SERVICE_MAX_LATENCIES = 10000 # latencies of the most recent queries the percentiles are computed on
+PATCH_SERVICE_PORT = 8000
+PATCH_SERVICE_MAX_DIST = 500 # meters, the largest dist a query can ask for
+
+# Per band statistics of the patches (see band_stats_utils)
+BAND_STATS_FILENAME = "band-stats.json" # saved next to the patches of every hurricane
+BAND_STATS_BINS = 256 # histogram bins per band
+# The first 3 digits of the catalog id in a DigitalGlobe link tell which satellite took the image
+SENSORS = {"101": "QB02", "102": "WV01", "103": "WV02", "104": "WV03", "105": "GE01"}
+
+# Choosing scenes (see scene_selection_utils)
+COVERAGE_MASK_SIZE = 512 # pixels across the masks the scenes are ranked by
+# Date of the first landfall of every hurricane, scenes acquired before it are "before landfall"
+LANDFALL_DATES = {"irma": "2017-09-06"}
+
 def print_message(toprint: bool, message: str, end = "\n"):
     if toprint:
-        print(message)
+        # Progress counters end with "\r" and must show up before the next line
+        print(message, end = end, flush = end != "\n")
 
 def check_if_file_exist(path: str, delete_if_exist: bool) -> bool:
     if os.path.isfile(path):
@@ -33,5 +99,54 @@ def check_if_file_exist(path: str, delete_if_exist: bool) -> bool:
 def convert_meters_to_deg(meters):
     return (180*meters)/(earth_radius*math.pi)
 
+def convert_meters_to_deg_lon(meters, lat):
+    """
+    Same as convert_meters_to_deg, but for an east-west distance at latitude lat
+    (in degrees, a number or an array): degrees of longitude get shorter away from the equator
+    """
+    return convert_meters_to_deg(meters) / np.cos(np.radians(lat))
+
 def convert_deg_to_meters(deg):
-    return (earth_radius*math.pi*deg)/180
\ No newline at end of file
+    return (earth_radius*math.pi*deg)/180
+
+def get_phase_from_link(link: str):
+    """
+    RETURNS:
+    ---
+        "pre" or "post" depending on whether the link is a pre or post event image,
+        None if it is neither
+    """
+    if "pre-event" in link:
+        return "pre"
+    if "post-event" in link:
+        return "post"
+    return None
+
+def get_sensor_from_link(link: str):
+    """
+    The satellite that took the image at a link such as
+    .../hurricane-irma/pre-event/2017-05-20/103001006B055400/103001006B055400.tif
+    from the first digits of its catalog id (see SENSORS)
+
+    RETURNS:
+    ---
+        e.g. "WV02", None if the link does not contain a known catalog id
+    """
+    match = re.search(r"(?:pre|post)-event/[^/]+/(\d{3})[0-9A-Fa-f]{13}/", link)
+    if match is None:
+        return None
+    return SENSORS.get(match.group(1))
+
+def get_acquisition_date_from_link(link: str):
+    """
+    Parse the acquisition date out of a link such as
+    .../hurricane-irma/pre-event/2017-05-20/103001006B055400/103001006B055400.tif
+
+    RETURNS:
+    ---
+        The date as a "YYYY-MM-DD" string, None if the link does not contain one
+    """
+    match = re.search(r"(?:pre|post)-event/(\d{4}-\d{2}-\d{2})/", link)
+    if match is None:
+        return None
+    return match.group(1)
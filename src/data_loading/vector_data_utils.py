@@ -1,9 +1,3 @@
-# Web scraping
-from importlib.resources import files
-# from msilib.schema import ComboBox
-import requests
-import urllib
-
 # Handling geojson files
 import geopandas as gpd
 import pandas as pd
@@ -11,24 +5,32 @@ import numpy as np
 # Each building label is represented as a Point object
 # From shapely
 from shapely.geometry.point import Point 
+from shapely.geometry import box
 # Finds the country
 import country_bounding_boxes as cbb
 from rasterio.coords import BoundingBox
 
+# Reading many files at once
+from concurrent.futures import ThreadPoolExecutor
+
 # Others
-from typing import List
-import zipfile
+from typing import List, Optional
+from functools import lru_cache
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from data_loading.utils import *
 from data_loading.tif_links_utils import get_list_of_bounds_for_hurricane
+from data_loading.download_utils import download_file, download_files, extract_archive
+from data_loading.instrumentation_utils import instrumented_run, stage, count
 
 def get_vector_data_links(hurricane_name = DEFAULT_HURRICANE, toprint = True) -> List:
     """
     Get a list of vector data links for the hurricane with hurricane_name
     The list must exist on github
     """
+    # Web scraping, only imported when needed
+    import requests
     filename = hurricane_name + FILE_LIST_SUFFIX
     file_list_path = FILE_LIST_PREFIX + filename
     response = requests.get(file_list_path)
@@ -40,25 +42,23 @@ def get_vector_data_links(hurricane_name = DEFAULT_HURRICANE, toprint = True) ->
     print_message(toprint, f"There are in total {len(links)} links.")
     return links
 
-def load_vector_data_link(vector_data_link, hurricane_name = DEFAULT_HURRICANE):
+def get_raw_vector_data_dir(hurricane_name = DEFAULT_HURRICANE) -> str:
     """
-    Given a link to the vector data, will download the (zip) file & extract it 
-    Will save the file in the correct directory in /data
+    Where the vector data of the hurricane is extracted to
     """
-    # Download and extract the zip file
-    filename = vector_data_link.split("/")[-1] # name of the zip file
-    destination_dir = os.path.join(PATH_TO_DATA_RAW, f"{hurricane_name}-vector-data")
-    
-    if not os.path.isdir(destination_dir):
-        os.mkdir(destination_dir)
-    if not os.path.isfile(filename):
-        urllib.request.urlretrieve(vector_data_link, filename=filename)
+    return os.path.join(PATH_TO_DATA_RAW, f"{hurricane_name}-vector-data")
 
-    with zipfile.ZipFile(filename, 'r') as zip_ref:
-        zip_ref.extractall(destination_dir)
+def load_vector_data_link(vector_data_link, hurricane_name = DEFAULT_HURRICANE, cache_dir = None):
+    """
+    Given a link to the vector data, will download the (zip) file & extract it 
+    Will save the file in the correct directory in /data
 
-    # After extraction, delete the zip file
-    os.remove(os.path.join(PATH_TO_DIR,filename))
+    The zip file is kept in the download cache (see download_utils.download_file),
+    so it is only downloaded again if it changes, and only extracted again if it
+    changed since it was last extracted
+    """
+    destination_dir = get_raw_vector_data_dir(hurricane_name)
+    extract_archive(download_file(vector_data_link, cache_dir), destination_dir)
     return destination_dir
 
 def find_all_files_with_extension_in_dir(dirname, desired_extension, files = []):
@@ -80,88 +80,272 @@ def find_all_files_with_extension_in_dir(dirname, desired_extension, files = [])
                     files.append(name.path)
     return files
 
-def load_all_vector_data_for_hurricane(hurricane_name = DEFAULT_HURRICANE, toprint = True) -> List:
+def load_all_vector_data_for_hurricane(hurricane_name = DEFAULT_HURRICANE, toprint = True, max_workers = DOWNLOAD_MAX_WORKERS, cache_dir = None) -> List:
     """
+    Downloads the zip files of the vector data max_workers at a time, then
+    extracts the ones that changed (see load_vector_data_link)
+
     RETURNS
     ---
         files: a list of paths to all the geojson files related to hurricane_name
     """
     links = get_vector_data_links(hurricane_name, toprint)
-    count = len(links)
-    print_message(toprint, "Extracting files...")
-    if count == 0:
+    if len(links) == 0:
         raise ValueError("No links available!")
-    for (link, idx) in zip(links, list(range(count))):
-        print_message(toprint, f"{idx+1}/{count}")
-        destination_dir = load_vector_data_link(link, hurricane_name)
+    print_message(toprint, "Downloading files...")
+    with stage("download"):
+        downloads = download_files(links, cache_dir, max_workers, toprint)
+    count("archives_downloaded", sum(download.downloaded > 0 for download in downloads.values()))
+    count("bytes_downloaded", sum(download.downloaded for download in downloads.values()))
+    destination_dir = get_raw_vector_data_dir(hurricane_name)
+    print_message(toprint, "Extracting files...")
+    with stage("extract"):
+        extracted = sum(extract_archive(downloads[link], destination_dir) for link in downloads)
+    count("archives_extracted", extracted)
+    print_message(toprint, f"{extracted}/{len(downloads)} files extracted, the others had not changed")
     print_message(toprint, f"Extracted files can be found in {destination_dir}")
     geojson_files = find_all_files_with_extension_in_dir(destination_dir, ".geojson", [])
     print_message(toprint, f"There are {len(geojson_files)} geojson files available")
     return geojson_files
 
-def combine_all_vector_data(hurricane_name, toprint, overwrite):
+def get_vector_data_engine() -> str:
     """
-    Combines all geojson files for the hurricane into one geojson file
-    The combined file will be saved in data/processed/geojson
+    The engine used by gpd.read_file: pyogrio if it is installed
+    (much faster, and can stream through arrow), fiona otherwise
+    """
+    try:
+        import pyogrio
+        return "pyogrio"
+    except ImportError:
+        return "fiona"
+
+def normalize_vector_data(gdf: gpd.GeoDataFrame, source: str) -> gpd.GeoDataFrame:
+    """
+    Brings the vector data from any source to the columns in VECTOR_DATA_COLUMNS:
+        source: where the rows come from (e.g. the name of the file)
+        damage: the damage label, taken from the first column of DAMAGE_COLUMN_ALIASES
+            that the source has ("label" for the crowdsourced data, "LEVEL_" for the
+            official damage assessments); missing if there is none
+        geometry: in VECTOR_DATA_CRS
+    """
+    if gdf.crs is not None and gdf.crs != VECTOR_DATA_CRS:
+        gdf = gdf.to_crs(VECTOR_DATA_CRS)
+    damage = None
+    for column in DAMAGE_COLUMN_ALIASES:
+        if column in gdf.columns:
+            damage = gdf[column].to_numpy()
+            break
+    return gpd.GeoDataFrame(
+        {"source": source, "damage": damage},
+        geometry = gdf.geometry.values,
+        crs = VECTOR_DATA_CRS,
+        columns = VECTOR_DATA_COLUMNS,
+    )
+
+def iter_vector_data_batches(path, batch_size, engine = None):
+    """
+    Reads the file at path batch_size rows at a time, so that only one batch
+    is held in memory. With pyogrio the file is streamed through arrow,
+    otherwise every batch is read with gpd.read_file(rows = ...)
+    """
+    if engine is None:
+        engine = get_vector_data_engine()
+    if engine == "pyogrio":
+        from pyogrio.raw import open_arrow
+        try:
+            stream = open_arrow(path, batch_size = batch_size, use_pyarrow = True)
+        except TypeError:
+            # Older pyogrio always returns a pyarrow reader
+            stream = open_arrow(path, batch_size = batch_size)
+        with stream as (meta, reader):
+            geometry_name = meta["geometry_name"] or "wkb_geometry"
+            for batch in reader:
+                df = batch.to_pandas()
+                geometry = gpd.GeoSeries.from_wkb(df.pop(geometry_name), crs = meta["crs"])
+                yield gpd.GeoDataFrame(df, geometry = geometry.values, crs = meta["crs"])
+        return
+    start = 0
+    while True:
+        batch = gpd.read_file(path, rows = slice(start, start + batch_size), engine = engine)
+        if len(batch) > 0:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        start += batch_size
+
+def read_vector_data_file(path, batch_size = None, engine = None) -> gpd.GeoDataFrame:
+    """
+    Reads and normalizes one file, batch by batch if batch_size is given
+    """
+    if engine is None:
+        engine = get_vector_data_engine()
+    source = os.path.splitext(os.path.basename(path))[0]
+    if batch_size is None:
+        return normalize_vector_data(gpd.read_file(path, engine = engine), source)
+    # Only the normalized (much smaller) batches are kept
+    batches = [
+        normalize_vector_data(batch, source)
+        for batch in iter_vector_data_batches(path, batch_size, engine)
+    ]
+    if len(batches) == 0:
+        return normalize_vector_data(gpd.GeoDataFrame(geometry = [], crs = VECTOR_DATA_CRS), source)
+    return pd.concat(batches, ignore_index = True)
+
+def read_vector_data_files(files: List, toprint = True, max_workers = VECTOR_DATA_MAX_WORKERS, batch_size = None) -> gpd.GeoDataFrame:
+    """
+    Reads the geojson files at once with a pool of max_workers threads
+    and combines them into one GeoDataFrame
+
+    PARAMETERS:
+    ---
+        files: a list of paths
+        toprint: whether or not to print progress
+        max_workers: maximum number of files read at the same time
+        batch_size: if given, read each file batch_size rows at a time
+            (for files too large to be read in one go)
+
+    RETURNS:
+    ---
+        A GeoDataFrame with the columns VECTOR_DATA_COLUMNS,
+        with the rows of the files in the same order as files
+    """
+    assert len(files) > 0, "No files to read!"
+    engine = get_vector_data_engine()
+    print_message(toprint, f"Reading {len(files)} files with {engine}...")
+    with ThreadPoolExecutor(max_workers = min(max_workers, len(files))) as executor:
+        frames = list(executor.map(lambda path: read_vector_data_file(path, batch_size, engine), files))
+    # Concatenate once, not one file at a time
+    return pd.concat(frames, ignore_index = True)
+
+def get_vector_data_path(name, extension = ".parquet") -> str:
+    """
+    Where the processed vector data called name is saved:
+        data/processed/vector-data/<name>.parquet (GeoParquet, the main format)
+        data/processed/geojsons/<name>.geojson (only if exported)
+    """
+    dirname = PATH_TO_VECTOR_DATA if extension == ".parquet" else PATH_TO_GEOJSONS
+    return os.path.join(dirname, name + extension)
+
+def save_vector_data(gdf: gpd.GeoDataFrame, name, toprint = True, export_geojson = False) -> str:
+    """
+    Saves gdf as GeoParquet and, if export_geojson, also as a geojson file
+
+    RETURNS:
+    ---
+        The path to the GeoParquet file
+    """
+    path = get_vector_data_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    gdf.to_parquet(path, index = False, row_group_size = VECTOR_DATA_ROW_GROUP_SIZE)
+    print_message(toprint, f"Successfully saved vector data as a GeoParquet file to:\n{path}")
+    if export_geojson:
+        geojson_path = get_vector_data_path(name, ".geojson")
+        os.makedirs(os.path.dirname(geojson_path), exist_ok = True)
+        gdf.to_file(geojson_path, driver = "GeoJSON")
+        print_message(toprint, f"Successfully saved vector data as a geojson file to:\n{geojson_path}")
+    return path
+
+def load_vector_data(name, columns: List = None, filters: List = None) -> gpd.GeoDataFrame:
+    """
+    Loads the processed vector data called name (e.g. the hurricane name),
+    reading only the columns and the rows that are asked for
+
+    PARAMETERS:
+    ---
+        name: the name it was saved under by save_vector_data
+        columns: the columns to read (the geometry is always read), all by default
+        filters: pyarrow filters, e.g. [("exist_pre_event_imagery", "==", True), ("country", "==", "Anguilla")];
+            row groups that cannot match are not read at all
+
+    EXAMPLE:
+    ---
+        load_vector_data("irma", ["country"], [("exist_pre_event_imagery", "==", True)])
+    """
+    if columns is not None and "geometry" not in columns:
+        columns = list(columns) + ["geometry"]
+    return gpd.read_parquet(get_vector_data_path(name), columns = columns, filters = filters)
+
+def combine_all_vector_data(hurricane_name, toprint, overwrite, max_workers = VECTOR_DATA_MAX_WORKERS, batch_size = None, export_geojson = False):
+    """
+    Combines all geojson files for the hurricane into one GeoParquet file
+    The combined file will be saved in data/processed/vector-data
 
     PARAMETERS:
     ---
         hurricane_name: name of the hurricane
         toprint: whether or not to print progress
         overwrite: whether or not to overwrite existing processed vector data
+        max_workers, batch_size: passed on to read_vector_data_files
+        export_geojson: whether or not to also save it in data/processed/geojsons
     """
-    # This is the path to the processed vector data file
-    if not os.path.isdir(PATH_TO_GEOJSONS):
-        os.mkdir(PATH_TO_GEOJSONS)
-    path = os.path.join(PATH_TO_GEOJSONS, hurricane_name + ".geojson")
+    # The combined (not yet trimmed) vector data
+    name = hurricane_name + "-combined"
     # If there is already a processed data file
-    if os.path.isfile(path) and not overwrite: 
-        return gpd.read_file(path)
+    if os.path.isfile(get_vector_data_path(name)) and not overwrite: 
+        return load_vector_data(name)
     print_message(toprint, f"Retrieving all vector data files for hurricane {hurricane_name}...")
     files = load_all_vector_data_for_hurricane(hurricane_name, toprint)
     assert len(files) > 0, f"No geojson data files available for hurricane {hurricane_name}!"
-    path = files.pop()
-    res = gpd.read_file(path)
-    while len(files) > 0:
-        path = files.pop()
-        temp = gpd.read_file(path)
-        res = pd.concat([res, temp])
+    res = read_vector_data_files(files, toprint, max_workers, batch_size)
     print_message(toprint, f"There are in total {len(res)} rows")
-    res.to_file(path, driver="GeoJSON")
-    print_message(toprint, f"Successfully saved vector data as a geojson file to:\n{path}")
+    save_vector_data(res, name, toprint, export_geojson)
     return res
 
 
-def combine_all_vector_data_and_save_for_hurricane(hurricane_name = DEFAULT_HURRICANE, toprint = True, overwrite = False):
-    # This is the path to the processed vector data file
-    if not os.path.isdir(PATH_TO_GEOJSONS):
-        os.mkdir(PATH_TO_GEOJSONS)
-    path = os.path.join(PATH_TO_GEOJSONS, hurricane_name + ".geojson")
-    # If there is already a processed data file
-    if os.path.isfile(path) and not overwrite: 
-        return gpd.read_file(path)
+def combine_all_vector_data_and_save_for_hurricane(hurricane_name = DEFAULT_HURRICANE, toprint = True, overwrite = False, max_workers = VECTOR_DATA_MAX_WORKERS, batch_size = None, export_geojson = False, metrics = None, max_distance = DAMAGE_ASSESSMENT_MAX_DISTANCE):
+    """
+    Combines, trims, filters and tags with countries all the vector data of the
+    hurricane, and saves it in data/processed/vector-data/<hurricane_name>.parquet
 
-    res = combine_all_vector_data(hurricane_name, toprint, overwrite=True)
+    If the hurricane has official damage assessments (see DAMAGE_ASSESSMENT_DIRS),
+    every building also gets the grade of the nearest one at most max_distance
+    meters away (see add_damage_assessments)
 
-    # We only keep the points
-    # for which we have image data
-    print_message(toprint, "Trimming...")
-    trimmed = trim_gdf(gpd.GeoDataFrame(res), hurricane_name, toprint)
-    print_message(toprint, f"There are {len(trimmed)} buildings in total after trimming")
-    
-    # We only want points that are buildings, not other things
-    print_message(toprint, "Filtering...")
-    trimmed_filtered = trimmed.loc[trimmed.label == "Flooded / Damaged Building"].copy()
-    print_message(toprint, f"There are {len(trimmed_filtered)} buildings in total after filtering")
-    
-    # Add country names
-    print_message(toprint, "Adding country names...")
-    add_country_names(trimmed_filtered, hurricane_name, toprint)
+    A table of where the time went is printed at the end; metrics is where to
+    write the timings and counters too (see instrumentation_utils.Instrumentation)
+    """
+    with instrumented_run("vector-data", toprint, metrics):
+        # If there is already a processed data file
+        if os.path.isfile(get_vector_data_path(hurricane_name)) and not overwrite: 
+            with stage("load"):
+                return load_vector_data(hurricane_name)
+
+        with stage("combine"):
+            res = combine_all_vector_data(hurricane_name, toprint, overwrite=True, max_workers=max_workers, batch_size=batch_size, export_geojson=export_geojson)
+        count("rows_read", len(res))
+
+        # We only keep the points
+        # for which we have image data
+        print_message(toprint, "Trimming...")
+        with stage("trim"):
+            trimmed = trim_gdf(gpd.GeoDataFrame(res), hurricane_name, toprint)
+        print_message(toprint, f"There are {len(trimmed)} buildings in total after trimming")
+        count("rows_with_imagery", len(trimmed))
+        
+        # We only want points that are buildings, not other things
+        print_message(toprint, "Filtering...")
+        with stage("filter"):
+            trimmed_filtered = trimmed.loc[trimmed.damage == "Flooded / Damaged Building"].copy()
+        print_message(toprint, f"There are {len(trimmed_filtered)} buildings in total after filtering")
+        count("buildings_kept", len(trimmed_filtered))
 
-    # Save processed vector data
-    trimmed_filtered.to_file(path, driver="GeoJSON")
-    print_message(toprint, f"Successfully saved trimmed vector data as a geojson file to:\n{path}")
-    return trimmed_filtered
+        # Grade the buildings with the official damage assessments, if there are any
+        with stage("assessments"):
+            assessments = load_damage_assessments(hurricane_name, toprint)
+            if assessments is not None:
+                print_message(toprint, "Adding official damage assessments...")
+                add_damage_assessments(trimmed_filtered, assessments, toprint, max_distance)
+                count("buildings_with_official_damage", int(trimmed_filtered["official_damage"].notna().sum()))
+        
+        # Add country names
+        print_message(toprint, "Adding country names...")
+        with stage("countries"):
+            add_country_names(trimmed_filtered, hurricane_name, toprint)
+
+        # Save processed vector data
+        with stage("save"):
+            save_vector_data(trimmed_filtered, hurricane_name, toprint, export_geojson)
+        return trimmed_filtered
 
 def check_point_in_bounding_box(point: Point, box: BoundingBox):
     return (box.left < point.x < box.right) and  (box.bottom < point.y < box.top)
@@ -178,6 +362,37 @@ def exist_link_containing_point(point: Point, bounds_list: List) -> bool:
             return True
     return False
 
+def make_footprints_gdf(bounds_dict: dict, crs = None) -> gpd.GeoDataFrame:
+    """
+    PARAMETERS:
+    ---
+        bounds_dict: a dictionary from phase ("pre"/"post") to a list of BoundingBox,
+            e.g. from get_list_of_bounds_for_hurricane
+
+    RETURNS:
+    ---
+        A GeoDataFrame with one box per scene and a "phase" column
+    """
+    phases = [phase for phase in bounds_dict.keys() for _ in bounds_dict[phase]]
+    boxes = [box(*bound) for phase in bounds_dict.keys() for bound in bounds_dict[phase]]
+    return gpd.GeoDataFrame({"phase": phases}, geometry = boxes, crs = crs)
+
+def add_imagery_columns(gdf: gpd.GeoDataFrame, footprints: gpd.GeoDataFrame):
+    """
+    Adds the columns exist_pre_event_imagery and exist_post_event_imagery to gdf,
+    with one spatial join against the footprints (from make_footprints_gdf).
+    A point is "within" a box only if it is strictly inside it,
+    the same as check_point_in_bounding_box
+    """
+    # Join on positions, the index of gdf is not necessarily unique
+    points = gpd.GeoDataFrame(geometry = gdf.geometry.values, crs = footprints.crs)
+    joined = gpd.sjoin(points, footprints, how = "inner", predicate = "within")
+    positions = np.arange(len(gdf))
+    for phase in ["post", "pre"]:
+        hits = joined.index[joined["phase"].to_numpy() == phase]
+        gdf[f"exist_{phase}_event_imagery"] = np.isin(positions, hits)
+    return gdf
+
 def trim_gdf(gdf: gpd.GeoDataFrame, hurricane_name, toprint):
     """
     This trims down the geodataframe 
@@ -188,24 +403,10 @@ def trim_gdf(gdf: gpd.GeoDataFrame, hurricane_name, toprint):
     """
     print_message(toprint, "Getting list of bounds...")
     bounds_dict = get_list_of_bounds_for_hurricane(hurricane_name, toprint)
-    pre_image_cnt = len(bounds_dict["pre"])
-    post_image_cnt = len(bounds_dict["post"])
-    print_message(toprint, f"There are {pre_image_cnt} links of pre-images")
-    print_message(toprint, f"There are {post_image_cnt} links of post-images")
-    gdf["exist_post_event_imagery"] = gdf.geometry.apply(
-        lambda point: exist_link_containing_point(
-            point=point,
-            bounds_list=bounds_dict["post"]
-        )
-    )
+    print_message(toprint, f"There are {len(bounds_dict['pre'])} links of pre-images")
+    print_message(toprint, f"There are {len(bounds_dict['post'])} links of post-images")
+    add_imagery_columns(gdf, make_footprints_gdf(bounds_dict, gdf.crs))
     print_message(toprint, f"There are {len(gdf.loc[gdf.exist_post_event_imagery])} buildings with post-event imagery")
-    
-    gdf["exist_pre_event_imagery"] = gdf.geometry.apply(
-        lambda point: exist_link_containing_point(
-            point=point,
-            bounds_list=bounds_dict["pre"]
-        )
-    )
     print_message(toprint, f"There are {len(gdf.loc[gdf.exist_pre_event_imagery])} buildings with pre-event imagery")
     
     return gdf.loc[
@@ -215,6 +416,98 @@ def trim_gdf(gdf: gpd.GeoDataFrame, hurricane_name, toprint):
         )
     ]
 
+def load_damage_assessments(hurricane_name = DEFAULT_HURRICANE, toprint = True) -> Optional[gpd.GeoDataFrame]:
+    """
+    RETURNS:
+    ---
+        The official damage assessments of the hurricane (see DAMAGE_ASSESSMENT_DIRS)
+        with the columns VECTOR_DATA_COLUMNS, the grade being in "damage";
+        None if it has none
+    """
+    dirname = DAMAGE_ASSESSMENT_DIRS.get(hurricane_name)
+    if dirname is None or not os.path.isdir(dirname):
+        return None
+    files = sorted(find_all_files_with_extension_in_dir(dirname, ".geojson", []))
+    if len(files) == 0:
+        return None
+    return read_vector_data_files(files, toprint)
+
+def get_utm_zones(xs) -> np.ndarray:
+    """
+    The UTM zone (1 to 60) of every longitude of xs
+    """
+    return (np.floor((np.asarray(xs, dtype = float) + 180) / 6).astype(np.int64) % 60) + 1
+
+def get_utm_crs(zone, north = True) -> str:
+    return f"EPSG:{(32600 if north else 32700) + int(zone)}"
+
+def join_nearest_assessments(gdf: gpd.GeoDataFrame, assessments: gpd.GeoDataFrame, max_distance = DAMAGE_ASSESSMENT_MAX_DISTANCE) -> tuple:
+    """
+    Finds the nearest assessment (a point or a polygon) of every point of gdf,
+    with one nearest-neighbour spatial join (gpd.sjoin_nearest, over an R-tree)
+    per UTM zone of the points: the points and the assessments up to max_distance
+    beyond the edges of the zone are projected to it, so that distances are in meters
+    and accurate wherever the points are
+
+    PARAMETERS:
+    ---
+        gdf: the points, e.g. the crowdsourced buildings
+        assessments: e.g. from load_damage_assessments
+        max_distance: in meters, points with no assessment this close get none
+
+    RETURNS:
+    ---
+        (positions, distances) arrays, one entry per point of gdf: the position in
+        assessments of the nearest assessment (the first of them if several are as
+        close), -1 if there is none; and its distance in meters, nan if there is none
+    """
+    positions = np.full(len(gdf), -1, dtype = np.int64)
+    distances = np.full(len(gdf), np.nan)
+    if len(gdf) == 0 or len(assessments) == 0:
+        return (positions, distances)
+    points = gdf.geometry.to_crs(VECTOR_DATA_CRS).values if gdf.crs is not None else gdf.geometry.values
+    others = assessments.geometry.to_crs(VECTOR_DATA_CRS).values if assessments.crs is not None else assessments.geometry.values
+    # Without a crs, so that geopandas does not warn about centroids in degrees
+    centers = gpd.GeoSeries(np.asarray(points)).centroid
+    (xs, ys) = (centers.x.to_numpy(), centers.y.to_numpy())
+    bounds = gpd.GeoSeries(others).bounds.to_numpy()
+    zones = get_utm_zones(xs)
+    for zone in np.unique(zones):
+        members = np.flatnonzero(zones == zone)
+        # The assessments the points of this zone can reach
+        west = -180 + 6 * (int(zone) - 1)
+        margin = convert_meters_to_deg_lon(max_distance, min(np.abs(ys[members]).max(), 89))
+        candidates = np.flatnonzero((bounds[:, 2] >= west - margin) & (bounds[:, 0] <= west + 6 + margin))
+        if len(candidates) == 0:
+            continue
+        crs = get_utm_crs(zone, np.mean(ys[members]) >= 0)
+        left = gpd.GeoDataFrame(geometry = points[members], crs = VECTOR_DATA_CRS).to_crs(crs)
+        right = gpd.GeoDataFrame({"position": candidates}, geometry = others[candidates], crs = VECTOR_DATA_CRS).to_crs(crs)
+        joined = gpd.sjoin_nearest(left, right, how = "inner", max_distance = max_distance, distance_col = "distance")
+        # Assessments as close as each other: keep the first one
+        joined = joined.rename_axis("member").sort_values(["member", "position"])
+        joined = joined.loc[~joined.index.duplicated()]
+        hits = members[joined.index.to_numpy()]
+        positions[hits] = joined["position"].to_numpy()
+        distances[hits] = joined["distance"].to_numpy()
+    return (positions, distances)
+
+def add_damage_assessments(gdf: gpd.GeoDataFrame, assessments: gpd.GeoDataFrame, toprint = True, max_distance = DAMAGE_ASSESSMENT_MAX_DISTANCE):
+    """
+    Adds two columns to gdf, from the nearest official assessment of every point
+    at most max_distance meters away (see join_nearest_assessments):
+        official_damage: its grade (the "damage" column of assessments), None if there is none
+        official_distance: how far it is, in meters (nan if there is none)
+    """
+    (positions, distances) = join_nearest_assessments(gdf, assessments, max_distance)
+    found = positions >= 0
+    grades = np.full(len(gdf), None, dtype = object)
+    grades[found] = assessments["damage"].to_numpy()[positions[found]]
+    gdf["official_damage"] = grades
+    gdf["official_distance"] = distances
+    print_message(toprint, f"{found.sum()} of {len(gdf)} buildings have an official damage assessment within {max_distance}m")
+    return gdf
+
 def find_countries_for_point(point: Point) -> str:
     """
     Find the country that the point is in
@@ -226,24 +519,62 @@ def find_countries_for_point(point: Point) -> str:
     cs = [c.name for c in cbb.country_subunits_containing_point(point.x, point.y)]
     return ", ".join(cs)
 
-def add_country_names(gdf: gpd.GeoDataFrame, hurricane_name, toprint):
-    gdf["country"] = gdf.geometry.apply(
-        lambda point: find_countries_for_point(point)
+@lru_cache(maxsize = None)
+def get_country_subunits_gdf() -> gpd.GeoDataFrame:
+    """
+    The bounding boxes of all the country subunits from country_bounding_boxes,
+    as a GeoDataFrame (built once, then cached)
+    """
+    return gpd.GeoDataFrame(
+        {
+            "name": [c.name for c in cbb.countries],
+            "order": np.arange(len(cbb.countries)),
+        },
+        geometry = [box(*c.bbox) for c in cbb.countries],
+        crs = "EPSG:4326",
     )
+
+def join_country_subunits(gdf: gpd.GeoDataFrame) -> pd.DataFrame:
+    """
+    RETURNS:
+    ---
+        One row per (point, country subunit containing it), with the position
+        of the point in gdf as index and the name of the subunit in a "name" column
+    """
+    subunits = get_country_subunits_gdf()
+    # Boxes include their boundary, the same as cbb.country_subunits_containing_point
+    points = gpd.GeoDataFrame(geometry = gdf.geometry.values, crs = subunits.crs)
+    joined = gpd.sjoin(points, subunits, how = "inner", predicate = "intersects")
+    return joined.rename_axis("position").sort_values(["position", "order"])[["name"]]
+
+def get_country_names(gdf: gpd.GeoDataFrame, joined: pd.DataFrame = None) -> np.ndarray:
+    """
+    Vectorized version of find_countries_for_point for every point of gdf
+    (joined is the result of join_country_subunits, if already computed)
+    """
+    if joined is None:
+        joined = join_country_subunits(gdf)
+    positions = joined.index.to_numpy()
+    matches = joined["name"].to_numpy()
+    res = np.full(len(gdf), "", dtype = object)
+    # Most points are in a single subunit, only join the names of the others
+    (starts, counts) = np.unique(positions, return_index = True, return_counts = True)[1:]
+    single = counts == 1
+    res[positions[starts[single]]] = matches[starts[single]]
+    for (start, count) in zip(starts[~single], counts[~single]):
+        res[positions[start]] = ", ".join(matches[start:start + count])
+    return res
+
+def add_country_names(gdf: gpd.GeoDataFrame, hurricane_name, toprint):
+    joined = join_country_subunits(gdf)
+    gdf["country"] = get_country_names(gdf, joined)
     if toprint:
-        countries = {}
-        for p in gdf.geometry.tolist():
-            cs = [c.name for c in cbb.country_subunits_containing_point(p.x, p.y)]
-            for c in cs:
-                if c not in countries.keys():
-                    countries[c] = 1
-                else:
-                    countries[c] += 1
+        countries = joined["name"].value_counts()
         print(f"The countries in the dataset for {hurricane_name} are: ")
-        for c in countries.keys():
-            print(c," ",countries[c])
+        for (c, count) in countries.items():
+            print(c," ",count)
         print("---------------")
-        print("Total: ", sum([countries[c] for c in countries.keys()]))
+        print("Total: ", countries.sum())
 
 if __name__ == "__main__":
     df = combine_all_vector_data_and_save_for_hurricane("test",toprint=True,overwrite=True)
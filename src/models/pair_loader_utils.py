@@ -0,0 +1,380 @@
+# Handle tif files
+import rasterio as rio
+import numpy as np
+
+# Loading batches in the background
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import multiprocessing
+import tempfile
+import time
+import re
+
+# Others
+from typing import List, NamedTuple
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.patch_store_utils import get_patch_store_paths, load_patch_store, load_patch_store_index
+
+# Decoded samples are kept in a memory-mapped file here, so that every worker can see them
+SHARED_MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+PATCH_FILENAME = re.compile(r"^(\d+)-(\d+)\.tif$")
+
+class PatchPair(NamedTuple):
+    """
+    The pre and post event patches of one building: with output "gtiff" pre and post
+    are the paths to the tif files, with output "npy" they are rows in the array stores
+    """
+    point_idx: int
+    pre: object
+    post: object
+
+class PairBatch(NamedTuple):
+    """
+    images: a (B, 2, C, H, W) array, images[:, 0] are the pre event patches and images[:, 1] the post event ones
+    point_idx: the row of each building in the processed vector data, to look up its label
+    """
+    images: np.ndarray
+    point_idx: np.ndarray
+
+def _first_patch_per_point(points, seqs, refs) -> dict:
+    """
+    RETURNS:
+    ---
+        A dictionary from point index to the ref with the lowest seq (the first image it was cropped from)
+    """
+    res, lowest = dict(), dict()
+    for (point_idx, seq, ref) in zip(points, seqs, refs):
+        if point_idx not in lowest or seq < lowest[point_idx]:
+            lowest[point_idx] = seq
+            res[point_idx] = ref
+    return res
+
+def find_patch_pairs(path_to_hurricane_patches, output = "gtiff") -> List:
+    """
+    Pairs the pre and post event patches saved by patch_utils.main by point index.
+    A building that was cropped from several images of the same phase gets the first of them,
+    and a building that is missing from either phase is left out
+
+    PARAMETERS:
+    ---
+        path_to_hurricane_patches: e.g. data/processed/patches/<hurricane_name>
+        output: "gtiff" for the {pre,post}/{point_idx}-{i}.tif files,
+            "npy" for the {pre,post}.npy array stores
+
+    RETURNS:
+    ---
+        A list of PatchPair, sorted by point index
+    """
+    found = dict()
+    for phase in ["pre", "post"]:
+        if output == "gtiff":
+            path_to_dir = os.path.join(path_to_hurricane_patches, phase)
+            matches = [PATCH_FILENAME.match(filename) for filename in sorted(os.listdir(path_to_dir))]
+            matches = [match for match in matches if match is not None]
+            found[phase] = _first_patch_per_point(
+                [int(match.group(1)) for match in matches],
+                [int(match.group(2)) for match in matches],
+                [os.path.join(path_to_dir, match.group(0)) for match in matches],
+            )
+        elif output == "npy":
+            # The rows of the patches skipped because of nodata are all zeros
+            index = load_patch_store_index(os.path.join(path_to_hurricane_patches, phase), ["patch_idx", "point_idx", "seq"], written_only = True)
+            found[phase] = _first_patch_per_point(
+                index["point_idx"].tolist(), index["seq"].tolist(), index["patch_idx"].tolist()
+            )
+        else:
+            raise ValueError(f"Unknown output format {output}")
+    points = sorted(set(found["pre"]) & set(found["post"]))
+    return [PatchPair(point_idx, found["pre"][point_idx], found["post"][point_idx]) for point_idx in points]
+
+def fit_patch(data: np.ndarray, shape, fit = "pad") -> np.ndarray:
+    """
+    Brings a (bands, height, width) patch to shape = (C, H, W). Extra bands are
+    dropped and missing ones are zeros
+
+    PARAMETERS:
+    ---
+        fit: "pad" to crop or pad with zeros around the centre, so the pixels keep their size;
+            "resize" to resample to H x W (nearest neighbour)
+    """
+    (count, height, width) = shape
+    res = np.zeros(shape, dtype = data.dtype)
+    data = data[:count]
+    if data.shape[1] == 0 or data.shape[2] == 0:
+        return res
+    if fit == "resize":
+        rows = np.minimum((np.arange(height) + 0.5) * data.shape[1] / height, data.shape[1] - 1).astype(int)
+        cols = np.minimum((np.arange(width) + 0.5) * data.shape[2] / width, data.shape[2] - 1).astype(int)
+        res[:data.shape[0]] = data[:, rows[:, None], cols[None, :]]
+    elif fit == "pad":
+        # Crop around the centre first...
+        top = max(data.shape[1] - height, 0) // 2
+        left = max(data.shape[2] - width, 0) // 2
+        data = data[:, top:top + height, left:left + width]
+        # ... then pad around the centre
+        top = (height - data.shape[1]) // 2
+        left = (width - data.shape[2]) // 2
+        res[:data.shape[0], top:top + data.shape[1], left:left + data.shape[2]] = data
+    else:
+        raise ValueError(f"Unknown fit {fit}")
+    return res
+
+# Array stores opened by this process, by path
+_open_stores = dict()
+
+def read_patch(path_to_hurricane_patches, output, phase, ref) -> np.ndarray:
+    """
+    RETURNS:
+    ---
+        The (bands, height, width) patch ref of phase, as saved by patch_utils.main
+    """
+    if output == "gtiff":
+        with rio.open(ref) as src:
+            return src.read()
+    path_to_store = os.path.join(path_to_hurricane_patches, phase)
+    if path_to_store not in _open_stores:
+        _open_stores[path_to_store] = load_patch_store(path_to_store)
+    (patches, index) = _open_stores[path_to_store]
+    row = index.iloc[ref]
+    return np.asarray(patches[ref, :row["count"], :row["height"], :row["width"]])
+
+class SampleCache:
+    """
+    Decoded (2, C, H, W) samples, in a memory-mapped file in shared memory
+    (/dev/shm where there is one). Workers write the samples they decode and
+    the next epoch reads them back instead of decoding them again. Like
+    patch_store_utils.ArraySink, every process maps the file itself
+    """
+    def __init__(self, n, sample_shape, dtype, directory = None):
+        if directory is None:
+            directory = SHARED_MEMORY_DIR
+        (fd, self.path) = tempfile.mkstemp(prefix = "paired-patches-", suffix = ".npy", dir = directory)
+        os.close(fd)
+        # One flag per sample, set once the sample has been filled in
+        np.lib.format.open_memmap(self.path + ".filled", mode = "w+", dtype = np.uint8, shape = (n,)).flush()
+        np.lib.format.open_memmap(self.path, mode = "w+", dtype = dtype, shape = (n,) + tuple(sample_shape)).flush()
+        self._samples = None
+        self._filled = None
+
+    def __getstate__(self):
+        return {"path": self.path, "_samples": None, "_filled": None}
+
+    def _map(self):
+        if self._samples is None:
+            self._samples = np.load(self.path, mmap_mode = "r+")
+            self._filled = np.load(self.path + ".filled", mmap_mode = "r+")
+
+    def filled(self, indices) -> np.ndarray:
+        self._map()
+        return self._filled[indices].astype(bool)
+
+    def get(self, indices) -> np.ndarray:
+        self._map()
+        return self._samples[indices]
+
+    def put(self, i, sample: np.ndarray):
+        self._map()
+        self._samples[i] = sample
+        self._filled[i] = 1
+
+    def close(self):
+        self._samples = None
+        self._filled = None
+        for path in [self.path, self.path + ".filled"]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+def load_pairs(path_to_hurricane_patches, output, pairs: List, shape, fit, dtype, cache: SampleCache = None, indices = None) -> np.ndarray:
+    """
+    Decodes a batch of pairs
+
+    PARAMETERS:
+    ---
+        cache: if given, the samples already in it are not decoded again, and the others are added
+        indices: the row of each pair in cache
+
+    RETURNS:
+    ---
+        A (len(pairs), 2, C, H, W) array
+    """
+    res = np.zeros((len(pairs), 2) + tuple(shape), dtype = dtype)
+    filled = cache.filled(indices) if cache is not None else np.zeros(len(pairs), dtype = bool)
+    # One GDAL environment for the whole batch rather than one per file
+    with rio.Env():
+        for (k, pair) in enumerate(pairs):
+            if filled[k]:
+                res[k] = cache.get(indices[k])
+                continue
+            for (j, phase, ref) in [(0, "pre", pair.pre), (1, "post", pair.post)]:
+                res[k, j] = fit_patch(read_patch(path_to_hurricane_patches, output, phase, ref), shape, fit)
+            if cache is not None:
+                cache.put(indices[k], res[k])
+    return res
+
+class PairedPatchLoader:
+    """
+    Batches of pre and post event patches for training, read from the output of patch_utils.main
+
+    Iterating over the loader goes through one epoch and yields PairBatch(images, point_idx),
+    with images of shape (batch_size, 2, C, H, W). With shuffle, the order of every epoch only
+    depends on seed and the epoch number, so a run can be repeated (or resumed with set_epoch)
+
+    EXAMPLE:
+    ---
+        with PairedPatchLoader("data/processed/patches/irma", batch_size = 32, shape = (3, 64, 64), workers = 4, cache = True) as loader:
+            for epoch in range(10):
+                for batch in loader:
+                    labels = gdf.damage.to_numpy()[batch.point_idx]
+                    ...
+    """
+    def __init__(self, path_to_hurricane_patches, pairs: List = None, output = "gtiff", batch_size = 32, shape = (3, 64, 64),
+            fit = "pad", shuffle = True, seed = 0, drop_last = False, workers = 0, prefetch = 2, cache = False, cache_dir = None):
+        """
+        PARAMETERS:
+        ---
+            path_to_hurricane_patches: e.g. data/processed/patches/<hurricane_name>
+            pairs: the PatchPairs to load, by default all of them (see find_patch_pairs)
+            output: "gtiff" or "npy", the output format the patches were saved in
+            shape: (C, H, W) every patch is brought to (see fit_patch)
+            fit: "pad" or "resize" (see fit_patch)
+            drop_last: whether or not to drop the last batch if it is smaller than batch_size
+            workers: number of worker processes decoding batches, 0 to decode them in this process
+            prefetch: number of batches each worker decodes ahead
+            cache: whether or not to keep the decoded samples in shared memory after the first epoch
+            cache_dir: where to keep them, by default SHARED_MEMORY_DIR
+        """
+        if fit not in ["pad", "resize"]:
+            raise ValueError(f"Unknown fit {fit}")
+        self.path_to_hurricane_patches = path_to_hurricane_patches
+        self.output = output
+        self.pairs = find_patch_pairs(path_to_hurricane_patches, output) if pairs is None else list(pairs)
+        self.batch_size = batch_size
+        self.shape = tuple(shape)
+        self.fit = fit
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.workers = workers
+        self.prefetch = prefetch
+        self.epoch = 0
+        if len(self.pairs) > 0:
+            self.dtype = read_patch(path_to_hurricane_patches, output, "pre", self.pairs[0].pre).dtype
+        else:
+            self.dtype = np.dtype(np.uint8)
+        self._cache = SampleCache(len(self.pairs), (2,) + self.shape, self.dtype, cache_dir) if cache else None
+        self._executor = None
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.pairs) // self.batch_size
+        return -(-len(self.pairs) // self.batch_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stops the workers and frees the cache
+        """
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures = True)
+            self._executor = None
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+    def set_epoch(self, epoch):
+        """
+        The next iteration goes through epoch (in the same order as the first time it did)
+        """
+        self.epoch = epoch
+
+    def get_order(self, epoch) -> np.ndarray:
+        """
+        RETURNS:
+        ---
+            The indices into self.pairs in the order epoch goes through them
+        """
+        if not self.shuffle:
+            return np.arange(len(self.pairs))
+        return np.random.default_rng([self.seed, epoch]).permutation(len(self.pairs))
+
+    def get_batches(self, epoch) -> List:
+        order = self.get_order(epoch)
+        return [order[start:start + self.batch_size] for start in range(0, len(self) * self.batch_size, self.batch_size)]
+
+    def _load(self, indices) -> np.ndarray:
+        pairs = [self.pairs[i] for i in indices]
+        return load_pairs(self.path_to_hurricane_patches, self.output, pairs, self.shape, self.fit, self.dtype, self._cache, indices)
+
+    def _submit(self, indices):
+        if self._executor is None:
+            # Workers are spawned rather than forked: GDAL's state does not survive a fork
+            context = multiprocessing.get_context("spawn")
+            self._executor = ProcessPoolExecutor(max_workers = self.workers, mp_context = context)
+        # Only the pairs of the batch are sent to the worker
+        pairs = [self.pairs[i] for i in indices]
+        return self._executor.submit(
+            load_pairs, self.path_to_hurricane_patches, self.output, pairs,
+            self.shape, self.fit, self.dtype, self._cache, indices,
+        )
+
+    def __iter__(self):
+        batches = self.get_batches(self.epoch)
+        self.epoch += 1
+        point_idx = np.array([pair.point_idx for pair in self.pairs], dtype = np.int64)
+        if self.workers <= 0:
+            for indices in batches:
+                yield PairBatch(self._load(indices), point_idx[indices])
+            return
+        # Keep prefetch batches per worker in flight, and hand them out in order
+        pending = deque()
+        batches = iter(batches)
+        try:
+            while True:
+                while len(pending) < self.workers * max(self.prefetch, 1):
+                    indices = next(batches, None)
+                    if indices is None:
+                        break
+                    if self._cache is not None and self._cache.filled(indices).all():
+                        # Nothing to decode, no need to go through a worker
+                        pending.append((indices, None))
+                    else:
+                        pending.append((indices, self._submit(indices)))
+                if len(pending) == 0:
+                    return
+                (indices, future) = pending.popleft()
+                images = self._cache.get(indices) if future is None else future.result()
+                yield PairBatch(images, point_idx[indices])
+        finally:
+            for (_, future) in pending:
+                if future is not None:
+                    future.cancel()
+
+def measure_throughput(loader: PairedPatchLoader, epochs = 1) -> dict:
+    """
+    Goes through epochs of loader and times every one of them
+
+    RETURNS:
+    ---
+        A dictionary with the number of samples, the seconds taken and the
+        samples per second of every epoch (lists, first epoch first)
+    """
+    res = {"samples": [], "seconds": [], "samples_per_second": []}
+    for _ in range(epochs):
+        samples = 0
+        start = time.perf_counter()
+        for batch in loader:
+            samples += len(batch.point_idx)
+        seconds = time.perf_counter() - start
+        res["samples"].append(samples)
+        res["seconds"].append(seconds)
+        res["samples_per_second"].append(samples / seconds if seconds > 0 else float("inf"))
+    return res
@@ -0,0 +1,64 @@
+# Normalizing the patches before training
+import numpy as np
+
+# Others
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import *
+from data_loading.band_stats_utils import load_band_stats, group_band_stats, get_valid_pixels
+
+def get_normalization(stats: dict, phase, sensor = None, link = None) -> tuple:
+    """
+    The mean and standard deviation of every band over a group of scenes
+
+    PARAMETERS:
+    ---
+        stats: a dictionary from (phase, link) to BandStats, e.g. from load_band_stats
+        phase: "pre" or "post"
+        sensor: only the scenes taken by this satellite (see get_sensor_from_link), if given
+        link: only this scene, if given
+
+    RETURNS:
+    ---
+        (mean, std) arrays, one entry per band
+    """
+    if link is not None:
+        key = (phase, link)
+        groups = group_band_stats({key: stats[key]}, "scene") if key in stats else dict()
+    elif sensor is not None:
+        key = (phase, sensor)
+        groups = group_band_stats(stats, "sensor")
+    else:
+        key = phase
+        groups = group_band_stats(stats, "phase")
+    if key not in groups:
+        raise KeyError(f"No band statistics for {key}")
+    return (groups[key].mean.copy(), groups[key].std)
+
+def load_normalization(path_to_hurricane_patches, phase, sensor = None, link = None) -> tuple:
+    """
+    Same as get_normalization, with the statistics saved next to the patches
+    (by patch_utils.main with band_stats, or by python -m src band-stats)
+    """
+    stats = load_band_stats(path_to_hurricane_patches)
+    if stats is None:
+        raise FileNotFoundError(f"No band statistics in {path_to_hurricane_patches}, run python -m src band-stats first")
+    return get_normalization(stats, phase, sensor, link)
+
+def normalize_patch(data: np.ndarray, mean, std, nodata = None) -> np.ndarray:
+    """
+    Brings every band of a (bands, height, width) patch to zero mean and unit
+    standard deviation; nodata pixels (see get_valid_pixels) become 0
+
+    RETURNS:
+    ---
+        A float32 array of the same shape
+    """
+    bands = data.shape[0]
+    mean = np.asarray(mean, dtype = np.float32)[:bands, None, None]
+    std = np.asarray(std, dtype = np.float32)[:bands, None, None]
+    res = (data.astype(np.float32) - mean) / np.where(std > 0, std, 1)
+    if nodata is not None:
+        res[:, ~get_valid_pixels(data, nodata)] = 0
+    return res
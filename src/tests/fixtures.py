@@ -0,0 +1,159 @@
+import numpy as np
+import rasterio as rio
+from rasterio.transform import from_bounds
+import functools
+import http.server
+import multiprocessing
+import time
+import re
+import os
+
+
+def write_synthetic_geotiff(path, bounds, count = 3, size = 64, dtype = "uint8", nodata = None, seed = 0):
+    """
+    Write a small GeoTIFF (EPSG:4326) with random pixel values covering bounds
+
+    bounds is (left, bottom, right, top); the image is size x size pixels
+    """
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    rng = np.random.default_rng(seed)
+    data = rng.integers(1, 255, size = (count, size, size)).astype(dtype)
+    with rio.open(
+        path, "w",
+        driver = "GTiff",
+        width = size,
+        height = size,
+        count = count,
+        dtype = dtype,
+        nodata = nodata,
+        crs = "EPSG:4326",
+        transform = from_bounds(*bounds, size, size),
+        tiled = True,
+        blockxsize = 16,
+        blockysize = 16,
+    ) as dst:
+        dst.write(data)
+    return path
+
+
+def scene_path(root, phase, date, name):
+    """
+    A local path laid out like the DigitalGlobe links, e.g.
+    root/pre-event/2017-05-20/name/name.tif
+    """
+    return os.path.join(root, f"{phase}-event", date, name, name + ".tif")
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files from a directory, honouring single "bytes=start-end" ranges
+    the way GDAL's /vsicurl/ expects, with an ETag made of the size and
+    modification time of the file (If-Range is honoured too)
+    """
+
+    def do_HEAD(self):
+        self.send_file(head = True)
+
+    def do_GET(self):
+        self.send_file(head = False)
+
+    def send_file(self, head):
+        server = self.server
+        time.sleep(server.delay)
+        relpath = self.path.split("?")[0].lstrip("/")
+        server.requests.append((relpath, self.headers.get("Range")))
+        failures = server.failures.get(relpath, 0)
+        if failures > 0:
+            server.failures[relpath] = failures - 1
+            self.send_error(503)
+            return
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        etag = f'"{size:x}-{os.stat(path).st_mtime_ns:x}"'
+        start, end, status = 0, size - 1, 200
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if match is not None and self.headers.get("If-Range", etag) == etag:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(end - start + 1))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not head:
+            # Drops the connection after cutoff bytes, once
+            cutoff = server.cutoffs.pop(relpath, None)
+            length = end - start + 1 if cutoff is None else min(cutoff, end - start + 1)
+            with open(path, "rb") as f:
+                f.seek(start)
+                self.wfile.write(f.read(length))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _serve(root, requests, failures, cutoffs, delay, port_queue):
+    handler = functools.partial(RangeRequestHandler, directory = root)
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    httpd.daemon_threads = True
+    httpd.requests = requests
+    httpd.failures = failures
+    httpd.cutoffs = cutoffs
+    httpd.delay = delay
+    port_queue.put(httpd.server_address[1])
+    httpd.serve_forever()
+
+
+class LocalHTTPServer:
+    """
+    A threaded HTTP server on 127.0.0.1 serving the files under root
+
+    It runs in a child process: rasterio holds the GIL while GDAL fetches bytes,
+    so a server thread in the same process would never get to answer
+
+    USAGE:
+    ---
+        with LocalHTTPServer(root) as server:
+            link = server.url("pre-event/2017-05-20/A/A.tif")
+
+    server.requests records every (path, range header) that was asked for;
+    server.failures maps a path to the number of times it should answer 503 first;
+    server.cutoffs maps a path to the number of bytes after which the connection is
+    dropped (once), like a download interrupted half way;
+    delay is the number of seconds to wait before answering each request
+    """
+
+    def __init__(self, root, delay = 0.0):
+        self.root = root
+        self.delay = delay
+
+    def url(self, relpath = ""):
+        relpath = os.path.relpath(relpath, self.root) if os.path.isabs(relpath) else relpath
+        return f"http://127.0.0.1:{self.port}/" + relpath.replace(os.sep, "/")
+
+    def __enter__(self):
+        self.manager = multiprocessing.Manager()
+        self.requests = self.manager.list()
+        self.failures = self.manager.dict()
+        self.cutoffs = self.manager.dict()
+        port_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target = _serve,
+            args = (self.root, self.requests, self.failures, self.cutoffs, self.delay, port_queue),
+            daemon = True,
+        )
+        self.process.start()
+        self.port = port_queue.get(timeout = 30)
+        return self
+
+    def __exit__(self, *args):
+        self.process.terminate()
+        self.process.join()
+        self.manager.shutdown()
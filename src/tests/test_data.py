@@ -1,9 +1,48 @@
 import unittest
 import os.path
 import sys
+import tempfile
+import itertools
+import time
+import io
+import contextlib
+import json
+import hashlib
+import threading
+import subprocess
+import zipfile
+import urllib.request
+import urllib.error
+from unittest import mock
+from rasterio.windows import Window, from_bounds
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from data_loading.tif_links_utils import *
 from data_loading.vector_data_utils import *
+import data_loading.utils as utils
+from data_loading.footprint_utils import FootprintIndex
+from data_loading.catalog_utils import SceneCatalog, get_scene_metadata, sync_catalog_with_file_list, read_scene_metadata, probe_link
+from data_loading.extraction_utils import plan_patch_jobs, extract_patches_by_scene, schedule_work_units, get_bounds_for_points, get_windows_for_bounds, \
+    get_pixel_indices, get_block_boxes, plan_region_reads, iter_patches_by_scene, PatchFilter, get_patch_transform, format_read_stats, \
+    GTiffSink, write_patch
+import data_loading.extraction_utils as extraction_utils
+from data_loading.patch_utils import get_indices_for_point, crop_patches_for_point, get_geom_for_point
+import data_loading.patch_utils as patch_utils
+from data_loading.patch_store_utils import create_patch_store, load_patch_store, get_patch_from_store, save_written_patches, WrittenPatches
+from data_loading.manifest_utils import PatchManifest, extract_patches_with_manifest, get_job_key, get_job_fingerprint, MANIFEST_FILENAME
+from data_loading.range_cache_utils import RangeCache, RANGE_CACHE_ENV, OPENER_SUPPORTED, open_scene, get_range_cache
+from data_loading.scene_selection_utils import SceneSelection, get_window_coverage, check_policy_for_phase
+from data_loading.instrumentation_utils import Instrumentation, instrumented_run, stage, count, get_instrumentation
+from data_loading.patch_service_utils import PatchService, make_patch_server, get_latency_percentiles
+from data_loading.band_stats_utils import BandStats, BandStatsSink, compute_band_stats_for_files, compute_band_stats_for_store, \
+    compute_band_stats_for_directory, save_band_stats, load_band_stats, group_band_stats
+from data_loading.download_utils import download_file, download_files, extract_archive
+from data_loading.patch_codec_utils import PatchEncoding, PATCH_CODECS, PATCH_LAYOUTS, get_encoding, get_tile_size
+from tests.fixtures import write_synthetic_geotiff, scene_path, LocalHTTPServer
+from benchmarks.synthetic_data import make_synthetic_hurricane
+from benchmarks.bench_pipeline import BenchmarkConfig, STAGES, run_benchmarks, save_baseline, load_baselines, find_regressions
+import benchmarks.bench_pipeline as bench_pipeline
+import benchmarks.bench_patch_codecs as bench_patch_codecs
+import cli
 
 class TestTifLinksUtils(unittest.TestCase):
     def test_get_tif_links(self):
@@ -70,4 +109,1476 @@ class TestVectorDataUtils(unittest.TestCase):
         links = get_vector_data_links("irma", False)
         assert len(links) == 3, f"Expect 3 links but found {len(links)} links instead"
 
-suite = unittest.TestLoader().loadTestsFromTestCase(TestVectorDataUtils)
\ No newline at end of file
+class TestFootprintUtils(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        lefts = rng.uniform(-65, -60, 50)
+        bottoms = rng.uniform(15, 20, 50)
+        self.bounds_list = [
+            BoundingBox(l, b, l + w, b + h)
+            for (l, b, w, h) in zip(lefts, bottoms, rng.uniform(0, 1, 50), rng.uniform(0, 1, 50))
+        ]
+        # Random points plus points lying exactly on the edges of the boxes
+        xs = list(rng.uniform(-66, -59, 2000)) + [b.left for b in self.bounds_list]
+        ys = list(rng.uniform(14, 21, 2000)) + [(b.bottom + b.top) / 2 for b in self.bounds_list]
+        self.points = [Point(x, y) for (x, y) in zip(xs, ys)]
+        self.xs = np.array(xs)
+        self.ys = np.array(ys)
+
+    def test_indices_for_points_match_linear_scan(self):
+        index = FootprintIndex(self.bounds_list)
+        res = index.indices_for_points(self.xs, self.ys)
+        expected = [get_indices_for_point(self.bounds_list, point) for point in self.points]
+        assert res == expected
+
+    def test_contains_any_matches_linear_scan(self):
+        index = FootprintIndex(self.bounds_list, cells_per_axis=3)
+        res = index.contains_any(self.xs, self.ys)
+        expected = [exist_link_containing_point(point, self.bounds_list) for point in self.points]
+        assert res.tolist() == expected
+
+    def test_empty_index(self):
+        index = FootprintIndex([])
+        assert len(index) == 0
+        assert index.indices_for_points(self.xs[:3], self.ys[:3]) == [[], [], []]
+
+
+class TestSpatialJoins(unittest.TestCase):
+    def setUp(self):
+        files = find_all_files_with_extension_in_dir(PATH_TO_DAMAGE_ASSESSMENTS, ".geojson", [])
+        gdfs = [gpd.read_file(path) for path in sorted(files)]
+        points = pd.concat([gdf.loc[gdf.geom_type == "Point", ["geometry"]] for gdf in gdfs])
+        self.gdf = gpd.GeoDataFrame(points, geometry="geometry", crs="EPSG:4326")
+
+    def test_imagery_columns_match_linear_scan(self):
+        (left, bottom, right, top) = self.gdf.total_bounds
+        rng = np.random.default_rng(0)
+        bounds_dict = dict()
+        for phase in ["pre", "post"]:
+            xs = rng.uniform(left, right, 20)
+            ys = rng.uniform(bottom, top, 20)
+            bounds_dict[phase] = [BoundingBox(x, y, x + 0.2, y + 0.2) for (x, y) in zip(xs, ys)]
+        # A box with a building exactly on its edge, which must not count as inside
+        point = self.gdf.geometry.iloc[0]
+        bounds_dict["pre"].append(BoundingBox(point.x, point.y - 0.1, point.x + 0.1, point.y + 0.1))
+        gdf = add_imagery_columns(self.gdf.copy(), make_footprints_gdf(bounds_dict, self.gdf.crs))
+        for phase in ["pre", "post"]:
+            expected = [exist_link_containing_point(p, bounds_dict[phase]) for p in self.gdf.geometry]
+            assert gdf[f"exist_{phase}_event_imagery"].tolist() == expected
+        assert gdf["exist_pre_event_imagery"].any() and not gdf["exist_pre_event_imagery"].all()
+
+    def test_country_names_match_country_bounding_boxes(self):
+        # Duplicate index labels on purpose
+        gdf = gpd.GeoDataFrame(pd.concat([self.gdf, self.gdf.iloc[:10]]), crs="EPSG:4326")
+        gdf = pd.concat([gdf, gpd.GeoDataFrame(geometry=[Point(0.0, -89.9)], crs="EPSG:4326")])
+        add_country_names(gdf, "irma", False)
+        expected = [find_countries_for_point(p) for p in gdf.geometry]
+        assert gdf["country"].tolist() == expected
+        assert expected[-1] == ""
+
+    def test_damage_assessments_match_pairwise_distances(self):
+        assessments = load_damage_assessments("irma", False)
+        official = assessments.loc[assessments.geom_type == "Point"].reset_index(drop=True)
+        rng = np.random.default_rng(0)
+        idx = rng.integers(0, len(official), 300)
+        xs = official.geometry.x.to_numpy()[idx] + rng.normal(0, 0.0002, len(idx))
+        ys = official.geometry.y.to_numpy()[idx] + rng.normal(0, 0.0002, len(idx))
+        gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(xs, ys), crs="EPSG:4326")
+        add_damage_assessments(gdf, official, False, 30)
+        # Great circle distances to every assessment
+        (lon1, lat1) = (np.radians(xs)[:, None], np.radians(ys)[:, None])
+        (lon2, lat2) = (np.radians(official.geometry.x.to_numpy())[None, :], np.radians(official.geometry.y.to_numpy())[None, :])
+        h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        pairwise = 2 * earth_radius * np.arcsin(np.sqrt(h))
+        nearest = pairwise.min(axis=1)
+        found = gdf["official_distance"].notna().to_numpy()
+        # Up to the scale error of UTM and the difference between the sphere and the ellipsoid, under 1%
+        clear = np.abs(nearest - 30) > 0.3
+        assert (found[clear] == (nearest[clear] <= 30)).all() and found.any() and not found.all()
+        assert np.allclose(gdf["official_distance"].to_numpy()[found], nearest[found], rtol=0.01)
+        grades = official["damage"].to_numpy()[pairwise.argmin(axis=1)]
+        # Unless the second nearest assessment is about as close
+        second = np.partition(pairwise, 1, axis=1)[:, 1]
+        unique = found & (second > nearest * 1.02)
+        assert (gdf["official_damage"].to_numpy()[unique] == grades[unique]).all() and unique.sum() > 100
+        assert gdf["official_damage"].isna().to_numpy()[~found].all()
+
+    def test_damage_assessments_across_zones_and_polygons(self):
+        assessments = gpd.GeoDataFrame(
+            {"damage": ["Minor", "Major", "Destroyed"]},
+            geometry=[Point(-65.9999, 18.0), box(-63.1, 18.1, -63.0, 18.2), Point(-62.0, 17.0)],
+            crs="EPSG:4326",
+        )
+        # On both sides of the edge between UTM zones 19 and 20, inside the polygon, and far from everything
+        gdf = gpd.GeoDataFrame(geometry=[Point(-66.0001, 18.0), Point(-65.9998, 18.0), Point(-63.05, 18.15), Point(-64.0, 17.0)], crs="EPSG:4326")
+        (positions, distances) = join_nearest_assessments(gdf, assessments, 30)
+        assert positions.tolist() == [0, 0, 1, -1]
+        assert abs(distances[0] - 21.2) < 0.2 and abs(distances[1] - 10.6) < 0.1 and distances[2] == 0 and np.isnan(distances[3])
+        assert join_nearest_assessments(gdf.iloc[:0], assessments)[0].tolist() == []
+
+
+class TestVectorDataIngestion(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        # A crowdsourced-like file, with its damage in "label" and in another crs
+        crowdsourced = gpd.GeoDataFrame(
+            {"label": ["Flooded / Damaged Building", "Blocked Road", "Flooded / Damaged Building"], "id": [1, 2, 3]},
+            geometry=[Point(-63.1, 18.2), Point(-63.0, 18.1), Point(-62.9, 18.0)],
+            crs="EPSG:4326",
+        ).to_crs("EPSG:3857")
+        path = os.path.join(self.tmpdir.name, "crowdsourced.geojson")
+        crowdsourced.to_file(path, driver="GeoJSON")
+        official = find_all_files_with_extension_in_dir(PATH_TO_DAMAGE_ASSESSMENTS, ".geojson", [])
+        self.files = [path] + sorted(official)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_schemas_are_normalized(self):
+        res = read_vector_data_files(self.files, False)
+        assert list(res.columns) == VECTOR_DATA_COLUMNS
+        assert res.crs == VECTOR_DATA_CRS
+        assert res["damage"].iloc[:3].tolist() == ["Flooded / Damaged Building", "Blocked Road", "Flooded / Damaged Building"]
+        assert abs(res.geometry.iloc[0].x + 63.1) < 1e-9
+        official = res.loc[res["source"] != "crowdsourced"]
+        assert set(official["damage"]) == {"Affected", "Minor", "Major", "Destroyed"}
+        expected = sum(len(gpd.read_file(path)) for path in self.files)
+        assert len(res) == expected and res.index.is_unique
+
+    def test_batches_match_whole_files(self):
+        res = read_vector_data_files(self.files, False, max_workers=1)
+        batched = read_vector_data_files(self.files, False, max_workers=3, batch_size=100)
+        assert res.drop(columns="geometry").equals(batched.drop(columns="geometry"))
+        assert res.geometry.geom_equals(batched.geometry).all()
+
+
+class TestVectorDataDownloads(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        self.archives = [self.write_archive(name, seed) for (name, seed) in [("a", 0), ("b", 1)]]
+        self.cache_dir = os.path.join(root, "cache")
+        self.patches = [
+            mock.patch("data_loading.vector_data_utils.PATH_TO_DATA_RAW", os.path.join(root, "raw")),
+            mock.patch("data_loading.download_utils.PATH_TO_DOWNLOAD_CACHE", self.cache_dir),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmpdir.cleanup()
+
+    def write_archive(self, name, seed):
+        path = os.path.join(self.tmpdir.name, "links", name + ".zip")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with zipfile.ZipFile(path, "w") as zip_ref:
+            zip_ref.writestr(f"{name}/{name}.geojson", json.dumps({"type": "FeatureCollection", "features": [], "seed": seed}))
+            # Random bytes, so that the archive is large enough to be cut short
+            zip_ref.writestr(f"{name}/{name}.bin", np.random.default_rng(seed).bytes(600000))
+        return path
+
+    def test_archives_are_downloaded_and_extracted_once(self):
+        destination_dir = os.path.join(self.tmpdir.name, "raw", "test-vector-data")
+        with LocalHTTPServer(self.tmpdir.name) as server:
+            links = [server.url(path) for path in self.archives]
+            with mock.patch("data_loading.vector_data_utils.get_vector_data_links", lambda *args: links):
+                counts = []
+                for run in range(4):
+                    if run == 2:
+                        # A new version of the first archive
+                        self.write_archive("a", 2)
+                    if run == 3:
+                        os.remove(os.path.join(destination_dir, "b", "b.bin"))
+                    with instrumented_run("test", False) as instrumentation:
+                        files = load_all_vector_data_for_hurricane("test", False, max_workers=2)
+                    counts.append([instrumentation.get(name) for name in ["archives_downloaded", "archives_extracted"]])
+                    assert sorted(os.path.relpath(path, destination_dir) for path in files) == [
+                        os.path.join("a", "a.geojson"), os.path.join("b", "b.geojson")
+                    ]
+            # Every run asks for the version of the archives, only the new ones are downloaded
+            assert [ranges for (_, ranges) in server.requests] == [None] * 11
+        assert counts == [[2, 2], [0, 0], [1, 1], [0, 1]]
+        with open(os.path.join(destination_dir, "a", "a.geojson")) as f:
+            assert json.load(f)["seed"] == 2
+        # The older version of the first archive was removed from the cache
+        assert len(os.listdir(self.cache_dir)) == 2
+
+    def test_interrupted_downloads_resume(self):
+        with open(self.archives[0], "rb") as f:
+            expected = f.read()
+        relpath = os.path.relpath(self.archives[0], self.tmpdir.name)
+        with LocalHTTPServer(self.tmpdir.name) as server:
+            link = server.url(relpath)
+            server.cutoffs[relpath] = 400000
+            with self.assertRaises(OSError):
+                download_file(link, retries=0)
+            # The next call carries on from the chunks already written
+            written = 400000 // DOWNLOAD_CHUNK_SIZE * DOWNLOAD_CHUNK_SIZE
+            server.failures[relpath] = 1
+            res = download_file(link, retries=1, backoff=0.01)
+            assert res.resumed and res.downloaded == len(expected) - written > 0
+            assert server.requests[-1] == (relpath, f"bytes={written}-")
+            # So does a retry
+            other = server.url(self.archives[1])
+            server.cutoffs[os.path.relpath(self.archives[1], self.tmpdir.name)] = 400000
+            downloads = download_files([link, other], toprint=False, retries=1, backoff=0.01)
+            assert downloads[link].downloaded == 0
+            assert downloads[other].resumed and server.requests[-1][1] == f"bytes={written}-"
+        with open(res.path, "rb") as f:
+            assert f.read() == expected
+        destination_dir = os.path.join(self.tmpdir.name, "extracted")
+        assert extract_archive(res, destination_dir) and not extract_archive(res, destination_dir)
+
+
+class TestVectorDataStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        files = find_all_files_with_extension_in_dir(PATH_TO_DAMAGE_ASSESSMENTS, ".geojson", [])
+        gdf = read_vector_data_files(sorted(files), False)
+        gdf = gdf.loc[gdf.geom_type == "Point"].reset_index(drop=True)
+        rng = np.random.default_rng(0)
+        gdf["exist_pre_event_imagery"] = rng.random(len(gdf)) < 0.5
+        gdf["exist_post_event_imagery"] = rng.random(len(gdf)) < 0.5
+        add_country_names(gdf, "irma", False)
+        self.gdf = gdf
+        self.patches = [
+            mock.patch("data_loading.vector_data_utils.PATH_TO_VECTOR_DATA", os.path.join(self.tmpdir.name, "vector-data")),
+            mock.patch("data_loading.vector_data_utils.PATH_TO_GEOJSONS", os.path.join(self.tmpdir.name, "geojsons")),
+            mock.patch("data_loading.vector_data_utils.VECTOR_DATA_ROW_GROUP_SIZE", 500),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        path = save_vector_data(self.gdf, "synthetic", False)
+        assert path.endswith(".parquet")
+        assert not os.path.isdir(os.path.join(self.tmpdir.name, "geojsons"))
+        res = load_vector_data("synthetic")
+        assert res.crs == self.gdf.crs
+        assert res.drop(columns="geometry").equals(self.gdf.drop(columns="geometry"))
+        assert res.geometry.geom_equals(self.gdf.geometry).all()
+
+    def test_projection_and_filters(self):
+        save_vector_data(self.gdf, "synthetic", False, export_geojson=True)
+        assert os.path.isfile(os.path.join(self.tmpdir.name, "geojsons", "synthetic.geojson"))
+        res = load_vector_data(
+            "synthetic", ["damage"], [("exist_pre_event_imagery", "==", True), ("country", "==", "Anguilla")]
+        )
+        expected = self.gdf.loc[self.gdf.exist_pre_event_imagery & (self.gdf.country == "Anguilla")]
+        assert list(res.columns) == ["damage", "geometry"]
+        assert 0 < len(res) < len(self.gdf)
+        assert res["damage"].tolist() == expected["damage"].tolist()
+        assert res.geometry.geom_equals(expected.geometry.reset_index(drop=True)).all()
+
+
+class TestCatalogUtils(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        self.catalog = SceneCatalog(os.path.join(root, "catalog.sqlite"))
+        self.links = [
+            write_synthetic_geotiff(scene_path(root, "pre", "2017-05-20", "A"), (-63.2, 18.1, -63.0, 18.3)),
+            write_synthetic_geotiff(scene_path(root, "post", "2017-09-12", "B"), (-63.1, 18.0, -62.9, 18.2), count=1),
+        ]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_metadata_is_read_once(self):
+        records = get_scene_metadata(self.links, False, self.catalog)
+        for link in self.links:
+            os.remove(link)
+        # The scenes are gone, so these can only come from the catalog
+        cached = get_scene_metadata(self.links, False, self.catalog)
+        assert cached == records
+        assert [record.phase for record in cached] == ["pre", "post"]
+        assert cached[0].acquisition_date == "2017-05-20"
+        assert cached[0].count == 3 and cached[1].count == 1
+        assert cached[0].bounds == BoundingBox(-63.2, 18.1, -63.0, 18.3)
+
+    def test_unreachable_links_are_none(self):
+        missing = os.path.join(self.tmpdir.name, "missing.tif")
+        records = get_scene_metadata([missing] + self.links, False, self.catalog, backoff=0)
+        assert records[0] is None
+        assert records[1].link == self.links[0]
+
+    def test_unreachable_links_are_not_probed_again(self):
+        missing = os.path.join(self.tmpdir.name, "missing.tif")
+        unreachable = dict()
+        get_scene_metadata([missing], False, self.catalog, unreachable=unreachable, backoff=0)
+        write_synthetic_geotiff(missing, (-63.2, 18.1, -63.0, 18.3))
+        again = dict()
+        assert get_scene_metadata([missing], False, self.catalog, unreachable=again) == [None]
+        assert again == unreachable
+        assert get_scene_metadata([missing], False, self.catalog, retry_unreachable=True)[0].link == missing
+        assert self.catalog.get_unreachable([missing]) == dict()
+
+    def test_unsaved_scenes_stay_out_of_the_catalog(self):
+        records = get_scene_metadata(self.links, False, self.catalog, save=False)
+        assert all(record is not None for record in records)
+        assert self.catalog.get(self.links) == dict()
+
+    def test_file_list_change_drops_stale_scenes(self):
+        sync_catalog_with_file_list("test", self.links, False, self.catalog)
+        sync_catalog_with_file_list("test", self.links[:1], False, self.catalog)
+        assert list(self.catalog.get(self.links).keys()) == self.links[:1]
+
+
+class TestTifLinksProbing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        self.paths = [
+            write_synthetic_geotiff(scene_path(root, "pre", "2017-05-20", "A"), (-63.2, 18.1, -63.0, 18.3)),
+            write_synthetic_geotiff(scene_path(root, "post", "2017-09-12", "B"), (-63.1, 18.0, -62.9, 18.2)),
+            write_synthetic_geotiff(scene_path(root, "post", "2017-09-12", "C"), (-63.1, 18.0, -62.9, 18.2), count=1),
+        ]
+        self.patches = [
+            mock.patch("data_loading.catalog_utils.PATH_TO_SCENE_CATALOG", os.path.join(root, "catalog.sqlite")),
+            mock.patch("data_loading.tif_links_utils.PATH_TO_TIDIED_FILELISTS", os.path.join(root, "tidied")),
+            mock.patch("data_loading.tif_links_utils.PATH_TO_TIDY_REPORTS", os.path.join(root, "reports")),
+            mock.patch.dict(os.environ, {RANGE_CACHE_ENV: os.path.join(root, "range-cache.sqlite")}),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.tmpdir.cleanup()
+
+    def test_probe_tif_links_sorts_links(self):
+        with LocalHTTPServer(self.tmpdir.name) as server:
+            links = [server.url(path) for path in self.paths] + [server.url("missing.tif")]
+            # The second link fails twice before succeeding
+            server.failures[os.path.relpath(self.paths[1], self.tmpdir.name)] = 2
+            report = probe_tif_links(links, "test", False, max_workers=4, retries=2, backoff=0.01)
+        assert report.kept == links[:2]
+        assert report.too_few_bands == {links[2]: 1}
+        assert list(report.unreachable.keys()) == [links[3]]
+
+    def test_probe_timeout_applies_through_the_range_cache(self):
+        with LocalHTTPServer(self.tmpdir.name, delay=2.0) as server:
+            start = time.perf_counter()
+            (record, error) = probe_link(server.url(self.paths[0]), timeout=0.2, retries=0)
+            seconds = time.perf_counter() - start
+        assert record is None and error is not None
+        assert seconds < 1.5, seconds
+
+    def test_unreachable_scenes_of_a_hurricane(self):
+        os.makedirs(os.path.join(self.tmpdir.name, "tidied"))
+        links = self.paths + [os.path.join(self.tmpdir.name, "missing.tif")]
+        with open(os.path.join(self.tmpdir.name, "tidied", "synthetic"), "w") as f:
+            f.write("".join(link + "\n" for link in links))
+        # Probed without waiting between retries; the missing scene is then not probed again
+        sync_catalog_with_file_list("synthetic", links, False, backoff=0)
+        with self.assertRaises(OSError):
+            get_scene_metadata_for_hurricane("synthetic", False)
+        with self.assertWarns(UserWarning) as warning:
+            records = get_scene_metadata_for_hurricane("synthetic", False, max_unreachable=0.5)
+        assert "1/4 scenes" in str(warning.warning)
+        assert len(records["pre"]) == 1 and len(records["post"]) == 2
+
+    def test_tidy_up_tif_links_writes_file_list(self):
+        with LocalHTTPServer(self.tmpdir.name) as server:
+            links = [server.url(path) for path in self.paths]
+            res = tidy_up_tif_links(links, "synthetic", False, overwrite=True)
+        assert res == links[:2]
+        with open(os.path.join(self.tmpdir.name, "tidied", "synthetic")) as f:
+            assert f.read() == "".join(link + "\n" for link in links[:2])
+        assert os.path.isfile(os.path.join(self.tmpdir.name, "reports", "synthetic.json"))
+
+
+class TestExtractionUtils(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        self.links = [
+            write_synthetic_geotiff(scene_path(root, "post", "2017-09-12", name), bounds, size=512, seed=seed)
+            for (name, bounds, seed) in [
+                ("A", (-63.10, 18.00, -63.08, 18.02), 1),
+                ("B", (-63.09, 18.01, -63.07, 18.03), 2),
+                ("C", (-63.10, 18.01, -63.09, 18.03), 3),
+            ]
+        ]
+        self.records = [read_scene_metadata(link) for link in self.links]
+        rng = np.random.default_rng(0)
+        # Random points, plus points close to the edges of scene A
+        self.xs = np.concatenate([rng.uniform(-63.10, -63.07, 40), [-63.0999, -63.0801, -63.09]])
+        self.ys = np.concatenate([rng.uniform(18.00, 18.03, 40), [18.01, 18.0001, 18.0199]])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read_patches(self, path_to_dir):
+        res = dict()
+        for name in os.listdir(path_to_dir):
+            with rio.open(os.path.join(path_to_dir, name)) as src:
+                res[name] = (src.read(), src.transform, src.crs)
+        return res
+
+    def test_same_patches_as_point_major(self):
+        expected_dir = os.path.join(self.tmpdir.name, "expected")
+        res_dir = os.path.join(self.tmpdir.name, "res")
+        os.makedirs(expected_dir)
+        os.makedirs(res_dir)
+        bounds_list = [record.bounds for record in self.records]
+        for (idx, (x, y)) in enumerate(zip(self.xs, self.ys)):
+            crop_patches_for_point(self.links, bounds_list, Point(x, y), idx, 20, expected_dir, False)
+
+        jobs = plan_patch_jobs(self.records, self.xs, self.ys, 20, res_dir)
+        written = extract_patches_by_scene(self.links, jobs, False)
+
+        expected = self.read_patches(expected_dir)
+        res = self.read_patches(res_dir)
+        assert written == len(expected) > len(self.xs)
+        assert res.keys() == expected.keys()
+        for name in expected.keys():
+            assert (res[name][0] == expected[name][0]).all(), name
+            assert res[name][1:] == expected[name][1:], name
+
+    def test_each_scene_opened_once(self):
+        jobs = plan_patch_jobs(self.records, self.xs, self.ys, 20, self.tmpdir.name)
+        with mock.patch.object(rio, "open", wraps=rio.open) as rio_open:
+            extract_patches_by_scene(self.links, jobs, False)
+        opened = [call.args[0] for call in rio_open.call_args_list if call.args[0] in self.links]
+        assert sorted(opened) == sorted(self.links)
+
+    def test_parallel_extraction_is_byte_identical(self):
+        outputs = []
+        for workers in [1, 2]:
+            path_to_dir = os.path.join(self.tmpdir.name, f"workers-{workers}")
+            os.makedirs(path_to_dir)
+            jobs = plan_patch_jobs(self.records, self.xs, self.ys, 20, path_to_dir)
+            extract_patches_by_scene(self.links, jobs, False, workers=workers)
+            files = dict()
+            for name in os.listdir(path_to_dir):
+                with open(os.path.join(path_to_dir, name), "rb") as f:
+                    files[name] = f.read()
+            outputs.append(files)
+        assert len(outputs[0]) > 0
+        assert outputs[0] == outputs[1]
+
+    def test_array_store_matches_gtiff_patches(self):
+        path_to_dir = os.path.join(self.tmpdir.name, "gtiff")
+        os.makedirs(path_to_dir)
+        jobs = plan_patch_jobs(self.records, self.xs, self.ys, 20, path_to_dir)
+        extract_patches_by_scene(self.links, jobs, False)
+        expected = self.read_patches(path_to_dir)
+
+        path_to_store = os.path.join(self.tmpdir.name, "store", "post")
+        (sink, store_jobs) = create_patch_store(path_to_store, self.records, jobs, "post")
+        extract_patches_by_scene(self.links, store_jobs, False, workers=2, sink=sink)
+        (patches, index) = load_patch_store(path_to_store)
+
+        assert patches.shape[0] == len(index) == len(expected)
+        for i in range(len(index)):
+            name = f"{index.point_idx[i]}-{index.seq[i]}.tif"
+            (data, transform, crs) = get_patch_from_store(patches, index, i)
+            assert (data == expected[name][0]).all(), name
+            assert (transform, crs) == expected[name][1:], name
+        assert set(index.phase) == {"post"}
+
+    def test_array_store_marks_skipped_patches(self):
+        # A scene whose western half is nodata
+        link = write_synthetic_geotiff(scene_path(self.tmpdir.name, "post", "2017-09-12", "D"), (-63.10, 18.00, -63.08, 18.02), size=512, nodata=0, seed=4)
+        with rio.open(link, "r+") as dst:
+            data = dst.read()
+            data[:, :, :256] = 0
+            dst.write(data)
+        records = [read_scene_metadata(link)]
+        path_to_store = os.path.join(self.tmpdir.name, "store", "post")
+        jobs = plan_patch_jobs(records, self.xs, self.ys, 20, os.path.join(self.tmpdir.name, "gtiff"))
+        patch_filter = PatchFilter(max_nodata=0.5)
+        (sink, store_jobs) = create_patch_store(path_to_store, records, jobs, "post", patch_filter)
+        assert not load_patch_store(path_to_store)[1].written.any()
+        written = WrittenPatches()
+        count = extract_patches_by_scene([link], store_jobs, False, sink=sink, on_done=written, patch_filter=patch_filter)
+        save_written_patches(path_to_store, written.idx)
+        (patches, index) = load_patch_store(path_to_store)
+        assert 0 < index.written.sum() == count < len(index)
+        # The rows of the skipped patches are all zeros, the others are not
+        assert not patches[~index.written.to_numpy()].any()
+        assert all(patches[i].any() for i in index.patch_idx[index.written])
+
+    def test_manifest_resumes_and_updates(self):
+        path_to_dir = os.path.join(self.tmpdir.name, "patches")
+        os.makedirs(path_to_dir)
+        manifest = PatchManifest(os.path.join(self.tmpdir.name, "manifest.sqlite"))
+        records = self.records + [self.records[0]._replace(link=os.path.join(self.tmpdir.name, "gone.tif"))]
+
+        def run(xs, ys, dry_run=False):
+            jobs = plan_patch_jobs(records, xs, ys, 20, path_to_dir)
+            return extract_patches_with_manifest(records, jobs, xs, ys, 20, manifest, "post", False, dry_run=dry_run)
+
+        first = run(self.xs, self.ys)
+        # The jobs of the missing scene fail, everything else is written
+        assert first["written"] > 0 and first["errors"] > 0
+        assert first["new"] == first["written"] + first["errors"]
+
+        dry = run(self.xs, self.ys, dry_run=True)
+        assert dry["failed"] == first["errors"] and dry["new"] == 0 and dry["written"] == 0
+
+        # Only the failures are retried
+        again = run(self.xs, self.ys)
+        assert again["done"] == first["written"] and again["written"] == 0
+
+        # A deleted patch and a new point are picked up
+        os.remove(os.path.join(path_to_dir, "0-1.tif"))
+        xs = np.append(self.xs, -63.095)
+        ys = np.append(self.ys, 18.005)
+        last = run(xs, ys)
+        assert last["missing"] == 1
+        assert last["written"] == 1 + len([name for name in os.listdir(path_to_dir) if name.startswith(f"{len(self.xs)}-")])
+
+    def test_default_patch_filter(self):
+        assert PatchFilter().max_nodata == PATCH_MAX_NODATA
+        assert cli.make_parser().parse_args(["serve"]).max_nodata == PATCH_MAX_NODATA
+        job = plan_patch_jobs(self.records, self.xs, self.ys, 20, self.tmpdir.name)[0]
+        record = self.records[job.scene_idx]
+        # Unfiltered patches keep the fingerprints of the manifests older than the filter
+        old = hashlib.sha256(json.dumps([job.path, [float(v) for v in job.window.flatten()], list(record.transform), record.crs]).encode()).hexdigest()
+        assert get_job_fingerprint(job, record, PatchFilter(1.0, "clip")) == old
+        assert get_job_fingerprint(job, record) == get_job_fingerprint(job, record, PatchFilter()) != old
+
+    def test_manifest_removes_stale_patches(self):
+        path_to_dir = os.path.join(self.tmpdir.name, "patches")
+        os.makedirs(path_to_dir)
+        manifest = PatchManifest(os.path.join(self.tmpdir.name, "manifest.sqlite"))
+
+        def run(xs, ys, patch_filter=None):
+            jobs = plan_patch_jobs(self.records, xs, ys, 20, path_to_dir)
+            summary = extract_patches_with_manifest(self.records, jobs, xs, ys, 20, manifest, "post", False, patch_filter=patch_filter)
+            return (summary, jobs)
+
+        run(self.xs, self.ys)
+        # Dropping the first point renumbers all the others
+        (summary, jobs) = run(self.xs[1:], self.ys[1:])
+        assert summary["removed"] > 0
+        assert sorted(os.listdir(path_to_dir)) == sorted(os.path.basename(job.path) for job in jobs)
+        assert sum(manifest.summary()["post"].values()) == len(jobs)
+
+        # The patches that are now skipped are removed, not left behind
+        (summary, jobs) = run(self.xs[1:], self.ys[1:], PatchFilter(boundless="skip"))
+        statuses = manifest.get([get_job_key(self.xs[1:][job.point_idx], self.ys[1:][job.point_idx], self.records[job.scene_idx].link, 20) for job in jobs])
+        empty = [path for (path, _, status, _) in statuses.values() if status == "empty"]
+        assert len(empty) > 0 and not any(os.path.isfile(path) for path in empty)
+        assert len(os.listdir(path_to_dir)) == summary["written"]
+
+    def test_bounds_are_latitude_corrected(self):
+        xs = np.array([-63.0, -63.0, 10.0])
+        ys = np.array([0.0, 18.0, 60.0])
+        (lefts, bottoms, rights, tops) = get_bounds_for_points(xs, ys, 20)
+        # 40 meters wide and high, wherever the point is
+        widths = convert_deg_to_meters(rights - lefts) * np.cos(np.radians(ys))
+        heights = convert_deg_to_meters(tops - bottoms)
+        assert np.allclose(widths, 40) and np.allclose(heights, 40)
+        assert np.isclose((rights - lefts)[2], 2 * (rights - lefts)[0])
+        for (x, y, bounds) in zip(xs, ys, zip(lefts, bottoms, rights, tops)):
+            assert np.allclose(get_geom_for_point(Point(x, y), 20).geometry[0].bounds, bounds)
+
+    def test_windows_match_from_bounds(self):
+        (lefts, bottoms, rights, tops) = get_bounds_for_points(self.xs, self.ys, 20)
+        for record in self.records:
+            windows = get_windows_for_bounds(lefts, bottoms, rights, tops, record.affine)
+            for i in range(len(self.xs)):
+                expected = from_bounds(lefts[i], bottoms[i], rights[i], tops[i], record.affine)
+                assert tuple(expected.flatten()) == tuple(w[i] for w in windows)
+
+    def test_region_planner_clusters_overlapping_windows(self):
+        rng = np.random.default_rng(0)
+        (width, height, block_shape) = (2048, 2048, (64, 64))
+        # Dense clusters of buildings plus a few isolated ones
+        centres = np.concatenate([rng.normal(c, 40, size=(60, 2)) for c in [300, 1000, 1700]] + [rng.uniform(0, 2048, (20, 2))])
+        windows = [Window(x - 60, y - 60, 120, 120) for (x, y) in centres]
+        pixel_indices = [get_pixel_indices(window, width, height) for window in windows]
+        boxes = get_block_boxes(pixel_indices, block_shape, width, height)
+
+        regions = plan_region_reads(pixel_indices, block_shape, width, height, max_region_pixels=width * height)
+        assert sorted(i for (_, members) in regions for i in members) == list(range(len(windows)))
+        for (region, members) in regions:
+            for i in members:
+                (r0, c0, r1, c1) = boxes[i]
+                assert region.row_off <= r0 and r1 <= region.row_off + region.height
+                assert region.col_off <= c0 and c1 <= region.col_off + region.width
+        # Without a size limit, no block is needed by two regions
+        owners = dict()
+        for (k, (_, members)) in enumerate(regions):
+            for i in members:
+                (r0, c0, r1, c1) = boxes[i]
+                for block in itertools.product(range(r0 // 64, (r1 - 1) // 64 + 1), range(c0 // 64, (c1 - 1) // 64 + 1)):
+                    assert owners.setdefault(block, k) == k
+        assert len(regions) < len(windows) / 4
+
+        limit = 256 * 256
+        small = plan_region_reads(pixel_indices, block_shape, width, height, max_region_pixels=limit)
+        assert sorted(i for (_, members) in small for i in members) == list(range(len(windows)))
+        assert all(len(members) == 1 or region.width * region.height <= limit for (region, members) in small)
+        assert len(small) > len(regions)
+
+    def test_read_stats(self):
+        # Many buildings close to each other
+        rng = np.random.default_rng(1)
+        xs = rng.uniform(-63.095, -63.094, 50)
+        ys = rng.uniform(18.005, 18.006, 50)
+        jobs = plan_patch_jobs(self.records, xs, ys, 20, self.tmpdir.name)
+        stats = dict()
+        written = extract_patches_by_scene(self.links, jobs, False, stats=stats)
+        assert stats["patches"] == written == len(jobs)
+        assert stats["regions"] < len(jobs)
+        # Overlapping patches are read once
+        assert stats["read_bytes"] < stats["requested_bytes"] <= stats["window_bytes"]
+        assert stats["scenes_opened"] == len(set(job.scene_idx for job in jobs))
+
+    def test_patch_stream_matches_files(self):
+        path_to_dir = os.path.join(self.tmpdir.name, "gtiff")
+        os.makedirs(path_to_dir)
+        jobs = plan_patch_jobs(self.records, self.xs, self.ys, 20, path_to_dir)
+        extract_patches_by_scene(self.links, jobs, False)
+        expected = self.read_patches(path_to_dir)
+
+        for prefetch in [0, 4]:
+            stream = list(iter_patches_by_scene(self.links, plan_patch_jobs(self.records, self.xs, self.ys, 20, None), self.xs, self.ys, prefetch=prefetch))
+            assert len(stream) == len(expected)
+            for patch in stream:
+                (data, transform, crs) = expected[f"{patch.point_idx}-{patch.seq}.tif"]
+                assert (patch.data == data).all() and patch.transform == transform and patch.crs == crs
+                assert (patch.x, patch.y) == (self.xs[patch.point_idx], self.ys[patch.point_idx])
+                assert patch.link in self.links
+
+    def test_patch_stream_prefetch_is_bounded(self):
+        jobs = plan_patch_jobs(self.records, self.xs, self.ys, 20, None)
+        made = []
+        Patch = extraction_utils.Patch
+        def counting_patch(*args):
+            made.append(args)
+            return Patch(*args)
+        with mock.patch.object(extraction_utils, "Patch", wraps=counting_patch):
+            stream = iter_patches_by_scene(self.links, jobs, prefetch=3)
+            next(stream)
+            time.sleep(0.5)
+            # One consumed, three waiting in the buffer, one waiting to be put
+            assert len(made) <= 5 < len(jobs)
+            stream.close()
+            time.sleep(0.2)
+            assert len(made) <= 5
+
+    def test_patch_stream_raises_errors(self):
+        jobs = plan_patch_jobs(self.records, self.xs, self.ys, 20, None)
+        links = self.links[:1] + [os.path.join(self.tmpdir.name, "gone.tif")] * 2
+        stream = iter_patches_by_scene(links, jobs, prefetch=2)
+        with self.assertRaises(rio.errors.RasterioIOError):
+            for patch in stream:
+                assert patch.link == links[0]
+
+    def test_iter_patches_for_hurricane(self):
+        gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(self.xs, self.ys), crs="EPSG:4326")
+        records = {"pre": self.records[:1], "post": self.records[1:]}
+        with mock.patch.object(patch_utils, "get_scene_metadata_for_hurricane", return_value=records), \
+                mock.patch.object(patch_utils, "combine_all_vector_data_and_save_for_hurricane", return_value=gdf):
+            pre = list(patch_utils.iter_patches("synthetic", phase="pre"))
+            post = list(patch_utils.iter_patches("synthetic", phase="post", prefetch=0))
+        assert len(pre) > 0 and len(post) > 0
+        assert {patch.link for patch in pre} == {self.links[0]}
+        assert {patch.link for patch in post} == set(self.links[1:])
+
+    def test_partial_windows_are_georeferenced(self):
+        jobs = plan_patch_jobs(self.records, self.xs, self.ys, 20, None)
+        partial = 0
+        for job in jobs:
+            record = self.records[job.scene_idx]
+            (rows, cols) = get_pixel_indices(job.window, record.width, record.height)
+            transform = get_patch_transform(job.window, record.affine, record.width, record.height)
+            # The first pixel of the patch is (within half a pixel) the pixel of the scene it was taken from
+            (x, y) = transform * (0.5, 0.5)
+            (col, row) = ~record.affine * (x, y)
+            assert abs(col - (cols[0] + 0.5)) < 1 and abs(row - (rows[0] + 0.5)) < 1
+            partial += job.window.col_off < -1 or job.window.row_off < -1
+        assert partial > 0
+
+    def test_boundless_windows(self):
+        jobs = plan_patch_jobs(self.records, self.xs, self.ys, 20, None)
+        clipped = {(patch.point_idx, patch.seq): patch for patch in iter_patches_by_scene(self.links, jobs, prefetch=0)}
+        inside = dict()
+        for job in jobs:
+            record = self.records[job.scene_idx]
+            window = job.window
+            inside[(job.point_idx, job.seq)] = (window.col_off >= 0 and window.row_off >= 0 and
+                window.col_off + window.width <= record.width and window.row_off + window.height <= record.height)
+        assert 0 < sum(inside.values()) < len(jobs)
+
+        stats = dict()
+        skipped = list(iter_patches_by_scene(self.links, jobs, prefetch=0, stats=stats, patch_filter=PatchFilter(boundless="skip")))
+        assert sorted((patch.point_idx, patch.seq) for patch in skipped) == sorted(key for key in inside if inside[key])
+        assert stats["skipped_outside"] == len(jobs) - len(skipped)
+
+        padded = list(iter_patches_by_scene(self.links, jobs, prefetch=0, patch_filter=PatchFilter(boundless="pad")))
+        assert len(padded) == len(jobs)
+        scenes = dict()
+        for link in self.links:
+            with rio.open(link) as src:
+                scenes[link] = src.read()
+        for (patch, job) in zip(sorted(padded, key=lambda patch: (patch.point_idx, patch.seq)), sorted(jobs)):
+            record = self.records[job.scene_idx]
+            assert patch.data.shape[1:] == (int(round(job.window.height)), int(round(job.window.width)))
+            assert patch.transform == record.affine * rio.Affine.translation(job.window.col_off, job.window.row_off)
+            # The pixels inside the scene are those of the scene, the rest is filled with 0
+            (rows, cols) = get_pixel_indices(job.window, record.width, record.height, "pad")
+            in_rows = (rows >= 0) & (rows < record.height)
+            in_cols = (cols >= 0) & (cols < record.width)
+            assert (patch.data[:, in_rows][:, :, in_cols] == scenes[record.link][:, rows[in_rows]][:, :, cols[in_cols]]).all()
+            assert (patch.data[:, ~in_rows] == 0).all() and (patch.data[:, :, ~in_cols] == 0).all()
+            assert in_rows.all() and in_cols.all() or not inside[(job.point_idx, job.seq)]
+
+    def write_nodata_scene(self, overviews):
+        path = os.path.join(self.tmpdir.name, f"nodata-{len(overviews)}.tif")
+        data = np.random.default_rng(4).integers(1, 255, size=(3, 512, 512)).astype("uint8")
+        # A black border over the left third and the top quarter of the scene
+        data[:, :, :170] = 0
+        data[:, :128, :] = 0
+        with rio.open(
+            path, "w", driver="GTiff", width=512, height=512, count=3, dtype="uint8", nodata=0, crs="EPSG:4326",
+            transform=rio.transform.from_bounds(-63.10, 18.00, -63.08, 18.02, 512, 512), tiled=True, blockxsize=64, blockysize=64,
+        ) as dst:
+            dst.write(data)
+            if len(overviews) > 0:
+                dst.build_overviews(overviews)
+        return path
+
+    def test_nodata_patches_are_skipped_before_reading(self):
+        for overviews in [[], [2, 4, 8]]:
+            link = self.write_nodata_scene(overviews)
+            record = read_scene_metadata(link)
+            jobs = plan_patch_jobs([record], self.xs, self.ys, 100, None)
+            # The fraction of nodata in every patch, from the patches themselves
+            fractions = dict()
+            for patch in iter_patches_by_scene([link], jobs, prefetch=0, patch_filter=PatchFilter(1.0)):
+                fractions[patch.point_idx] = np.mean((patch.data == 0).all(axis=0))
+            assert min(fractions.values()) == 0 and max(fractions.values()) == 1
+
+            stats = dict()
+            kept = {patch.point_idx for patch in iter_patches_by_scene([link], jobs, prefetch=0, stats=stats, patch_filter=PatchFilter(0.5))}
+            if len(overviews) == 0:
+                # Checked on the data itself, exactly
+                assert kept == {p for p in fractions if fractions[p] <= 0.5}
+                assert stats.get("mask_bytes", 0) == 0
+            else:
+                # Checked on an overview of the mask, only the patches close to the threshold can differ
+                assert {p for p in fractions if fractions[p] < 0.4} <= kept <= {p for p in fractions if fractions[p] < 0.6}
+                assert 0 < stats["mask_bytes"] < stats["read_bytes"] / 16
+                assert stats["saved_bytes"] > 0
+            assert stats["skipped_nodata"] == len(jobs) - len(kept) > 0
+            assert "too much nodata" in format_read_stats(stats)
+
+    def test_point_major_cropping_skips_nodata_patches(self):
+        link = self.write_nodata_scene([])
+        record = read_scene_metadata(link)
+        jobs = plan_patch_jobs([record], self.xs, self.ys, 100, None)
+        kept = {patch.point_idx for patch in iter_patches_by_scene([link], jobs, prefetch=0, patch_filter=PatchFilter(0.5))}
+        path_to_dir = os.path.join(self.tmpdir.name, "point-major")
+        os.makedirs(path_to_dir)
+        for (idx, (x, y)) in enumerate(zip(self.xs, self.ys)):
+            crop_patches_for_point([link], [record.bounds], Point(x, y), idx, 100, path_to_dir, False, patch_filter=PatchFilter(0.5))
+        assert {int(name.split("-")[0]) for name in os.listdir(path_to_dir)} == kept
+
+    def test_schedule_work_units(self):
+        jobs = plan_patch_jobs(self.records, self.xs, self.ys, 20, self.tmpdir.name)
+        units = schedule_work_units(self.links, jobs, max_jobs_per_unit=5)
+        costs = [cost for (cost, _, _) in units]
+        assert costs == sorted(costs, reverse=True)
+        assert all(len(unit_jobs) <= 5 for (_, _, unit_jobs) in units)
+        assert all(self.links[job.scene_idx] == link for (_, link, unit_jobs) in units for job in unit_jobs)
+        assert sorted(job for (_, _, unit_jobs) in units for job in unit_jobs) == sorted(jobs)
+
+
+@unittest.skipUnless(OPENER_SUPPORTED, "reading through the range cache needs rasterio >= 1.4")
+class TestRangeCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        self.paths = [
+            write_synthetic_geotiff(scene_path(root, "post", "2017-09-12", name), bounds, size=512, seed=seed)
+            for (name, bounds, seed) in [
+                ("A", (-63.10, 18.00, -63.08, 18.02), 1),
+                ("B", (-63.09, 18.01, -63.07, 18.03), 2),
+            ]
+        ]
+        self.cache_path = os.path.join(root, "cache", "range-cache.sqlite")
+        self.env = mock.patch.dict(os.environ, {RANGE_CACHE_ENV: self.cache_path})
+        self.env.start()
+        self.windows = [((100, 180), (40, 300)), ((0, 512), (500, 512)), ((300, 301), (0, 512))]
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmpdir.cleanup()
+
+    def read_windows(self, link):
+        with rio.Env(**GDAL_REMOTE_OPTIONS), open_scene(link) as src:
+            return [src.read(window=window) for window in self.windows]
+
+    def test_cached_reads_match_and_persist(self):
+        expected = self.read_windows(self.paths[0])
+        with LocalHTTPServer(self.tmpdir.name) as server:
+            link = server.url(self.paths[0])
+            first = self.read_windows(link)
+            fetched = len(server.requests)
+            # A new cache object on the same file, so nothing comes from memory
+            with mock.patch("data_loading.range_cache_utils._range_cache", None):
+                second = self.read_windows(link)
+            assert len(server.requests) == fetched > 0
+        for (a, b, c) in zip(expected, first, second):
+            assert (a == b).all() and (a == c).all()
+        stats = RangeCache(self.cache_path).stats()
+        assert stats["hits"] > 0 and stats["misses"] > 0 and stats["evictions"] == 0
+        assert stats["cached_bytes"] == stats["bytes_fetched"] <= os.path.getsize(self.paths[0])
+
+    def test_eviction_keeps_cache_bounded(self):
+        cache = RangeCache(self.cache_path, max_bytes=8 * 1024, block_size=1024, memory_blocks=0)
+        with LocalHTTPServer(self.tmpdir.name) as server:
+            link = server.url(self.paths[0])
+            with open(self.paths[0], "rb") as f:
+                expected = f.read()
+            assert cache.read(link, 0, 3000) == expected[:3000]
+            assert cache.read(link, 50000, 20000) == expected[50000:70000]
+            # The first blocks were evicted, so they are fetched again
+            before = len(server.requests)
+            assert cache.read(link, 10, 100) == expected[10:110]
+            assert len(server.requests) == before + 1
+            assert cache.read(link, len(expected) - 10, 100) == expected[-10:]
+        stats = cache.stats()
+        assert stats["cached_bytes"] <= 8 * 1024
+        assert stats["evictions"] > 0
+        assert stats["requests"] == 4
+
+    def test_shared_by_worker_processes(self):
+        records = [read_scene_metadata(path) for path in self.paths]
+        rng = np.random.default_rng(0)
+        xs = rng.uniform(-63.10, -63.07, 30)
+        ys = rng.uniform(18.00, 18.03, 30)
+        expected_dir = os.path.join(self.tmpdir.name, "expected")
+        os.makedirs(expected_dir)
+        expected = extract_patches_by_scene(self.paths, plan_patch_jobs(records, xs, ys, 20, expected_dir), False)
+        with LocalHTTPServer(self.tmpdir.name) as server:
+            links = [server.url(path) for path in self.paths]
+            for run in range(2):
+                path_to_dir = os.path.join(self.tmpdir.name, f"run-{run}")
+                os.makedirs(path_to_dir)
+                jobs = plan_patch_jobs([record._replace(link=link) for (record, link) in zip(records, links)], xs, ys, 20, path_to_dir)
+                before = len(server.requests)
+                assert extract_patches_by_scene(links, jobs, False, workers=2) == expected
+                if run == 1:
+                    # Everything was cached by the workers of the first run
+                    assert len(server.requests) == before
+                for name in os.listdir(expected_dir):
+                    with rio.open(os.path.join(expected_dir, name)) as a, rio.open(os.path.join(path_to_dir, name)) as b:
+                        assert (a.read() == b.read()).all() and a.transform == b.transform
+        assert get_range_cache().stats()["misses"] > 0
+
+
+class TestSceneSelection(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        bounds = (-63.10, 18.00, -63.08, 18.02)
+        self.links = [
+            write_synthetic_geotiff(scene_path(root, phase, date, name), bounds, size=256, nodata=0, seed=seed)
+            for (seed, (phase, date, name)) in enumerate([
+                ("pre", "2017-05-20", "A"),
+                ("pre", "2017-08-30", "B"),
+                ("post", "2017-09-08", "C"),
+                ("post", "2017-09-20", "D"),
+                ("pre", "2017-09-07", "E"),
+            ])
+        ]
+        # Scene C is black but for its right quarter
+        with rio.open(self.links[2], "r+") as dst:
+            data = dst.read()
+            data[:, :, :192] = 0
+            dst.write(data)
+        self.records = [read_scene_metadata(link) for link in self.links]
+        rng = np.random.default_rng(0)
+        self.xs = rng.uniform(-63.0995, -63.0805, 30)
+        self.ys = rng.uniform(18.0005, 18.0195, 30)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def selected(self, selection, records=None):
+        records = self.records if records is None else records
+        jobs = plan_patch_jobs(records, self.xs, self.ys, 20, None, selection=selection)
+        res = dict()
+        for job in jobs:
+            res.setdefault(job.point_idx, []).append(records[job.scene_idx].link)
+        # Patches are still numbered 1, 2, ... for every point
+        for point_idx in res:
+            assert sorted(job.seq for job in jobs if job.point_idx == point_idx) == list(range(1, len(res[point_idx]) + 1))
+        return res
+
+    def test_all(self):
+        everything = self.selected(None)
+        assert self.selected(SceneSelection("all")) == everything
+        assert all(len(links) == 5 for links in everything.values()) and len(everything) == len(self.xs)
+
+    def test_date_policies(self):
+        (A, B, C, D, E) = self.links
+        by_phase = {point: links for (point, links) in self.selected(SceneSelection("latest-before", k=2)).items()}
+        assert all(links == [B, E] for links in by_phase.values())
+        # With a landfall date, E (in the pre-event folder but acquired after landfall) is not before it
+        for (selection, expected) in [
+            (SceneSelection("latest-before", 2, "2017-09-06"), [A, B]),
+            (SceneSelection("latest-before", 1, "2017-09-06"), [B]),
+            (SceneSelection("earliest-after", 1), [C]),
+            (SceneSelection("earliest-after", 2, "2017-09-06"), [C, E]),
+            (SceneSelection("closest", 2, "2017-09-06"), [C, E]),
+            (SceneSelection("closest", 2), [C, E]),
+        ]:
+            res = self.selected(selection)
+            assert len(res) == len(self.xs)
+            assert all(sorted(links) == sorted(expected) for links in res.values()), selection
+        # Only the pre event scenes are given, as for a pre event run
+        res = self.selected(SceneSelection("closest", 1), [self.records[i] for i in [0, 1, 4]])
+        assert all(links == [E] for links in res.values())
+        res = self.selected(SceneSelection("closest", 1), [self.records[i] for i in [2, 3]])
+        assert all(links == [C] for links in res.values())
+
+    def test_single_phase_policies_are_rejected_for_both_phases(self):
+        check_policy_for_phase("latest-before", "pre")
+        check_policy_for_phase("earliest-after", "post")
+        check_policy_for_phase("closest")
+        for (policy, phase) in [("latest-before", None), ("latest-before", "post"), ("earliest-after", None), ("earliest-after", "pre")]:
+            with self.assertRaises(ValueError):
+                check_policy_for_phase(policy, phase)
+        # Before any data is loaded
+        with mock.patch.object(patch_utils, "crop_all_patches") as crop_all_patches, self.assertRaises(ValueError):
+            patch_utils.main("test", False, scenes="earliest-after")
+        crop_all_patches.assert_not_called()
+
+    def test_coverage(self):
+        record = self.records[2]
+        with rio.open(record.link) as src:
+            mask = src.dataset_mask()
+        windows = get_windows_for_bounds(*get_bounds_for_points(self.xs, self.ys, 100), record.affine)
+        coverage = get_window_coverage(mask, windows, record.width, record.height)
+        for (i, window) in enumerate(zip(*windows)):
+            (col_off, row_off, width, height) = window
+            (c0, r0) = (int(np.floor(col_off)), int(np.floor(row_off)))
+            (c1, r1) = (int(np.ceil(col_off + width)), int(np.ceil(row_off + height)))
+            expected = np.count_nonzero(mask[max(r0, 0):r1, max(c0, 0):c1]) / ((c1 - c0) * (r1 - r0))
+            assert abs(coverage[i] - expected) < 1e-9
+        # Decimated, the coverage is about the same
+        small = mask[::4, ::4]
+        assert np.abs(get_window_coverage(small, windows, record.width, record.height) - coverage).max() < 0.1
+
+        # The points whose patch is in the black part of scene C are not cropped from it
+        res = self.selected(SceneSelection("coverage", 5))
+        (col_offs, _, widths, _) = get_windows_for_bounds(*get_bounds_for_points(self.xs, self.ys, 20), record.affine)
+        for (point_idx, links) in res.items():
+            assert (self.links[2] in links) == (col_offs[point_idx] + widths[point_idx] > 192), links
+        assert set(len(links) for links in res.values()) == {4, 5}
+
+    def test_custom_policy(self):
+        def first_two(records, point_idx, scene_idx, landfall, coverage):
+            return (np.ones(len(point_idx), dtype=bool), -scene_idx.astype(float))
+        res = self.selected(SceneSelection(first_two, 2))
+        assert all(links == self.links[:2] for links in res.values())
+        with self.assertRaises(ValueError):
+            self.selected(SceneSelection("newest"))
+
+
+class TestPipelineBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config = BenchmarkConfig(points=200, scenes=4, scene_size=64, extract_points=20)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_synthetic_hurricane(self):
+        data = make_synthetic_hurricane(self.tmpdir.name, points=100, scenes=10, scene_size=32, files=3)
+        assert len(data.scene_paths) == 10 and data.counts.count(1) == 1
+        assert [get_phase_from_link(path) for path in data.scene_paths] == ["pre"] * 5 + ["post"] * 5
+        for (path, bounds) in zip(data.scene_paths, data.bounds):
+            with rio.open(path) as src:
+                assert np.allclose(tuple(src.bounds), bounds)
+        gdf = read_vector_data_files(data.vector_files, False)
+        assert len(gdf) == 100 and gdf.geometry.x.tolist() == data.xs.tolist()
+        # Crowdsourced labels first, then the official assessments
+        assert "Flooded / Damaged Building" in set(gdf.damage[:66]) and set(gdf.damage[67:]) <= {"Affected", "Minor", "Major", "Destroyed"}
+
+    def test_run_benchmarks(self):
+        for source in ["local", "http"]:
+            res = run_benchmarks(self.config._replace(source=source), repeat=1, toprint=False)
+            assert list(res.keys()) == STAGES and all(seconds > 0 for seconds in res.values()), (source, res)
+        # Nothing is written outside of the temporary directory
+        assert not os.path.isdir(os.path.join(PATH_TO_TIDIED_FILELISTS, "synthetic"))
+
+    def test_baselines(self):
+        path = os.path.join(self.tmpdir.name, "baselines.json")
+        results = dict(zip(STAGES, [0.1, 0.2, 1.0, 0.01, 0.5, 0.5, 2.0]))
+        save_baseline(self.config, results, path)
+        assert load_baselines(path)[self.config.key]["seconds"] == results
+        slower = dict(results, combine=1.6, trim=0.04, extract=2.5)
+        # trim is 4 times slower, but by less than MIN_REGRESSION_SECONDS
+        assert list(find_regressions(slower, results, tolerance=0.5).keys()) == ["combine"]
+        assert find_regressions(slower, dict(), tolerance=0.5) == dict()
+        with mock.patch.object(bench_pipeline, "run_benchmarks", return_value=slower):
+            assert bench_pipeline.main(self.config, path_to_baselines=path) == 1
+            assert bench_pipeline.main(self.config._replace(points=300), path_to_baselines=path) == 0
+        with mock.patch.object(bench_pipeline, "run_benchmarks", return_value=results):
+            assert bench_pipeline.main(self.config, path_to_baselines=path) == 0
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_print_message_end(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            utils.print_message(True, "1/2", end="\r")
+            utils.print_message(True, "2/2")
+            utils.print_message(False, "hidden")
+        assert out.getvalue() == "1/2\r2/2\n"
+
+    def test_stages_and_counters(self):
+        path = os.path.join(self.tmpdir.name, "metrics", "run.jsonl")
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            with instrumented_run("outer", True, path) as instrumentation:
+                with stage("scenes"):
+                    time.sleep(0.01)
+                # A nested run is a stage of the outer one
+                with instrumented_run("inner", True):
+                    with stage("trim"):
+                        count("rows", 5)
+                for phase in ["pre", "post"]:
+                    with stage("extract", phase=phase):
+                        count("patches_written", 3, phase=phase)
+                count("patches_written", 1, phase="pre")
+        assert get_instrumentation() is None
+        # Outside of a run, nothing is recorded
+        with stage("nothing"):
+            count("rows", 1)
+        assert [key for key in instrumentation.timers] == [
+            ("scenes", ()), ("inner/trim", ()), ("inner", ()),
+            ("extract", (("phase", "pre"),)), ("extract", (("phase", "post"),)),
+        ]
+        assert instrumentation.timers[("scenes", ())][0] >= 0.01
+        assert instrumentation.get("patches_written", phase="pre") == 4 and instrumentation.get("rows") == 5
+        # One summary, for the outer run
+        summary = out.getvalue()
+        assert summary.count("total") == 1 and "inner/trim" in summary and 'patches_written{phase="post"}' in summary
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        assert [line["stage"] for line in lines if line["type"] == "stage"] == ["scenes", "inner/trim", "inner", "extract", "extract"]
+        assert {(line["counter"], line["labels"].get("phase"), line["value"]) for line in lines if line["type"] == "counter"} == {
+            ("rows", None, 5), ("patches_written", "pre", 4), ("patches_written", "post", 3)
+        }
+        assert lines[-1]["type"] == "run" and all(line["run"] == "outer" for line in lines)
+
+    def test_prometheus(self):
+        path = os.path.join(self.tmpdir.name, "run.prom")
+        with instrumented_run("patches", False, path):
+            with stage("extract", phase="pre"):
+                count("bytes_read", 2048, phase="pre")
+        with open(path) as f:
+            text = f.read()
+        samples = dict(line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#"))
+        assert float(samples['cat5_stage_seconds{run="patches",stage="extract",phase="pre"}']) > 0
+        assert samples['cat5_stage_calls{run="patches",stage="extract",phase="pre"}'] == "1"
+        assert samples['cat5_bytes_read{run="patches",phase="pre"}'] == "2048"
+        assert "# TYPE cat5_bytes_read gauge" in text
+
+    def test_io_stats(self):
+        root = self.tmpdir.name
+        paths = [write_synthetic_geotiff(scene_path(root, "post", "2017-09-12", name), (0, 0, 1, 1), size=64) for name in "AB"]
+        with mock.patch.dict(os.environ, {RANGE_CACHE_ENV: ""}), LocalHTTPServer(root) as server:
+            with instrumented_run("read", False, io_stats=True) as instrumentation:
+                for link in [paths[0], server.url(paths[1])]:
+                    with rio.Env(**GDAL_REMOTE_OPTIONS), open_scene(link) as src:
+                        src.read()
+            sent = len(server.requests)
+        assert instrumentation.get("gdal_opens") == 2
+        assert 0 < instrumentation.get("gdal_http_requests") <= sent
+        assert 0 < instrumentation.get("gdal_http_bytes") <= os.path.getsize(paths[1])
+        assert not rio.env.get_gdal_config("CPL_DEBUG")
+
+
+class TestCommandLine(unittest.TestCase):
+    # Seconds to import the command line, and a module the worker processes import
+    CLI_IMPORT_BUDGET = 1.0
+    WORKER_IMPORT_BUDGET = 2.0
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def import_in_new_process(self, module) -> tuple:
+        code = (
+            "import sys, time, json\n"
+            "sys.path.append('src')\n"
+            "start = time.perf_counter()\n"
+            f"import {module}\n"
+            "print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))\n"
+        )
+        root = os.path.join(os.path.dirname(__file__), "..", "..")
+        out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True).stdout
+        return tuple(json.loads(out.splitlines()[-1]))
+
+    def test_import_time(self):
+        (seconds, modules) = self.import_in_new_process("src.cli")
+        assert not {"rasterio", "geopandas", "pandas", "shapely", "requests", "pyarrow"} & set(modules)
+        assert seconds < self.CLI_IMPORT_BUDGET, f"Importing the command line took {seconds:.2f}s"
+        # What every extraction worker imports
+        (seconds, modules) = self.import_in_new_process("data_loading.extraction_utils")
+        assert not {"geopandas", "pandas", "shapely", "requests", "email", "asyncio"} & set(modules)
+        assert seconds < self.WORKER_IMPORT_BUDGET, f"Importing extraction_utils took {seconds:.2f}s"
+
+    def test_extract_patches_arguments(self):
+        with mock.patch.object(patch_utils, "main") as main:
+            cli.main(["extract-patches", " Test", "--quiet", "--scenes", "closest", "--k", "2", "--workers", "4"])
+        main.assert_called_once_with(
+            hurricane_name="test", toprint=False, dist=20, workers=4, output="gtiff", dry_run=False, max_nodata=PATCH_MAX_NODATA,
+            boundless="clip", scenes="closest", k=2, metrics=None, io_stats=False, band_stats=False,
+            codec="none", level=None, layout=None, encode_threads=PATCH_ENCODE_THREADS,
+        )
+        for scenes in ["newest", "latest-before"]:
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+                cli.main(["extract-patches", "test", "--scenes", scenes])
+        args = cli.make_parser().parse_args(["trim"])
+        assert (args.hurricane_name, args.toprint, args.overwrite, args.func) == (DEFAULT_HURRICANE, True, False, cli.run_trim)
+        with mock.patch("data_loading.vector_data_utils.combine_all_vector_data_and_save_for_hurricane") as combine:
+            args.func(args)
+        assert combine.call_args.args == ()
+        assert combine.call_args.kwargs["hurricane_name"] == DEFAULT_HURRICANE and combine.call_args.kwargs["overwrite"] is False
+
+    def test_tidy_and_stats(self):
+        root = self.tmpdir.name
+        paths = [
+            write_synthetic_geotiff(scene_path(root, "pre", "2017-05-20", "A"), (0, 0, 1, 1)),
+            write_synthetic_geotiff(scene_path(root, "post", "2017-09-12", "B"), (0, 0, 1, 1)),
+            write_synthetic_geotiff(scene_path(root, "post", "2017-09-12", "C"), (0, 0, 1, 1), count=1),
+        ]
+        file_list = os.path.join(root, "synthetic_file_list.txt")
+        with open(file_list, "w") as f:
+            f.write("\n".join(paths) + "\n")
+        tidied = os.path.join(root, "tidied")
+        with mock.patch("data_loading.catalog_utils.PATH_TO_SCENE_CATALOG", os.path.join(root, "catalog.sqlite")), \
+                mock.patch("data_loading.tif_links_utils.PATH_TO_TIDIED_FILELISTS", tidied), \
+                mock.patch("data_loading.tif_links_utils.PATH_TO_TIDY_REPORTS", os.path.join(root, "reports")), \
+                mock.patch.object(cli, "PATH_TO_TIDIED_FILELISTS", tidied), \
+                mock.patch.object(cli, "PATH_TO_PATCHES", os.path.join(root, "patches")):
+            cli.main(["tidy", "synthetic", "--quiet", "--file-list", file_list])
+            PatchManifest(os.path.join(root, "patches", "synthetic", MANIFEST_FILENAME)).record([
+                ("a", "pre", "a.tif", "f", "done", "h", None),
+                ("b", "post", "b.tif", "f", "done", "h", None),
+                ("c", "post", "c.tif", "f", "failed", None, "error"),
+            ])
+            stats = cli.get_stats("synthetic")
+            assert stats == {"links": {"pre": 1, "post": 1}, "patches": {"pre": {"done": 1}, "post": {"done": 1, "failed": 1}}}
+            assert "1 done, 1 failed" in cli.format_stats("synthetic", stats)
+            assert cli.get_stats("other") == dict()
+
+
+class TestPatchService(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data = make_synthetic_hurricane(self.tmpdir.name, points=40, scenes=6, scene_size=128)
+        records = [read_scene_metadata(path) for path in self.data.scene_paths]
+        self.records = {phase: [record for record in records if record.phase == phase] for phase in ["pre", "post"]}
+        # Points inside at least one post event scene
+        index = FootprintIndex([record.bounds for record in self.records["post"]])
+        (point_idx, _) = index.query(self.data.xs, self.data.ys)
+        self.points = sorted(set(point_idx.tolist()))[:5]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def expected_patches(self, point_idx, phase="post"):
+        (xs, ys) = (self.data.xs[[point_idx]], self.data.ys[[point_idx]])
+        records = self.records[phase]
+        jobs = plan_patch_jobs(records, xs, ys, 20, None)
+        return list(iter_patches_by_scene([record.link for record in records], jobs, xs, ys))
+
+    def test_same_patches_as_extraction(self):
+        assert len(self.points) > 0
+        with PatchService(self.records) as service:
+            for point_idx in self.points:
+                (lon, lat) = (self.data.xs[point_idx], self.data.ys[point_idx])
+                patches = service.get_patches(lat, lon, 20, "post")
+                expected = self.expected_patches(point_idx)
+                assert [(p.seq, p.link) for p in patches] == [(p.seq, p.link) for p in expected]
+                for (patch, other) in zip(patches, expected):
+                    assert np.array_equal(patch.data, other.data) and patch.transform == other.transform
+                    assert not patch.data.flags.writeable
+                # As GeoTIFF bytes
+                for (tif, other) in zip(service.get_geotiffs(lat, lon, 20, "post"), expected):
+                    with rio.MemoryFile(tif) as memfile, memfile.open() as src:
+                        assert np.array_equal(src.read(), other.data) and src.transform == other.transform
+            # Nowhere near any scene
+            assert service.get_patches(0, 0, 20, "post") == []
+            with self.assertRaises(ValueError):
+                service.get_patches(0, 0, 20, "during")
+
+    def test_caches(self):
+        with PatchService(self.records, max_queries=2, max_open_datasets=1) as service:
+            (lon, lat) = (self.data.xs[self.points[0]], self.data.ys[self.points[0]])
+            first = service.get_patches(lat, lon)
+            assert service.get_patches(lat + 1e-9, lon) is first
+            stats = service.latency_stats()
+            assert (stats["queries"], stats["cache_hits"], stats["open_datasets"]) == (2, 1, 1)
+            assert stats["patches_read"] == len(first)
+            for point_idx in self.points[1:]:
+                service.get_patches(self.data.ys[point_idx], self.data.xs[point_idx])
+            stats = service.latency_stats()
+            assert stats["cached_queries"] == min(2, len(self.points)) and stats["open_datasets"] <= 1
+            assert stats["p50_ms"] <= stats["p90_ms"] <= stats["p99_ms"] <= stats["max_ms"]
+        assert get_latency_percentiles([])["p50_ms"] is None
+        assert get_latency_percentiles([0.001, 0.002, 0.003], [50])["p50_ms"] == 2.0
+
+    def test_slow_reads_do_not_block_cache_hits(self):
+        slow = threading.Event()
+
+        def read_slowly(*args, **kwargs):
+            if slow.is_set():
+                time.sleep(1.0)
+            return extraction_utils.iter_patches_from_dataset(*args, **kwargs)
+
+        with mock.patch("data_loading.patch_service_utils.iter_patches_from_dataset", read_slowly), PatchService(self.records) as service:
+            (lon, lat) = (self.data.xs[self.points[0]], self.data.ys[self.points[0]])
+            service.get_patches(lat, lon)
+            slow.set()
+            (other_lon, other_lat) = (self.data.xs[self.points[1]], self.data.ys[self.points[1]])
+            thread = threading.Thread(target=service.get_patches, args=(other_lat, other_lon))
+            thread.start()
+            time.sleep(0.2)
+            start = time.perf_counter()
+            service.get_patches(lat, lon)
+            seconds = time.perf_counter() - start
+            assert thread.is_alive()
+            thread.join()
+        assert seconds < 0.5, seconds
+        assert service.latency_stats()["cache_hits"] == 1
+
+    def test_http_server(self):
+        point_idx = self.points[0]
+        (lon, lat) = (self.data.xs[point_idx], self.data.ys[point_idx])
+        (lon, lat) = (float(lon), float(lat))
+        expected = self.expected_patches(point_idx)
+        with PatchService(self.records) as service, make_patch_server(service, port=0) as server:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            try:
+                with urllib.request.urlopen(f"{url}/patches?lat={lat!r}&lon={lon!r}") as response:
+                    described = json.loads(response.read())
+                assert [(d["seq"], d["link"], d["shape"]) for d in described] == [(p.seq, p.link, list(p.data.shape)) for p in expected]
+                with urllib.request.urlopen(f"{url}/patch?lat={lat!r}&lon={lon!r}&seq=1") as response:
+                    with rio.MemoryFile(response.read()) as memfile, memfile.open() as src:
+                        assert np.array_equal(src.read(), expected[0].data)
+                with urllib.request.urlopen(f"{url}/patch?lat={lat!r}&lon={lon!r}&seq=1&format=npy") as response:
+                    assert np.array_equal(np.load(io.BytesIO(response.read())), expected[0].data)
+                for (query, status) in [("patch?lat=1", 400), ("patch?lat=0&lon=0", 404), ("tiles", 404),
+                                        ("patches?lat=0&lon=0&dist=1e9", 400), ("patches?lat=0&lon=0&dist=0", 400)]:
+                    with self.assertRaises(urllib.error.HTTPError) as e:
+                        urllib.request.urlopen(f"{url}/{query}")
+                    assert e.exception.code == status
+                with urllib.request.urlopen(f"{url}/stats") as response:
+                    stats = json.loads(response.read())
+                assert (stats["queries"], stats["cache_hits"]) == (4, 2)
+            finally:
+                server.shutdown()
+
+
+class TestBandStats(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def assert_same_stats(self, a, b):
+        assert (a.count == b.count).all() and (a.histogram == b.histogram).all()
+        assert np.allclose(a.mean, b.mean) and np.allclose(a.std, b.std)
+        assert (a.min == b.min).all() and (a.max == b.max).all()
+
+    def test_matches_numpy(self):
+        rng = np.random.default_rng(0)
+        patches = [rng.integers(0, 256, size=(3, rng.integers(1, 40), rng.integers(1, 40)), dtype=np.uint8) for _ in range(50)]
+        # Nodata where every band is 0
+        for patch in patches[::3]:
+            patch[:, :patch.shape[1] // 2] = 0
+        (first, second) = (BandStats(), BandStats())
+        for (i, patch) in enumerate(patches):
+            (first if i % 2 == 0 else second).update(patch, nodata=0)
+        merged = BandStats().merge(first).merge(second)
+        values = np.concatenate([patch[:, (patch != 0).any(axis=0)] for patch in patches], axis=1).astype(float)
+        assert (merged.count == values.shape[1]).all()
+        assert np.allclose(merged.mean, values.mean(axis=1)) and np.allclose(merged.std, values.std(axis=1))
+        assert (merged.min == values.min(axis=1)).all() and (merged.max == values.max(axis=1)).all()
+        assert all((merged.histogram[b] == np.bincount(values[b].astype(int), minlength=256)).all() for b in range(3))
+        q = [0.01, 0.5, 0.99]
+        assert (merged.quantiles(q) == np.quantile(values, q, axis=1, method="inverted_cdf").T).all()
+        # Through JSON and back
+        self.assert_same_stats(BandStats.from_dict(json.loads(json.dumps(merged.to_dict()))), merged)
+        # A patch with an extra band, and histograms that do not match
+        merged.update(np.full((4, 2, 2), 7, dtype=np.uint8))
+        assert merged.count.tolist() == [values.shape[1] + 4] * 3 + [4] and merged.mean[3] == 7
+        coarse = BandStats(bins=16)
+        coarse.update(patches[0])
+        with self.assertRaises(ValueError):
+            merged.merge(coarse)
+        other = BandStats()
+        other.update(np.zeros((3, 2, 2), dtype=np.uint16))
+        with self.assertRaises(ValueError):
+            merged.merge(other)
+
+    def test_during_extraction_and_from_files(self):
+        data = make_synthetic_hurricane(self.tmpdir.name, points=200, scenes=8, scene_size=128)
+        records = [read_scene_metadata(path) for path in data.scene_paths if "post-event" in path]
+        links = [record.link for record in records]
+        path_to_dir = os.path.join(self.tmpdir.name, "patches", "post")
+        os.makedirs(path_to_dir)
+        jobs = plan_patch_jobs(records, data.xs, data.ys, 20, path_to_dir)
+        # Every patch, so that all the files exist
+        keep_all = PatchFilter(max_nodata=1.0)
+        serial = BandStatsSink(GTiffSink(), records, "post")
+        extract_patches_by_scene(links, jobs, False, sink=serial, patch_filter=keep_all)
+        parallel = BandStatsSink(GTiffSink(), records, "post")
+        extract_patches_by_scene(links, jobs, False, workers=2, sink=parallel, patch_filter=keep_all)
+        from_files = compute_band_stats_for_files(
+            [job.path for job in jobs], [("post", links[job.scene_idx]) for job in jobs], [records[job.scene_idx].nodata for job in jobs]
+        )
+        assert set(serial.stats) == set(parallel.stats) == set(from_files) and len(from_files) > 1
+        for key in from_files:
+            self.assert_same_stats(serial.stats[key], from_files[key])
+            self.assert_same_stats(parallel.stats[key], from_files[key])
+        # The scene with nodata edges has no 0 in its statistics
+        assert all(value.min.min() > 0 for value in from_files.values())
+        # From an array store, and from the directory
+        sink = BandStatsSink(None, records, "post")
+        (sink.sink, store_jobs) = create_patch_store(os.path.join(self.tmpdir.name, "patches", "post"), records, jobs, "post", keep_all)
+        written = WrittenPatches()
+        extract_patches_by_scene(links, store_jobs, False, sink=sink, on_done=written, patch_filter=keep_all)
+        save_written_patches(os.path.join(self.tmpdir.name, "patches", "post"), written.idx)
+        from_store = compute_band_stats_for_store(os.path.join(self.tmpdir.name, "patches", "post"))
+        for key in from_files:
+            self.assert_same_stats(from_store[key], sink.stats[key])
+            self.assert_same_stats(from_store[key], from_files[key])
+        by_phase = compute_band_stats_for_directory(os.path.join(self.tmpdir.name, "patches"), "gtiff", workers=1, toprint=False)
+        self.assert_same_stats(by_phase[("post", None)], group_band_stats(from_files)["post"])
+
+    def test_saved_next_to_the_patches(self):
+        rng = np.random.default_rng(1)
+        links = [
+            "https://host/hurricane-irma/pre-event/2017-05-20/103001006B055400/103001006B055400.tif",
+            "https://host/hurricane-irma/pre-event/2016-09-08/104001005CD78300/104001005CD78300.tif",
+            "https://host/hurricane-irma/post-event/2017-09-12/103001000BC42300/103001000BC42300.tif",
+        ]
+        stats = dict()
+        patches = dict()
+        for (i, link) in enumerate(links):
+            phase = get_phase_from_link(link)
+            patches[link] = rng.normal(50 * (i + 1), 10 * (i + 1), size=(3, 30, 30)).clip(1, 255).astype(np.uint8)
+            stats[(phase, link)] = BandStats()
+            stats[(phase, link)].update(patches[link], nodata=0)
+        path = os.path.join(self.tmpdir.name, "irma")
+        assert load_band_stats(path) is None
+        save_band_stats(path, stats)
+        loaded = load_band_stats(path)
+        assert set(loaded) == set(stats)
+        assert set(group_band_stats(loaded, "sensor")) == {("pre", "WV02"), ("pre", "WV03"), ("post", "WV02")}
+
+
+class TestPatchCodecs(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_codecs_are_lossless(self):
+        patches = bench_patch_codecs.make_synthetic_patches(2, 40, bands=3) + bench_patch_codecs.make_synthetic_patches(1, 40, bands=4, dtype="uint16")
+        transform = rio.transform.from_bounds(-63.1, 18.0, -63.0, 18.1, 40, 40)
+        for (codec, layout, (i, data)) in itertools.product(PATCH_CODECS, PATCH_LAYOUTS, enumerate(patches)):
+            path = os.path.join(self.tmpdir.name, f"{codec}-{layout}-{i}.tif")
+            write_patch(path, data, transform, "EPSG:4326", get_encoding(codec, 1 if codec == "zstd" else None, layout))
+            with rio.open(path) as src:
+                assert (src.read() == data).all() and src.transform == transform, (codec, layout)
+                # webp only encodes 8 bit pixels
+                expected = "deflate" if codec == "webp" and data.dtype != np.uint8 else codec
+                assert src.compression == (None if codec == "none" else rio.enums.Compression[expected]), (codec, layout)
+                assert src.profile["tiled"] == (layout != "strips")
+                assert layout == "strips" or src.block_shapes[0] == {"tiles": (48, 48), "cog": (128, 128)}[layout]
+                assert (src.tags(ns="IMAGE_STRUCTURE").get("LAYOUT") == "COG") == (layout == "cog")
+        assert get_encoding() == PatchEncoding() and get_encoding("zstd").layout == "tiles"
+        assert get_tile_size((3, 500, 20)) == PATCH_TILE_SIZE and get_tile_size((3, 17, 3)) == 32
+        for (args, kwargs) in [(("jpeg",), {}), (("deflate",), {"layout": "rows"}), (("deflate",), {"tile_size": 100})]:
+            with self.assertRaises(ValueError):
+                get_encoding(*args, **kwargs)
+
+    def test_threaded_sink_matches_serial(self):
+        data = make_synthetic_hurricane(self.tmpdir.name, points=200, scenes=8, scene_size=128)
+        records = [read_scene_metadata(path) for path in data.scene_paths if "post-event" in path]
+        links = [record.link for record in records]
+        encoding = get_encoding("deflate", 9)
+        written = dict()
+        for (name, sink, workers) in [("serial", GTiffSink(), 1), ("threaded", GTiffSink(encoding, 2), 1), ("parallel", GTiffSink(encoding, 2), 2)]:
+            path_to_dir = os.path.join(self.tmpdir.name, name)
+            os.makedirs(path_to_dir)
+            jobs = plan_patch_jobs(records, data.xs, data.ys, 20, path_to_dir)
+            assert extract_patches_by_scene(links, jobs, False, workers=workers, sink=sink, patch_filter=PatchFilter(1.0)) == len(jobs) > 0
+            written[name] = {os.path.basename(job.path): job.path for job in jobs}
+        for (name, path) in written["serial"].items():
+            with rio.open(path) as a, rio.open(written["threaded"][name]) as b, rio.open(written["parallel"][name]) as c:
+                assert (a.read() == b.read()).all() and (a.read() == c.read()).all() and a.transform == b.transform == c.transform
+                assert b.compression == rio.enums.Compression.deflate
+        # The errors of the threads come out of flush
+        sink = GTiffSink(encoding, 2)
+        sink.write(jobs[0]._replace(path=os.path.join(self.tmpdir.name, "missing", "0-1.tif")), np.zeros((3, 8, 8), np.uint8), rio.Affine.identity(), "EPSG:4326")
+        with self.assertRaises(rio.errors.RasterioIOError):
+            sink.flush()
+        # Patches saved with another encoding are cut again, the fingerprints of older manifests stay the same
+        fingerprints = [get_job_fingerprint(jobs[0], records[jobs[0].scene_idx], None, encoding) for encoding in [None, PatchEncoding(), encoding]]
+        assert fingerprints[0] == fingerprints[1] != fingerprints[2]
+
+    def test_codec_report(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            res = bench_patch_codecs.main(count=4, size=32, repeat=1)
+        assert [(row["codec"], row["layout"]) for row in res] == [("none", "strips")] + list(itertools.product(PATCH_CODECS, ["tiles", "cog"]))
+        assert res[0]["ratio"] == 1 and all(row["bytes"] > 0 and row["read_seconds"] > 0 for row in res)
+        assert max(row["ratio"] for row in res) > 1
+        assert len(out.getvalue().splitlines()) == len(res) + 1
+
+
+suite = unittest.TestSuite([
+    unittest.TestLoader().loadTestsFromTestCase(TestVectorDataUtils),
+    unittest.TestLoader().loadTestsFromTestCase(TestFootprintUtils),
+    unittest.TestLoader().loadTestsFromTestCase(TestSpatialJoins),
+    unittest.TestLoader().loadTestsFromTestCase(TestVectorDataIngestion),
+    unittest.TestLoader().loadTestsFromTestCase(TestVectorDataDownloads),
+    unittest.TestLoader().loadTestsFromTestCase(TestVectorDataStore),
+    unittest.TestLoader().loadTestsFromTestCase(TestCatalogUtils),
+    unittest.TestLoader().loadTestsFromTestCase(TestTifLinksProbing),
+    unittest.TestLoader().loadTestsFromTestCase(TestExtractionUtils),
+    unittest.TestLoader().loadTestsFromTestCase(TestRangeCache),
+    unittest.TestLoader().loadTestsFromTestCase(TestSceneSelection),
+    unittest.TestLoader().loadTestsFromTestCase(TestPipelineBenchmark),
+    unittest.TestLoader().loadTestsFromTestCase(TestInstrumentation),
+    unittest.TestLoader().loadTestsFromTestCase(TestCommandLine),
+    unittest.TestLoader().loadTestsFromTestCase(TestPatchService),
+    unittest.TestLoader().loadTestsFromTestCase(TestBandStats),
+    unittest.TestLoader().loadTestsFromTestCase(TestPatchCodecs),
+])
\ No newline at end of file
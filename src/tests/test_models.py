@@ -1,4 +1,13 @@
 import unittest
+import os.path
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+import rasterio as rio
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from models.pair_loader_utils import PairedPatchLoader, PatchPair, find_patch_pairs, fit_patch, measure_throughput
+from tests.fixtures import write_synthetic_geotiff
 
 
 class TestCase(unittest.TestCase):
@@ -6,4 +15,94 @@ class TestCase(unittest.TestCase):
         self.assertEqual("foo".upper(), "FOO")
 
 
-suite = unittest.TestLoader().loadTestsFromTestCase(TestCase)
+class TestPairedPatchLoader(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = self.tmpdir.name
+        # Points 0..8 have a pre event patch and 1..9 a post event one; point 3 has two post event patches
+        for point_idx in range(9):
+            self.write_patch("pre", point_idx, 1, size = 10 + point_idx)
+        for point_idx in range(1, 10):
+            self.write_patch("post", point_idx, 1, size = 12)
+        self.write_patch("post", 3, 2, size = 12)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_patch(self, phase, point_idx, seq, size):
+        path = os.path.join(self.path, phase, f"{point_idx}-{seq}.tif")
+        return write_synthetic_geotiff(path, (0, 0, 1, 1), size = size, seed = 100 * point_idx + seq)
+
+    def test_find_patch_pairs(self):
+        pairs = find_patch_pairs(self.path)
+        assert [pair.point_idx for pair in pairs] == list(range(1, 9))
+        assert pairs[2].post == os.path.join(self.path, "post", "3-1.tif")
+        assert pairs[2].pre == os.path.join(self.path, "pre", "3-1.tif")
+
+    def test_find_patch_pairs_in_array_stores(self):
+        for (phase, points) in [("pre", [5, 6, 6]), ("post", [6, 7, 6])]:
+            np.save(os.path.join(self.path, phase + ".npy"), np.zeros((3, 3, 4, 4), dtype = np.uint8))
+            pd.DataFrame({"patch_idx": [0, 1, 2], "point_idx": points, "seq": [1, 2, 1]}).to_parquet(os.path.join(self.path, phase + ".parquet"))
+        assert find_patch_pairs(self.path, "npy") == [PatchPair(6, 2, 0)]
+        # Patches skipped for nodata are not paired
+        pd.DataFrame({"patch_idx": [0, 1, 2], "point_idx": [6, 7, 6], "seq": [1, 2, 1], "written": [False, True, True]}).to_parquet(os.path.join(self.path, "post.parquet"))
+        assert find_patch_pairs(self.path, "npy") == [PatchPair(6, 2, 2)]
+
+    def test_fit_patch(self):
+        data = np.arange(2 * 4 * 6).reshape(2, 4, 6) + 1
+        padded = fit_patch(data, (3, 6, 4))
+        assert padded.shape == (3, 6, 4)
+        assert (padded[:2, 1:5] == data[:, :, 1:5]).all()
+        assert (padded[2] == 0).all() and (padded[:, 0] == 0).all() and (padded[:, 5] == 0).all()
+        resized = fit_patch(data, (2, 8, 12), "resize")
+        assert (resized[:, ::2, ::2] == data).all() and (resized[:, 1::2, 1::2] == data).all()
+        assert (fit_patch(data[:, :0], (2, 3, 3)) == 0).all()
+
+    def test_batches(self):
+        with PairedPatchLoader(self.path, batch_size = 3, shape = (3, 11, 11)) as loader:
+            assert len(loader) == 3
+            epochs = [list(loader) for _ in range(2)]
+            loader.set_epoch(0)
+            again = list(loader)
+        for epoch in epochs:
+            assert [batch.images.shape for batch in epoch] == [(3, 2, 3, 11, 11)] * 2 + [(2, 2, 3, 11, 11)]
+            assert sorted(np.concatenate([batch.point_idx for batch in epoch])) == list(range(1, 9))
+        order = [np.concatenate([batch.point_idx for batch in epoch]).tolist() for epoch in epochs]
+        assert order[0] != order[1]
+        assert order[0] == np.concatenate([batch.point_idx for batch in again]).tolist()
+        for batch in epochs[0]:
+            for (images, point_idx) in zip(batch.images, batch.point_idx):
+                with rio.open(os.path.join(self.path, "post", f"{point_idx}-1.tif")) as src:
+                    assert (images[1] == fit_patch(src.read(), (3, 11, 11))).all()
+        with PairedPatchLoader(self.path, batch_size = 3, drop_last = True, shuffle = False) as loader:
+            assert [batch.point_idx.tolist() for batch in loader] == [[1, 2, 3], [4, 5, 6]]
+
+    def test_workers_and_cache(self):
+        with PairedPatchLoader(self.path, batch_size = 2, shape = (3, 8, 8), fit = "resize") as loader:
+            expected = list(loader)
+        with PairedPatchLoader(self.path, batch_size = 2, shape = (3, 8, 8), fit = "resize", workers = 2, cache = True, cache_dir = self.path) as loader:
+            first = list(loader)
+            # The second epoch comes from the cache, the patches are not read again
+            for phase in ["pre", "post"]:
+                for name in os.listdir(os.path.join(self.path, phase)):
+                    os.remove(os.path.join(self.path, phase, name))
+            loader.set_epoch(0)
+            second = list(loader)
+            cache_path = loader._cache.path
+        assert not os.path.isfile(cache_path)
+        for run in [first, second]:
+            assert len(run) == len(expected)
+            for (a, b) in zip(run, expected):
+                assert (a.images == b.images).all() and (a.point_idx == b.point_idx).all()
+
+    def test_measure_throughput(self):
+        with PairedPatchLoader(self.path, batch_size = 4) as loader:
+            res = measure_throughput(loader, epochs = 2)
+        assert res["samples"] == [8, 8]
+        assert len(res["samples_per_second"]) == 2 and min(res["samples_per_second"]) > 0
+
+
+suite = unittest.TestSuite([
+    unittest.TestLoader().loadTestsFromTestCase(TestCase),
+    unittest.TestLoader().loadTestsFromTestCase(TestPairedPatchLoader),
+])
@@ -1,4 +1,12 @@
 import unittest
+import os.path
+import sys
+import tempfile
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from data_loading.utils import get_phase_from_link
+from data_loading.band_stats_utils import BandStats, save_band_stats, load_band_stats
+from preprocessing.normalization_utils import get_normalization, load_normalization, normalize_patch
 
 
 class TestCase(unittest.TestCase):
@@ -6,4 +14,46 @@ class TestCase(unittest.TestCase):
         self.assertEqual("foo".upper(), "FOO")
 
 
-suite = unittest.TestLoader().loadTestsFromTestCase(TestCase)
+class TestNormalization(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(1)
+        self.links = [
+            "https://host/hurricane-irma/pre-event/2017-05-20/103001006B055400/103001006B055400.tif",
+            "https://host/hurricane-irma/pre-event/2016-09-08/104001005CD78300/104001005CD78300.tif",
+            "https://host/hurricane-irma/post-event/2017-09-12/103001000BC42300/103001000BC42300.tif",
+        ]
+        stats = dict()
+        self.patches = dict()
+        for (i, link) in enumerate(self.links):
+            phase = get_phase_from_link(link)
+            self.patches[link] = rng.normal(50 * (i + 1), 10 * (i + 1), size=(3, 30, 30)).clip(1, 255).astype(np.uint8)
+            stats[(phase, link)] = BandStats()
+            stats[(phase, link)].update(self.patches[link], nodata=0)
+        self.path = os.path.join(self.tmpdir.name, "irma")
+        save_band_stats(self.path, stats)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_load_normalization(self):
+        (mean, std) = load_normalization(self.path, "pre")
+        values = np.concatenate([self.patches[link].reshape(3, -1) for link in self.links[:2]], axis=1).astype(float)
+        assert np.allclose(mean, values.mean(axis=1)) and np.allclose(std, values.std(axis=1))
+        with self.assertRaises(FileNotFoundError):
+            load_normalization(self.tmpdir.name, "pre")
+
+    def test_normalize_patch(self):
+        loaded = load_band_stats(self.path)
+        (mean, std) = get_normalization(loaded, "pre", sensor="WV03")
+        normalized = normalize_patch(self.patches[self.links[1]], mean, std, nodata=0)
+        assert normalized.dtype == np.float32
+        assert np.allclose(normalized.reshape(3, -1).mean(axis=1), 0, atol=1e-4) and np.allclose(normalized.reshape(3, -1).std(axis=1), 1, atol=1e-3)
+        with self.assertRaises(KeyError):
+            get_normalization(loaded, "post", sensor="GE01")
+
+
+suite = unittest.TestSuite([
+    unittest.TestLoader().loadTestsFromTestCase(TestCase),
+    unittest.TestLoader().loadTestsFromTestCase(TestNormalization),
+])